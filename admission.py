@@ -0,0 +1,206 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class AdmissionRejected(Exception):
+    """
+    A request the instance has no room for.
+
+    Args:
+    - status: 429 when the wait queue was full, 503 when the request waited its longest without a slot freeing up.
+    - retry_after: Seconds the caller should wait before trying again, for the Retry-After header.
+    """
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class FileSlots:
+    # Slots shared by every process using the same directory, i.e. all gunicorn workers of an instance. Holding a
+    # slot means holding an flock on its file. The kernel drops the lock when its holder exits, so a worker that
+    # was killed mid request can't leak one.
+
+    def __init__(self, directory, prefix, count):
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, f"{prefix}-{index}.lock") for index in range(count)]
+
+    def try_acquire(self):
+        # Every attempt opens the file anew: flocks on separate open files conflict even within one process
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def release(self, fd):
+        os.close(fd)
+
+
+class LocalSlots:
+    # Slots of this process only, where there is no fcntl (Windows)
+
+    def __init__(self, count):
+        self.free = count
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        with self.lock:
+            if self.free == 0:
+                return None
+            self.free -= 1
+            return True
+
+    def release(self, token):
+        with self.lock:
+            self.free += 1
+
+
+class AdmissionController:
+    """
+    Limits how many generations an instance runs at once, so a burst queues briefly or is turned away fast
+    instead of piling up behind busy workers until gunicorn's timeout kills them.
+
+    A request takes one of limit slots, or several when it generates several letters at once. When too few are
+    free it waits in one of queue_size waiting places for up to max_wait seconds, polling for them. Waiting
+    requests aren't served in arrival order. When the queue is full too, the request is rejected right away.
+
+    Args:
+    - lock_dir: Directory of the slot files shared by the processes of an instance. Without it, or without
+      fcntl, the limits apply to this process only.
+    - retry_after: Seconds rejected requests are told to wait. Up to a quarter more is added at random, so that
+      retries of a rejected burst don't all come back at the same moment.
+    """
+
+    def __init__(self, limit=4, queue_size=4, max_wait=20.0, retry_after=30, lock_dir=None, poll_interval=0.1):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.poll_interval = poll_interval
+        if lock_dir and fcntl is not None:
+            self.slots = FileSlots(lock_dir, "slot", limit)
+            self.waiting_places = FileSlots(lock_dir, "wait", queue_size)
+        else:
+            self.slots = LocalSlots(limit)
+            self.waiting_places = LocalSlots(queue_size)
+        self.lock = threading.Lock()
+        self.counters = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0,
+                         "running": 0, "waiting": 0}
+        self.wait_seconds = 0.0
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def rejection(self, message, status, counter):
+        self.count(counter)
+        retry_after = int(self.retry_after + random.uniform(0, self.retry_after / 4))
+        return AdmissionRejected(message, status, max(retry_after, 1))
+
+    def take_slots(self, count):
+        # All count slots, or none of them, so requests that need several can't hold each other's halves
+        taken = []
+        for _ in range(count):
+            slot = self.slots.try_acquire()
+            if slot is None:
+                for held in taken:
+                    self.slots.release(held)
+                return None
+            taken.append(slot)
+        return tuple(taken)
+
+    def start_waiting(self, count):
+        # Returns the slots when they are free right away, otherwise a waiting place
+        slots = self.take_slots(count)
+        if slots is not None:
+            return self.admitted(slots), None
+        place = self.waiting_places.try_acquire()
+        if place is None:
+            raise self.rejection(f"The server is busy with {self.limit} cover letters and {self.queue_size} waiting",
+                                 429, "rejected_queue_full")
+        self.count("queued")
+        self.count("waiting")
+        return None, place
+
+    def stop_waiting(self, place, started):
+        self.waiting_places.release(place)
+        self.count("waiting", -1)
+        with self.lock:
+            self.wait_seconds += time.monotonic() - started
+
+    def admitted(self, slots):
+        self.count("admitted")
+        self.count("running", len(slots))
+        return slots
+
+    def timed_out(self):
+        return self.rejection(f"No room for the cover letter after waiting {self.max_wait:g}s", 503,
+                              "rejected_timeout")
+
+    def enter(self, count=1):
+        """
+        Take count slots (at most limit), waiting for them when the instance is busy.
+
+        Returns:
+        - The slots, to give back with leave().
+
+        Raises:
+        - AdmissionRejected when the queue is full or the slots didn't free up within max_wait.
+        """
+        count = min(max(count, 1), self.limit)
+        slots, place = self.start_waiting(count)
+        if slots is not None:
+            return slots
+        started = time.monotonic()
+        try:
+            while time.monotonic() - started < self.max_wait:
+                time.sleep(self.poll_interval)
+                slots = self.take_slots(count)
+                if slots is not None:
+                    return self.admitted(slots)
+        finally:
+            self.stop_waiting(place, started)
+        raise self.timed_out()
+
+    async def enter_async(self, count=1):
+        # enter() for the event loop, which has to keep serving while a request waits
+        count = min(max(count, 1), self.limit)
+        slots, place = self.start_waiting(count)
+        if slots is not None:
+            return slots
+        started = time.monotonic()
+        try:
+            while time.monotonic() - started < self.max_wait:
+                await asyncio.sleep(self.poll_interval)
+                slots = self.take_slots(count)
+                if slots is not None:
+                    return self.admitted(slots)
+        finally:
+            self.stop_waiting(place, started)
+        raise self.timed_out()
+
+    def leave(self, slots):
+        for slot in slots:
+            self.slots.release(slot)
+        self.count("running", -len(slots))
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["wait_seconds"] = round(self.wait_seconds, 3)
+        stats["limit"] = self.limit
+        stats["queue_size"] = self.queue_size
+        return stats
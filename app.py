@@ -1,93 +1,322 @@
-import spacy
 import json
+import re
 import openai
 import os
 import requests
 import time
 import firebase_admin
-import datetime
+import tempfile
+import atexit
+import queue
+import threading
+import uuid
+import zipfile
+from collections import namedtuple
+from functools import partial, wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from google.oauth2 import service_account
 from google.cloud import secretmanager, tasks_v2
-from google.protobuf import timestamp_pb2
 from firebase_admin import credentials, firestore
 from io import BytesIO
-from langdetect import detect
-from flask import Flask, jsonify, request
+from admission import AdmissionController, AdmissionRejected
+from browser_pool import BrowserPool
+from caching import TTLCache, SingleFlight, content_hash
+from docx_renderer import render_cover_letter, letter_styles
+from checkpoints import Checkpoint, LocalCheckpointStore, FirestoreCheckpointStore
+from http_client import HttpClient, default_upstreams
+from html_extract import extract_paragraphs, read_paragraphs
+from nlp_pool import NLPClient, score_texts
+from openai_scheduler import OpenAIScheduler, PRIORITY_DRAFT, PRIORITY_REVISION, estimate_tokens, truncate_to_tokens
+from quota import FirestoreQuota, LocalQuota
+from outbox import Outbox, EmailMessage, MailgunTransport, FakeMailgun, DOCX_MIME_TYPE, ZIP_MIME_TYPE
+from page_cache import PageCache, DiskPageCache, FirestorePageCache
+from metrics import (CONTENT_TYPE_LATEST, render_metrics, stats_collector, openai_tokens, http_requests,
+                     http_request_seconds, task_queue_seconds)
+from task_queue import (CloudTasksQueue, LocalTaskQueue, TaskStatuses, Task, PRIORITIES,
+                        QUEUE_RETRY_POLICY)
+from tracing import span, traced, trace_id_from_header
+from langdetect import detect, DetectorFactory
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
 from flask_mail import Mail, Message
 from dotenv import load_dotenv, find_dotenv
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.options import Options
-from bs4 import BeautifulSoup
-from docx import Document
-from docx.shared import Pt
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT as WD_ALIGN_PARAGRAPH
+from selenium.common.exceptions import TimeoutException
 
 app = Flask(__name__)
+CORS_ORIGINS = ["https://myaiguy.net", "https://www.myaiguy.net", "http://localhost:3000"]
 CORS(app, resources={
     r"/*": {
-        "origins": ["https://myaiguy.net", "https://www.myaiguy.net", "http://localhost:3000"]
+        "origins": CORS_ORIGINS
     }
 })
 
 app.config["ENV"] = "development"
 load_dotenv(find_dotenv(usecwd=True))
 
-def access_secret_version(secret_id, project_id="coverlettergenerator-396114", version_id="latest"):
-    secrets_key_file = 'CLRSecretCreds.json'
-    # Access the payload of the secret version.
-    client = secretmanager.SecretManagerServiceClient(credentials=service_account.Credentials.from_service_account_file(secrets_key_file))
+# Offline mode runs without any Google Cloud service: secrets come from the environment, Firebase isn't initialized
+# and every Firestore backed component uses its local backend. Benchmarks and local runs use it to import the app.
+OFFLINE = os.environ.get("COVERLETTER_OFFLINE", "false").lower() == "true"
+
+# Startup phases and how long each took, reported on /startup-report
+startup_timings = {}
+
+@contextmanager
+def startup_phase(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[phase] = round(time.perf_counter() - start, 3)
+        print(f"Startup phase {phase} took {startup_timings[phase]}s")
+
+secrets_client = None
+
+def get_secrets_client():
+    # One Secret Manager client per process, built from the key file on first use
+    global secrets_client
+    if secrets_client is None:
+        secrets_key_file = 'CLRSecretCreds.json'
+        secrets_client = secretmanager.SecretManagerServiceClient(
+            credentials=service_account.Credentials.from_service_account_file(secrets_key_file))
+    return secrets_client
 
+def access_secret_version(secret_id, project_id="coverlettergenerator-396114", version_id="latest"):
     # Build the resource name of the secret version
     name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
 
     # Access the secret version
-    response = client.access_secret_version(name=name)
+    response = get_secrets_client().access_secret_version(name=name)
 
     # Return the decoded payload
     return response.payload.data.decode('UTF-8')
 
+def access_secret_versions(secret_ids):
+    # Fetch several secrets in parallel over the shared client
+    if OFFLINE:
+        # Offline runs read the secrets from environment variables of the same name, if they are set at all
+        return {secret_id: os.environ.get(secret_id, "offline") for secret_id in secret_ids}
+    get_secrets_client()
+    with ThreadPoolExecutor(max_workers=len(secret_ids), thread_name_prefix="secrets") as executor:
+        return dict(zip(secret_ids, executor.map(access_secret_version, secret_ids)))
+
 # Key Variables
+with startup_phase("secrets"):
+    secrets = access_secret_versions(["MAILGUN_API_KEY", "OPENAI_API_KEY", "DEEPL_API_KEY",
+                                      "Firebase-service-account"])
 MAILGUN_DOMAIN = 'mg.myaiguy.net'
-MAILGUN_API_KEY = access_secret_version('MAILGUN_API_KEY')
-MAILGUN_API_ENDPOINT = f"https://api.mailgun.net/v3/mg.myaiguy.net/messages"
-openai.api_key = access_secret_version('OPENAI_API_KEY')
-DEEPL_API_KEY = access_secret_version('DEEPL_API_KEY')
-DEEPL_API_ENDPOINT = "https://api-free.deepl.com/v2/translate"
-
-# Get Firebase service account from Secret Manager
-firebase_service_account_str = access_secret_version("Firebase-service-account")
-firebase_service_account_dict = json.loads(firebase_service_account_str)
-
-# Use the dictionary as credentials for Firebase
-cred = credentials.Certificate(firebase_service_account_dict)
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+MAILGUN_API_KEY = secrets['MAILGUN_API_KEY']
+MAILGUN_API_ENDPOINT = os.environ.get("MAILGUN_API_ENDPOINT", f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages")
+openai.api_key = secrets['OPENAI_API_KEY']
+DEEPL_API_KEY = secrets['DEEPL_API_KEY']
+DEEPL_API_ENDPOINT = os.environ.get("DEEPL_API_ENDPOINT", "https://api-free.deepl.com/v2/translate")
+# The OpenAI client reads OPENAI_API_BASE itself, so all upstreams can be pointed at local stand-ins (see loadtest/)
+
+# Translation caches, keyed by content hash. Seeding langdetect makes its answers deterministic.
+DetectorFactory.seed = 0
+language_cache = TTLCache(max_entries=int(os.environ.get("LANGUAGE_CACHE_SIZE", 5000)))
+translation_cache = TTLCache(max_entries=int(os.environ.get("TRANSLATION_CACHE_SIZE", 5000)),
+                             ttl=int(os.environ.get("TRANSLATION_CACHE_TTL_SECONDS", 7 * 24 * 3600)))
+
+# OpenAI completion cache. Identical prompts (retried tasks, the generic alignment prompt, a company page already
+# seen) reuse the earlier completion, and identical requests in flight at the same time share one upstream call.
+completion_cache = TTLCache(max_entries=int(os.environ.get("COMPLETION_CACHE_SIZE", 2000)),
+                            ttl=int(os.environ.get("COMPLETION_CACHE_TTL_SECONDS", 24 * 3600)))
+inflight_completions = SingleFlight()
+
+# Client side OpenAI rate limiting. The account limits are shared by every worker process, so each process
+# schedules against its share of them.
+OPENAI_SCHEDULER_PROCESSES = int(os.environ.get("OPENAI_SCHEDULER_PROCESSES", os.environ.get("WEB_CONCURRENCY", 1)))
+openai_scheduler = OpenAIScheduler(
+    requests_per_minute=int(os.environ.get("OPENAI_RPM_LIMIT", 3500)) / OPENAI_SCHEDULER_PROCESSES,
+    tokens_per_minute=int(os.environ.get("OPENAI_TPM_LIMIT", 90000)) / OPENAI_SCHEDULER_PROCESSES,
+)
+
+# Letter layout used when the request doesn't pick one of the letter_styles()
+DEFAULT_LETTER_STYLE = os.environ.get("DEFAULT_LETTER_STYLE", "classic")
+
+# Seconds between keep-alive comments on the streaming endpoint
+SSE_KEEPALIVE_SECONDS = 15
+
+# Shared keep-alive HTTP sessions with per-upstream timeouts and retries. Every outbound HTTP call goes through them,
+# including the OpenAI client. The OpenAI client closes its session every few minutes from whichever thread gets
+# there first, so each thread gets a session of its own instead of the shared one.
+http_client = HttpClient(default_upstreams())
+openai.requestssession = lambda: http_client.thread_session("openai")
+
+# Emails go out through a background outbox by default, so a slow Mailgun doesn't hold up the request.
+# MAILGUN_BACKEND=fake swaps Mailgun for a local stand-in that only records the messages. It is the default offline.
+USE_EMAIL_OUTBOX = os.environ.get("EMAIL_OUTBOX", "true").lower() == "true"
+if os.environ.get("MAILGUN_BACKEND", "fake" if OFFLINE else "mailgun") == "fake":
+    mail_transport = FakeMailgun()
+else:
+    mail_transport = MailgunTransport(http_client, MAILGUN_API_ENDPOINT, MAILGUN_API_KEY)
+email_outbox = Outbox(mail_transport, workers=int(os.environ.get("OUTBOX_WORKERS", 2)),
+                      max_attempts=int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 5)))
+# Give queued emails a chance to go out when the worker shuts down
+atexit.register(email_outbox.flush, float(os.environ.get("OUTBOX_SHUTDOWN_TIMEOUT", 20)))
+
+if OFFLINE:
+    db = None
+else:
+    # Get Firebase service account from Secret Manager
+    firebase_service_account_str = secrets["Firebase-service-account"]
+    firebase_service_account_dict = json.loads(firebase_service_account_str)
+
+    # Use the dictionary as credentials for Firebase
+    with startup_phase("firebase"):
+        cred = credentials.Certificate(firebase_service_account_dict)
+        firebase_admin.initialize_app(cred)
+        db = firestore.client()
+
+# Free letter quota, reserved before a letter is generated and committed once it was emailed
+FREE_LETTER_LIMIT = int(os.environ.get("FREE_LETTER_LIMIT", 5))
+if OFFLINE or os.environ.get("QUOTA_BACKEND", "firestore") == "local":
+    letter_quota = LocalQuota(limit=FREE_LETTER_LIMIT)
+else:
+    letter_quota = FirestoreQuota(db, firestore, limit=FREE_LETTER_LIMIT)
+
+# Per-task checkpoints, so a Cloud Tasks retry resumes at the stage that failed instead of starting over
+if OFFLINE or os.environ.get("CHECKPOINT_BACKEND", "firestore") == "local":
+    checkpoint_store = LocalCheckpointStore(os.environ.get("CHECKPOINT_DIR",
+                                                           os.path.join(tempfile.gettempdir(), "checkpoints")))
+else:
+    checkpoint_store = FirestoreCheckpointStore(db, firestore)
+
+# Company page cache. The local tier lives on instance disk, the optional Firestore tier is shared by all instances.
+page_cache = PageCache(
+    DiskPageCache(os.environ.get("PAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "page_cache")),
+                  max_entries=int(os.environ.get("PAGE_CACHE_MAX_ENTRIES", 500))),
+    shared=(FirestorePageCache(db)
+            if not OFFLINE and os.environ.get("PAGE_CACHE_FIRESTORE", "false").lower() == "true" else None),
+    ttl=int(os.environ.get("PAGE_CACHE_TTL_SECONDS", 24 * 3600)),
+)
+
+# Company pages are read in chunks, and only until the first paragraphs are parsed or the cap is reached
+PAGE_MAX_BYTES = int(os.environ.get("PAGE_MAX_BYTES", 1024 * 1024))
+PAGE_CHUNK_BYTES = 16 * 1024
 
 mail = Mail(app)
-nlp = spacy.load("spacy_models/en_core_web_sm/en_core_web_sm-3.6.0")
 driver_path = "/chromedriver.exe"
 
-def score_content(text):
-    keywords = ["about", "mission", "vision", "history", "company", "founded", "established", "believe", "our goal",
-                "we aim", "we strive"]
-    doc = nlp(text)
+# The spaCy model loads in the background so the app can serve requests that don't need it right away.
+# Code that needs the model waits for it through get_nlp. Under gunicorn, gunicorn.conf.py starts a pool of NLP
+# processes shared by all workers instead (see nlp_pool.py), and no worker loads the model itself.
+NLP_MODEL_PATH = os.environ.get("NLP_MODEL_PATH", "spacy_models/en_core_web_sm/en_core_web_sm-3.6.0")
+NLP_LOAD_TIMEOUT = float(os.environ.get("NLP_LOAD_TIMEOUT", 60))
+NLP_POOL_ADDRESS = os.environ.get("NLP_POOL_ADDRESS")
+nlp_client = (NLPClient(NLP_POOL_ADDRESS, bytes.fromhex(os.environ.get("NLP_POOL_AUTHKEY", "")),
+                        timeout=float(os.environ.get("NLP_POOL_TIMEOUT", 10)))
+              if NLP_POOL_ADDRESS else None)
+nlp = None
+nlp_load_error = None
+nlp_ready = threading.Event()
+
+def load_nlp():
+    global nlp, nlp_load_error
+    try:
+        with startup_phase("spacy"):
+            import spacy
+            nlp = spacy.load(NLP_MODEL_PATH)
+    except Exception as e:
+        nlp_load_error = e
+        print(f"Failed to load the spaCy model: {e}")
+    finally:
+        nlp_ready.set()
+
+def get_nlp(timeout=None):
+    if not nlp_ready.wait(NLP_LOAD_TIMEOUT if timeout is None else timeout):
+        raise RuntimeError("The spaCy model is still loading")
+    if nlp is None:
+        raise RuntimeError(f"The spaCy model failed to load: {nlp_load_error}")
+    return nlp
+
+def wait_for_nlp(timeout=None):
+    # Wait until content can be scored, by the NLP pool or the model of this process
+    if nlp_client is not None:
+        nlp_client.wait_ready(NLP_LOAD_TIMEOUT if timeout is None else timeout)
+    else:
+        get_nlp(timeout)
+
+if nlp_client is None:
+    threading.Thread(target=load_nlp, name="load-nlp", daemon=True).start()
+
+# Section generation settings. The three sections don't depend on each other, so by default they are
+# generated in parallel and each one gets its own deadline (in seconds) counted from the fan-out.
+GENERATE_SECTIONS_CONCURRENTLY = os.environ.get("GENERATE_SECTIONS_CONCURRENTLY", "true").lower() == "true"
+SECTION_DEADLINES = {
+    "intro": float(os.environ.get("INTRO_DEADLINE_SECONDS", 60)),
+    "tailored_experience": float(os.environ.get("TAILORED_EXPERIENCE_DEADLINE_SECONDS", 60)),
+    "company_alignment": float(os.environ.get("COMPANY_ALIGNMENT_DEADLINE_SECONDS", 90)),
+}
+# Admission control for the generation endpoints. An instance generates at most ADMISSION_LIMIT letters at once,
+# whatever its number of workers. Up to ADMISSION_QUEUE more requests wait up to ADMISSION_MAX_WAIT seconds for
+# a slot. Requests beyond that get a 429 or 503 with Retry-After, so Cloud Tasks backs off and retries them later.
+ADMISSION_LIMIT = int(os.environ.get("ADMISSION_LIMIT", 4))
+
+# Enough threads for every section of every admitted letter, since a section's deadline also runs while it waits
+# for a thread
+section_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("SECTION_WORKERS", len(SECTION_DEADLINES) * ADMISSION_LIMIT)),
+    thread_name_prefix="section")
+
+# Batches generate their letters on a pool of their own, a few letters at a time with the sections of each letter
+# one after the other, so a large batch can't take over the section executor. A batch takes an admission slot
+# for each letter it generates at once.
+BATCH_MAX_TARGETS = int(os.environ.get("BATCH_MAX_TARGETS", 20))
+BATCH_PARALLELISM = int(os.environ.get("BATCH_PARALLELISM", 4))
+# Seconds a batch request may spend on its letters, under gunicorn's 150s timeout. Letters that aren't done by
+# then are reported as timed out and left out of the email, and their letters aren't used up.
+BATCH_DEADLINE_SECONDS = float(os.environ.get("BATCH_DEADLINE_SECONDS", 120))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_PARALLELISM, thread_name_prefix="batch")
+
+admission = AdmissionController(
+    limit=ADMISSION_LIMIT,
+    queue_size=int(os.environ.get("ADMISSION_QUEUE", 4)),
+    max_wait=float(os.environ.get("ADMISSION_MAX_WAIT", 20)),
+    retry_after=int(os.environ.get("ADMISSION_RETRY_AFTER", 30)),
+    lock_dir=os.environ.get("ADMISSION_LOCK_DIR", os.path.join(tempfile.gettempdir(), "coverletter-admission")),
+)
+
+# How each section is written: the model, the number of passes and the most tokens of user bullets or scraped
+# content its prompt may carry. Two passes write a draft and then revise it, one pass asks for the revised version
+# in a single prompt. SECTION_PIPELINES overrides fields as JSON, e.g. {"intro": {"passes": 1}}.
+SectionPipeline = namedtuple("SectionPipeline", ["model", "passes", "input_tokens"])
+DEFAULT_SECTION_PIPELINES = {
+    "intro": SectionPipeline(model="gpt-3.5-turbo", passes=2, input_tokens=400),
+    "tailored_experience": SectionPipeline(model="gpt-3.5-turbo", passes=2, input_tokens=600),
+    "company_alignment": SectionPipeline(model="gpt-3.5-turbo", passes=1, input_tokens=800),
+}
+SECTION_PASSES = {"intro": (1, 2), "tailored_experience": (1, 2), "company_alignment": (1,)}
+
+def load_section_pipelines(overrides):
+    pipelines = dict(DEFAULT_SECTION_PIPELINES)
+    for section_name, fields in overrides.items():
+        if section_name not in pipelines:
+            raise ValueError(f"Unknown section {section_name} in SECTION_PIPELINES")
+        pipelines[section_name] = pipelines[section_name]._replace(**fields)
+    for section_name, pipeline in pipelines.items():
+        if pipeline.passes not in SECTION_PASSES[section_name]:
+            raise ValueError(f"The {section_name} section can't be written in {pipeline.passes} passes")
+    return pipelines
+
+SECTION_PIPELINES = load_section_pipelines(json.loads(os.environ.get("SECTION_PIPELINES", "{}")))
 
-    # Score based on keywords and named entities
-    keyword_score = sum([text.lower().count(keyword) for keyword in keywords])
-    named_entity_score = len([ent for ent in doc.ents if ent.label_ in ["ORG", "DATE"]])
+def score_content(text):
+    return score_contents([text])[0]
 
-    return keyword_score + named_entity_score
+def score_contents(texts):
+    if nlp_client is not None:
+        return nlp_client.score(texts)
+    return score_texts(get_nlp(), texts)
 
 def extract_relevant_content(text_content):
     # Split the text into sentences by breaking at each period
     sentences = [sent.strip() for sent in text_content.split('.') if sent]
 
-    # Score each sentence
-    scored_sentences = [(sent, score_content(sent)) for sent in sentences]
+    # Score all sentences in one batch
+    with span("score", sentences=len(sentences)):
+        scored_sentences = list(zip(sentences, score_contents(sentences)))
 
     # Sort sentences based on score and length
     scored_sentences.sort(key=lambda s: (-s[1], len(s[0])))
@@ -98,23 +327,75 @@ def extract_relevant_content(text_content):
     return ' '.join(top_sentences)
 
 def get_web_content(url):
+    return fetch_web_page(url)["content"]
+
+def fetch_web_page(url, etag=None, last_modified=None):
+    """
+    Fetch the first paragraphs of a web page, falling back to headless Chrome when plain requests fails.
+
+    Args:
+    - etag, last_modified: Validators from a cached copy. When given, the request is conditional and a
+      304 response is reported as not_modified instead of being parsed.
+
+    Returns:
+    - A dict with the joined "content", the individual "paragraphs", the response "etag" and "last_modified"
+      headers and the "not_modified" flag.
+    """
     try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
-        }
-        response = requests.get(url, headers=headers)
-        print("Response code for website URL:", response.status_code)
-        response.raise_for_status()
-        html_content = response.text
-        soup = BeautifulSoup(html_content, 'html.parser')
-        paragraphs = soup.find_all('p')
-        content = " ".join([para.text for para in paragraphs[:10]])
-        if len(soup.get_text()) > 50:
-            return content
+        with span("scrape_requests") as scrape, \
+                http_client.get("scrape", url, headers=scrape_headers(etag, last_modified), stream=True) as response:
+            print("Response code for website URL:", response.status_code)
+            if response.status_code == 304:
+                return {"content": None, "paragraphs": None, "etag": etag, "last_modified": last_modified,
+                        "not_modified": True}
+            response.raise_for_status()
+            extractor = read_paragraphs(response.iter_content(PAGE_CHUNK_BYTES), response.encoding, PAGE_MAX_BYTES)
+            scrape.set(bytes_read=extractor.bytes_read)
+            paragraphs = extractor.result()
+            if paragraphs is not None:
+                return {"content": " ".join(paragraphs), "paragraphs": paragraphs,
+                        "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified"),
+                        "not_modified": False}
     except requests.exceptions.RequestException as e:
         print(f"Error fetching the page with requests: {e}")
 
-    # If the requests approach fails, fall back to Selenium
+    # If the requests approach fails, fall back to Selenium with a warm browser from the pool
+    return fetch_with_browser(url)
+
+def scrape_headers(etag=None, last_modified=None):
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
+    }
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+def fetch_with_browser(url):
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    with span("scrape_selenium"), browser_pool.browser() as browser:
+        print("Fetching content from:", url)
+        browser.get(url)
+        WebDriverWait(browser, 10).until(EC.presence_of_element_located((By.TAG_NAME, 'p')))
+        paragraphs = [para.text for para in browser.find_elements(By.TAG_NAME, 'p')[:10]]
+        print("Fetched content")
+
+    return {"content": " ".join(paragraphs), "paragraphs": paragraphs, "etag": None, "last_modified": None,
+            "not_modified": False}
+
+def parse_page(html_content):
+    # The text of the first paragraphs, or None when the page has too little text to be worth using
+    return extract_paragraphs(html_content, max_paragraphs=10, min_text_length=50)
+
+def start_headless_chrome():
+    # Selenium's webdriver package is slow to import, so it is only imported once a browser is needed
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+
     options = Options()
     options.add_argument("--headless")
     chrome_prefs = {
@@ -123,18 +404,57 @@ def get_web_content(url):
     }
     options.experimental_options["prefs"] = chrome_prefs
     browser = webdriver.Chrome(options=options)
+    browser.set_page_load_timeout(BROWSER_PAGE_LOAD_TIMEOUT)
+    return browser
+
+# Warm headless Chrome pool for pages that plain requests can't fetch. Chrome is the largest memory consumer on an
+# instance, so the pool size caps how many pages are rendered at once.
+BROWSER_PAGE_LOAD_TIMEOUT = int(os.environ.get("BROWSER_PAGE_LOAD_TIMEOUT", 20))
+browser_pool = BrowserPool(
+    start_headless_chrome,
+    size=int(os.environ.get("BROWSER_POOL_SIZE", 1)),
+    max_pages=int(os.environ.get("BROWSER_MAX_PAGES", 50)),
+    acquire_timeout=float(os.environ.get("BROWSER_ACQUIRE_TIMEOUT", 5)),
+    max_overflow=int(os.environ.get("BROWSER_POOL_OVERFLOW", 1)),
+    healthy_exceptions=(TimeoutException,),
+)
+atexit.register(browser_pool.close)
+
+def get_company_content(url):
+    """
+    Get the text of a company page together with its most relevant sentences.
 
-    try:
-        print("Fetching content from:", url)
-        browser.get(url)
-        WebDriverWait(browser, 10).until(EC.presence_of_element_located((By.TAG_NAME, 'p')))
-        paragraphs = browser.find_elements(By.TAG_NAME, 'p')
-        content = " ".join([para.text for para in paragraphs[:10]])
-        print("Fetched content")
-    finally:
-        browser.quit()
+    Fresh cache hits skip both the fetch and the spaCy scoring. Stale entries are revalidated with their
+    ETag/Last-Modified validators and only re-scored when the page changed.
 
-    return content
+    Returns:
+    - A (text_content, relevant_content) tuple. text_content is empty when the page has no usable text.
+    """
+    entry, fresh = page_cache.lookup(url)
+    if entry is not None and fresh:
+        print("Company page cache hit:", url)
+        return " ".join(entry["paragraphs"]), entry["relevant_content"]
+
+    page = fetch_web_page(url,
+                          etag=entry.get("etag") if entry else None,
+                          last_modified=entry.get("last_modified") if entry else None)
+    return company_content_from_page(url, entry, page)
+
+def company_content_from_page(url, entry, page):
+    # Score a freshly fetched page and cache it, or refresh the cached entry when the page didn't change
+    if page["not_modified"]:
+        print("Company page not modified since it was cached:", url)
+        entry = page_cache.revalidated(url, entry)
+        return " ".join(entry["paragraphs"]), entry["relevant_content"]
+
+    text_content = page["content"]
+    if not text_content:
+        return text_content, ""
+
+    relevant_content = extract_relevant_content(text_content)
+    page_cache.store(url, page["paragraphs"], relevant_content, etag=page["etag"],
+                     last_modified=page["last_modified"])
+    return text_content, relevant_content
 
 # def extract_relevant_content(html_content):
 #     soup = BeautifulSoup(html_content, 'html.parser')
@@ -246,75 +566,253 @@ def clean_response_text(response_text):
 
     return response_text
 
-def safe_openai_request(request_function, max_retries=3, delay=5):
+def safe_openai_request(request_function, max_retries=3, delay=1, cache_key=None, priority=PRIORITY_DRAFT,
+                        estimated_tokens=1000):
     """
     Safe wrapper around OpenAI requests with retries.
 
     Args:
     - request_function: A function that makes the actual OpenAI request.
-    - max_retries: Maximum number of times to retry the request.
-    - delay: How many seconds to wait between retries.
+    - max_retries: Maximum number of attempts for the request.
+    - delay: Base delay in seconds for the exponential backoff between retries. A Retry-After header wins.
+    - cache_key: When given, the response is served from the completion cache, and identical requests that are
+      in flight at the same time share one upstream call.
+    - priority: Scheduling priority, PRIORITY_REVISION requests are admitted before PRIORITY_DRAFT ones.
+    - estimated_tokens: Tokens the request is expected to use, charged against the tokens-per-minute budget.
 
     Returns:
     - The response from the OpenAI request.
     """
-    for attempt in range(max_retries):
-        try:
-            return request_function()
-        except openai.error.ServiceUnavailableError:
-            if attempt < max_retries - 1:  # i.e. not the last attempt
-                time.sleep(delay)
-                continue
+    def scheduled_request():
+        return openai_scheduler.run(request_function, estimated_tokens=estimated_tokens, priority=priority,
+                                    max_attempts=max_retries, base_delay=delay)
+
+    if cache_key is None:
+        return scheduled_request()
+
+    cached = completion_cache.get(cache_key)
+    if cached is not None:
+        print("Completion cache hit")
+        return cached
+
+    def fetch():
+        response = scheduled_request()
+        completion_cache.set(cache_key, response)
+        return response
+
+    return inflight_completions.do(cache_key, fetch)
+
+def completion_cache_key(model, messages):
+    # Whitespace differences don't change the completion, so they don't change the key either
+    normalized = [{"role": message["role"], "content": " ".join(message["content"].split())} for message in messages]
+    return content_hash(model, normalized)
+
+def chat_completion(model, messages, on_delta=None, priority=PRIORITY_DRAFT):
+    """
+    Create a chat completion through the completion cache.
+
+    Args:
+    - priority: Scheduling priority passed on to safe_openai_request.
+    - on_delta: Optional callback that receives the completion text as it is generated. It is called with None
+      when a streamed attempt failed and is retried, so the text received so far should be discarded.
+      Completions served from the cache or by a coalesced request arrive in one piece.
+    """
+    streamed_attempts = []
+
+    def request_function():
+        with span("openai", model=model, stream=on_delta is not None):
+            if on_delta is None:
+                response = openai.ChatCompletion.create(model=model, messages=messages,
+                                                        request_timeout=http_client.timeout("openai"))
             else:
-                raise
+                if streamed_attempts:
+                    on_delta(None)
+                streamed_attempts.append(True)
+                response = stream_chat_completion(model, messages, on_delta)
+        record_token_usage(model, messages, response)
+        return response
+
+    response = safe_openai_request(request_function, cache_key=completion_cache_key(model, messages),
+                                   priority=priority, estimated_tokens=estimate_tokens(messages))
+    if on_delta is not None and not streamed_attempts:
+        on_delta(response['choices'][0]['message']['content'])
+    return response
+
+def stream_chat_completion(model, messages, on_delta):
+    chunks = []
+    for chunk in openai.ChatCompletion.create(model=model, messages=messages, stream=True,
+                                              request_timeout=http_client.timeout("openai")):
+        delta = chunk['choices'][0]['delta'].get('content')
+        if delta:
+            chunks.append(delta)
+            on_delta(delta)
+    # Same shape as a regular response, so callers and the completion cache can't tell them apart
+    return {"choices": [{"message": {"role": "assistant", "content": "".join(chunks)}}]}
+
+def record_token_usage(model, messages, response):
+    usage = response.get("usage")
+    if usage:
+        openai_tokens.labels(model=model, kind="prompt", source="usage").inc(usage["prompt_tokens"])
+        openai_tokens.labels(model=model, kind="completion", source="usage").inc(usage["completion_tokens"])
+    else:
+        # Streamed responses don't report usage, so count roughly four characters per token
+        completion = response["choices"][0]["message"]["content"]
+        openai_tokens.labels(model=model, kind="prompt", source="estimate").inc(
+            sum(len(message["content"]) for message in messages) // 4)
+        openai_tokens.labels(model=model, kind="completion", source="estimate").inc(len(completion) // 4)
+
+def pass_callback(on_delta, pass_name):
+    # Tag the streamed text of one OpenAI call with the pass it belongs to
+    if on_delta is None:
+        return None
+    return lambda text: on_delta(pass_name, text)
+
 
+def detect_language(text):
+    # Language detection is cached by content, and langdetect is seeded below so the answer is deterministic
+    key = content_hash(text)
+    language = language_cache.get(key)
+    if language is None:
+        try:
+            language = detect(text)
+        except Exception:
+            # If there's any issue detecting the language, treat it as unknown and translate
+            language = "unknown"
+        language_cache.set(key, language)
+    return language
 
 def translate_text(text, target_language="EN"):
-    try:
-        detected_language = detect(text)
-        # If detected language is English, return the text without translating
-        if detected_language == 'en':
-            return text
-    except:
-        # If there's any issue detecting the language, proceed with translation
-        pass
+    return translate_texts([text], target_language)[0]
 
-    headers = {
-        "Authorization": f"DeepL-Auth-Key {DEEPL_API_KEY}",
-        "Content-Type": "application/json",
-        "User-Agent": "CoverLetterRewriterApp/1.0"
-    }
+def translate_texts(texts, target_language="EN"):
+    """
+    Translate several texts with at most one DeepL call.
 
-    payload = {
-        "text": [text],
-        "target_lang": target_language,
-    }
+    English texts are returned as they are, and translations are cached by content so repeated text never
+    reaches DeepL twice. If DeepL fails, the untranslated text is returned.
+    """
+    translated, pending = cached_translations(texts, target_language)
+    if not pending:
+        return translated
 
-    response = requests.post(DEEPL_API_ENDPOINT, headers=headers, json=payload)
+    pending_texts = list(pending)
+    try:
+        with span("deepl", texts=len(pending_texts)):
+            response = http_client.post("deepl", DEEPL_API_ENDPOINT, headers=deepl_headers(),
+                                        json=deepl_payload(pending_texts, target_language))
+    except requests.exceptions.RequestException as e:
+        print(f"DeepL request failed, keeping the untranslated texts: {e}")
+        return translated
 
     # Print debugging information
-    print("DeepL API Status Code:", response.status_code)
+    print("DeepL API Status Code:", response.status_code, "Texts:", len(pending_texts))
 
     try:
-        response_data = response.json()
-        return response_data['translations'][0]['text']
+        translations = response.json()['translations']
     except Exception as e:
         print(f"Failed to parse JSON: {e}")
-        return None
+        return translated
+    return apply_translations(translated, pending, translations, target_language)
+
+def cached_translations(texts, target_language):
+    # The texts with English and cached ones already in place, and the texts left to translate with their positions
+    translated = list(texts)
+    pending = {}
+    for index, text in enumerate(texts):
+        if not text or detect_language(text) == 'en':
+            continue
+        cached = translation_cache.get(content_hash(target_language, text))
+        if cached is not None:
+            translated[index] = cached
+        else:
+            pending.setdefault(text, []).append(index)
+    return translated, pending
+
+def deepl_headers():
+    return {
+        "Authorization": f"DeepL-Auth-Key {DEEPL_API_KEY}",
+        "Content-Type": "application/json",
+        "User-Agent": "CoverLetterRewriterApp/1.0"
+    }
+
+def deepl_payload(pending_texts, target_language):
+    return {
+        "text": pending_texts,
+        "target_lang": target_language,
+    }
 
-def rewrite_intro(name, role, company, intro_points):
-    translated_intro_points = translate_text(intro_points)
+def apply_translations(translated, pending, translations, target_language):
+    for text, translation in zip(pending, translations):
+        translation_cache.set(content_hash(target_language, text), translation['text'])
+        for index in pending[text]:
+            translated[index] = translation['text']
+    return translated
+
+# Section writers are generators that yield the steps they need done (an OpenAI completion, the company page) and
+# get each step's result sent back. run_section performs the steps with blocking calls, the async serving mode in
+# asgi_app.py performs the same steps with non-blocking clients.
+CompletionStep = namedtuple("CompletionStep", ["model", "messages", "pass_name", "priority"],
+                            defaults=["final", PRIORITY_DRAFT])
+CompanyContentStep = namedtuple("CompanyContentStep", ["url"])
+
+def run_section(steps, on_delta=None):
+    # A step that fails is raised inside the section writer, which may handle it
+    result, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result, error = None, None
+        try:
+            result = perform_step(step, on_delta)
+        except Exception as e:
+            error = e
+
+def perform_step(step, on_delta=None):
+    if isinstance(step, CompanyContentStep):
+        return get_company_content(step.url)
+    return chat_completion(step.model, step.messages, on_delta=pass_callback(on_delta, step.pass_name),
+                           priority=step.priority)
+
+def trim_section_input(section_name, text, pipeline):
+    # Keep user bullets and scraped content within the section's prompt budget
+    trimmed = truncate_to_tokens(text, pipeline.input_tokens)
+    if trimmed != text:
+        print(f"Trimmed the {section_name} input from {len(text)} to {len(trimmed)} characters")
+    return trimmed
+
+def intro_steps(name, role, company, translated_intro_points, pipeline=None):
+    pipeline = pipeline or SECTION_PIPELINES["intro"]
+    translated_intro_points = trim_section_input("intro", translated_intro_points, pipeline)
+
+    if pipeline.passes == 1:
+        # Draft and revision in one OpenAI call
+        response = yield CompletionStep(
+            model=pipeline.model,
+            messages=[
+                {"role": "system",
+                 "content": "You are a wise and experienced career coach with a specialty in resumes and cover letters"},
+                {"role": "user",
+                 "content": f"We must write an intro paragraph for a cover letter. I will give you a few key points about myself and you must incorporate them and also highlight why I would be a strong fit for the position. This is for a very important job. The intro should stand out among a crowded field, and it should generate curiosity and intrigue to the first human gatekeeper. It must not sound robotic: write in a human style while remaining professional, with a very assertive tone. Please ONLY RETURN TWO PARAGRAPHS AND NO MORE. This is only the intro, so please DO NOT ADD SIGNATURE AT THE END. My name is {name}, and I am applying for {role} at {company}. Here are the bullet points: {translated_intro_points}"},
+            ],
+            pass_name="final"
+        )
+        cleaned_response = clean_response_text(response['choices'][0]['message']['content'].strip())
+        print(cleaned_response)
+        return cleaned_response
 
     # First OpenAI call
-    response = safe_openai_request(lambda: openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
+    response = yield CompletionStep(
+        model=pipeline.model,
         messages=[
             {"role": "system",
              "content": "You are a wise and experienced career coach with a specialty in resumes and cover letters"},
             {"role": "user",
              "content": f"We must write an intro paragraph for a cover letter. Please write ONLY ONE PARAGRAPH. I will give you a few key points about myself and you must incorporate them and also highlight why I would be a strong fit for the position. This is for a very important job. This is only the intro, so please DO NOT ADD SIGNATURE AT THE END. The intro paragraph should stand out among a crowded field, and it should generate curiosity and intrigue to the first human gatekeeper. Please write in a human style. My name is {name}, and I am applying for {role} at {company}. Here are the bullet points: {translated_intro_points}"},
-        ]
-    ))
+        ],
+        pass_name="draft"
+    )
     initial_response_text = response['choices'][0]['message']['content']
 
     # Extract the main content and send it back for revision
@@ -323,193 +821,724 @@ def rewrite_intro(name, role, company, intro_points):
     if ',' in main_content:
         main_content = main_content.split(',', 1)[1].strip()
     # Second OpenAI call
-    revised_response = safe_openai_request(lambda: openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
+    revised_response = yield CompletionStep(
+        model=pipeline.model,
         messages=[
             {"role": "system",
              "content": "You are a meticulous editor. Please revise the following content for clarity and impact."},
             {"role": "user",
              "content": f"I am going to give you an intro paragraph for a cover letter. It's pretty good, but seems robotic, and we need to humanize it while remaining professional. We are looking for a very assertive tone. Please ONLY RETURN TWO PARAGRAPHS AND NO MORE. This is only the intro, so please DO NOT ADD SIGNATURE AT THE END. My name is {name} and I am applying for a {role} position for {company}. Here is the paragraph {main_content}"},
-        ]
-    ))
+        ],
+        pass_name="final",
+        priority=PRIORITY_REVISION
+    )
     cleaned_response = clean_response_text(revised_response['choices'][0]['message']['content'].strip())
     print(cleaned_response)
     return cleaned_response
 
-def rewrite_tailored_experience(role, company, tailored_experience_points):
-    translated_tailored_experience_points = translate_text(tailored_experience_points)
+def tailored_experience_steps(role, company, translated_tailored_experience_points, pipeline=None):
+    pipeline = pipeline or SECTION_PIPELINES["tailored_experience"]
+    translated_tailored_experience_points = trim_section_input(
+        "tailored_experience", translated_tailored_experience_points, pipeline)
+
+    if pipeline.passes == 1:
+        # Draft and revision in one OpenAI call
+        response = yield CompletionStep(
+            model=pipeline.model,
+            messages=[
+                {"role": "system",
+                 "content": "You are a wise and experienced career coach with a specialty in resumes and cover letters"},
+                {"role": "user",
+                 "content": f"We need to write a tailored experience section for a cover letter. Please write ONLY TWO PARAGRAPHS. I will give you some key points about my experience and skills and you must incorporate them to highlight why I'd be a great fit for the role. This is for a significant role and it's crucial that this section showcases my expertise effectively. Write it in a compelling and assertive style with a humanized touch, so that it stands out from other applications. Again, I am applying for {role} at {company}. Here are the bullet points: {translated_tailored_experience_points}"},
+            ],
+            pass_name="final"
+        )
+        cleaned_response = clean_response_text(response['choices'][0]['message']['content'].strip())
+        print(cleaned_response)
+        return cleaned_response
 
     # First OpenAI call
-    response = safe_openai_request(lambda: openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
+    response = yield CompletionStep(
+        model=pipeline.model,
         messages=[
             {"role": "system",
              "content": "You are a wise and experienced career coach with a specialty in resumes and cover letters"},
             {"role": "user",
              "content": f"We need to write a tailored experience section for a cover letter. Please write ONLY TWO PARAGRAPHS. I will give you some key points about my experience and skills and you must incorporate them to highlight why I'd be a great fit for the role. This is for a significant role and it's crucial that this section showcases my expertise effectively. Please write in a compelling and assertive style. Again, I am applying for {role} at {company}. Here are the bullet points: {translated_tailored_experience_points}"},
-        ]
-    ))
+        ],
+        pass_name="draft"
+    )
     initial_response_text = response['choices'][0]['message']['content']
 
     # Extract the main content and send it back for revision
     main_content = initial_response_text.strip()
 
     # Second OpenAI call for revision
-    revised_response = safe_openai_request(lambda: openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
+    revised_response = yield CompletionStep(
+        model=pipeline.model,
         messages=[
             {"role": "system",
              "content": "You are a meticulous editor. Please revise the following content for clarity, conciseness, and impact."},
             {"role": "user",
              "content": f"I'm sharing a tailored experience section of a cover letter with you. Please write ONLY TWO PARAGRAPHS. I think it's decent, but I'm confident it can be better. Please rewrite it with a more humanized touch, ensuring it stands out from other applications and effectively showcases my skills and experience. Here is the paragraph: {main_content}"},
-        ]
-    ))
+        ],
+        pass_name="final",
+        priority=PRIORITY_REVISION
+    )
     cleaned_revised_response = clean_response_text(revised_response['choices'][0]['message']['content'].strip())
     print(cleaned_revised_response)
     return cleaned_revised_response
 
-def rewrite_company_alignment(company_url, name, company):
+def company_alignment_steps(company_url, name, company, pipeline=None, company_content=None):
+    # company_content is the (text_content, relevant_content) of company_url when the caller already fetched it
+    pipeline = pipeline or SECTION_PIPELINES["company_alignment"]
     text_content = None
-    if company_url:  # Checking if the URL is provided
+    relevant_content = None
+    if company_content is not None:
+        text_content, relevant_content = company_content
+        relevant_content = trim_section_input("company_alignment", relevant_content, pipeline)
+    elif company_url:  # Checking if the URL is provided
         try:
-            # Step 1: Fetch the HTML content from the company URL
-            text_content = get_web_content(company_url)
+            # Step 1: Fetch the company page and its most relevant content, from the page cache when possible
+            text_content, relevant_content = yield CompanyContentStep(company_url)
+            relevant_content = trim_section_input("company_alignment", relevant_content, pipeline)
         except Exception as e:
             print(f"Failed to fetch content from URL due to: {e}")
 
     if not text_content:
         # Generic OpenAI call for a broad alignment with companies
-        response = safe_openai_request(lambda: openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = yield CompletionStep(
+            model=pipeline.model,
             messages=[
                 {"role": "system",
                  "content": "You are a talented writer, experienced in aligning professional strengths with company values in cover letters"},
                 {"role": "user",
                  "content": f"I don't have specific information about the company {company}. However, this is the final section of the letter, so DO NOT USE SALUTATIONS, but include a signature that ends with {name}. Can you craft ONE OR TWO paragraphs for my cover letter that emphasizes a generic alignment with popular company values like innovation, dedication, teamwork, and excellence?"}
-            ]
-        ))
+            ],
+            pass_name="final"
+        )
     else:
-        # Step 2: Extract the most relevant content using the score_content function
-        relevant_content = extract_relevant_content(text_content)
-
-        # Step 3: Send the extracted content to OpenAI for rephrasing
-        response = safe_openai_request(lambda: openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        # Step 2: Send the extracted content to OpenAI for rephrasing
+        response = yield CompletionStep(
+            model=pipeline.model,
             messages=[
                 {"role": "system",
                  "content": "You are a talented writer, experienced in aligning professional strengths with company values in cover letters"},
                 {"role": "user",
                  "content": f"I've extracted some content about the company {company} from their website. This is the final section of the letter, so DO NOT USE SALUTATIONS, but include a signature that ends with {name}. Can you help me craft ONE OR TWO paragraphs for my cover letter that emphasizes my alignment with the company's values and mission derived from the main points that I will provide? Here's the extracted content: {relevant_content}"}
-            ]
-        ))
+            ],
+            pass_name="final"
+        )
 
     alignment_paragraph_raw = response['choices'][0]['message']['content'].strip()
     alignment_paragraph_cleaned = clean_response_text(alignment_paragraph_raw)
     print("Company Alignment Content: ", alignment_paragraph_cleaned)
     return alignment_paragraph_cleaned
 
+def rewrite_intro(name, role, company, translated_intro_points, on_delta=None):
+    return run_section(intro_steps(name, role, company, translated_intro_points), on_delta)
+
+def rewrite_tailored_experience(role, company, translated_tailored_experience_points, on_delta=None):
+    return run_section(tailored_experience_steps(role, company, translated_tailored_experience_points), on_delta)
+
+def rewrite_company_alignment(company_url, name, company, on_delta=None, company_content=None):
+    return run_section(company_alignment_steps(company_url, name, company, company_content=company_content),
+                       on_delta)
+
 @app.route('/test', methods=['GET'])
 def test():
     return jsonify({"message": "Server is running!"})
 
 
+@app.route('/startup-report', methods=['GET'])
+def startup_report():
+    if nlp_client is not None:
+        try:
+            nlp_client.wait_ready(0)
+            nlp_available = True
+        except RuntimeError:
+            nlp_available = False
+    else:
+        nlp_available = nlp_ready.is_set() and nlp is not None
+    return jsonify({"phases": startup_timings, "nlp_ready": nlp_available, "nlp_pool": nlp_client is not None})
+
+
+@app.route('/_ah/warmup', methods=['GET'])
+def warmup():
+    # App Engine sends warmup requests before routing traffic to a new instance, so wait for the model here
+    wait_for_nlp()
+    return jsonify({"message": "Warmed up", "startup": startup_timings})
+
+
+@app.route('/http-stats', methods=['GET'])
+def http_stats():
+    return jsonify(http_client.stats())
+
+
+# Statistics the components already keep, reported on every scrape of /metrics
+stats_collector("coverletter_cache", "Cache statistics", lambda: {
+    "completion": completion_cache.stats(),
+    "translation": translation_cache.stats(),
+    "language": language_cache.stats(),
+    "company_page": page_cache.stats(),
+    "completion_inflight": {"coalesced": inflight_completions.coalesced},
+}, "cache", gauges=("entries",))
+stats_collector("coverletter_upstream", "Outbound HTTP requests", http_client.stats, "upstream")
+stats_collector("coverletter_openai_scheduler", "OpenAI scheduler", lambda: {"openai": openai_scheduler.stats()},
+                "scheduler", gauges=("in_flight", "waiting"))
+stats_collector("coverletter_outbox", "Email outbox", lambda: {"email": email_outbox.stats()},
+                "outbox", gauges=("pending",))
+stats_collector("coverletter_browser_pool", "Headless Chrome pool", lambda: {"chrome": browser_pool.stats()}, "pool",
+                gauges=("idle",))
+stats_collector("coverletter_nlp_pool", "Batches sent to the NLP pool",
+                lambda: {"nlp": nlp_client.stats()} if nlp_client is not None else {}, "pool")
+stats_collector("coverletter_admission", "Admission control of the generation endpoints",
+                lambda: {"generate": admission.stats()}, "controller",
+                gauges=("running", "waiting", "limit", "queue_size"))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus text format, for all gunicorn workers of the instance (see metrics.py)
+    return Response(render_metrics(), content_type=CONTENT_TYPE_LATEST)
+
+
+# Endpoints hit by every metrics scrape and health check, which would flood the logs with request spans
+UNTRACED_ENDPOINTS = {"metrics", "test"}
+
+@app.before_request
+def start_request_span():
+    # Every stage a request runs becomes a child span of this one, in the request's Cloud Trace when there is one
+    g.request_started = time.perf_counter()
+    if request.endpoint in UNTRACED_ENDPOINTS:
+        return
+    g.request_span = span("request", trace_id=trace_id_from_header(request.headers.get("X-Cloud-Trace-Context")),
+                          record=False, endpoint=request.endpoint, method=request.method)
+    g.request_span.__enter__()
+
+
+@app.teardown_request
+def end_request_span(error=None):
+    request_span = g.pop("request_span", None)
+    if request_span is not None:
+        if error is None:
+            request_span.__exit__(None, None, None)
+        else:
+            request_span.__exit__(type(error), error, error.__traceback__)
+
+
+@app.after_request
+def record_request(response):
+    # Streamed responses are counted once their headers are ready, not when the stream ends
+    endpoint = request.endpoint or "unknown"
+    http_requests.labels(endpoint=endpoint, method=request.method, status=response.status_code).inc()
+    if "request_started" in g:
+        http_request_seconds.labels(endpoint=endpoint).observe(time.perf_counter() - g.request_started)
+
+    # Offline runs report which worker process served a request, so the load harness can break results down by it
+    if OFFLINE:
+        response.headers["X-Worker-Id"] = str(os.getpid())
+    return response
+
+
+# Local stand-in for Cloud Tasks (loadtest/stubs.py). When set, tasks are posted to it instead of the real queue.
+CLOUD_TASKS_STUB_URL = os.environ.get("CLOUD_TASKS_STUB_URL")
+TASKS_PROJECT_ID = os.environ.get("PROJECT_ID", "coverlettergenerator-396114")
+TASKS_LOCATION = os.environ.get("LOCATION", "us-east1")
+TASKS_QUEUE_NAME = os.environ.get("QUEUE_NAME", "cover-letter-queue")
+# Submissions of the same letter within a window of this many seconds become one task
+TASK_DEDUP_WINDOW = int(os.environ.get("TASK_DEDUP_WINDOW_SECONDS", 600))
+# The fields that make two submissions the same letter
+TASK_FINGERPRINT_FIELDS = ("email", "name", "role", "company", "intro_points", "tailored_experience_points",
+                           "company_alignment_points", "letter_style")
+
+tasks_client = None
+
+def get_tasks_client():
+    # One Cloud Tasks client per process, built from the key file on first use
+    global tasks_client
+    if tasks_client is None:
+        tasks_key_file = 'cloudrun-deploy-account.json'
+        tasks_client = tasks_v2.CloudTasksClient(
+            credentials=service_account.Credentials.from_service_account_file(tasks_key_file))
+    return tasks_client
+
+def task_id(data, headers=None, now=None):
+    """
+    Deterministic task id for a submission, so a double click or a resent form doesn't generate the letter twice.
+
+    Cloud Tasks refuses a second task with the same name, and the id is also the key of the task's checkpoints.
+    It comes from the client's Idempotency-Key when there is one, and from the letter's fields otherwise, together
+    with the TASK_DEDUP_WINDOW the submission falls in. Two submissions either side of a window boundary
+    get different ids.
+    """
+    if headers is None:
+        headers = request.headers
+    client_key = headers.get("Idempotency-Key") or data.get("idempotency_key")
+    if client_key:
+        fingerprint = content_hash("key", client_key)
+    else:
+        fields = {field: data.get(field) for field in TASK_FINGERPRINT_FIELDS}
+        fields["email"] = (fields["email"] or "").strip().lower()
+        fields["letter_style"] = fields["letter_style"] or DEFAULT_LETTER_STYLE
+        fingerprint = content_hash("fields", fields)
+    window = int((time.time() if now is None else now) // TASK_DEDUP_WINDOW)
+    return f"letter-{fingerprint[:32]}-{window}"
+
+def task_delay(data):
+    # Tasks run right away unless the submission asks for a delay
+    delay = data.get("delay_seconds", 0)
+    if not isinstance(delay, (int, float)) or isinstance(delay, bool) or not 0 <= delay <= 30 * 24 * 3600:
+        raise ValueError("delay_seconds must be a number of seconds between 0 and 30 days")
+    return delay
+
+def task_priority(data):
+    # Only the local task queue orders tasks by priority, Cloud Tasks runs them as they come
+    priority = data.get("priority", "normal")
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority: {priority}. Choose one of: {', '.join(PRIORITIES)}")
+    return PRIORITIES[priority]
+
 @app.route('/enqueue-cover-letter-task', methods=['POST'])
 def enqueue_task():
-    tasks_key_file = 'cloudrun-deploy-account.json'
-    client = tasks_v2.CloudTasksClient(credentials=service_account.Credentials.from_service_account_file(tasks_key_file))
-
-    PROJECT_ID = 'coverlettergenerator-396114'
-    LOCATION = 'us-east1'
-    QUEUE_NAME = 'cover-letter-queue'
-
-    # Define the queue name and location
-    parent = client.queue_path(PROJECT_ID, LOCATION, QUEUE_NAME)
-
-    # Create a task
-    task = {
-        'app_engine_http_request': {
-            'http_method': 'POST',
-            'relative_uri': '/generate-cover-letter',
-            'body': request.data,  # Your request payload here
-            'headers': {
-                'Content-Type': 'application/json'
-            }
-        }
-    }
-
-    # Calculate schedule time (optional)
-    d = datetime.datetime.utcnow() + datetime.timedelta(seconds=10)
-    timestamp = timestamp_pb2.Timestamp()
-    timestamp.FromDatetime(d)
-    task['schedule_time'] = timestamp
+    try:
+        data = get_data_from_request()
+        # A task that can't succeed would only be retried until the queue gives up on it
+        validate_input_data(data)
+        letter_task_id = task_id(data)
+        name, created = task_queue.enqueue(letter_task_id, request.get_data(), delay=task_delay(data),
+                                           priority=task_priority(data))
+        if not created:
+            # The same letter was submitted moments ago, and that task generates it
+            print(f"Task {letter_task_id} already exists, not enqueueing the letter again")
+            return jsonify({"status": "Task already enqueued", "task_name": name, "task_id": letter_task_id,
+                            "duplicate": True})
+        return jsonify({"status": "Task enqueued", "task_name": name, "task_id": letter_task_id, "duplicate": False})
 
-    # Add the task to the queue
-    response = client.create_task(parent=parent, task=task)
+    except Exception as e:
+        print(f"Error while enqueueing cover letter task: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
-    return jsonify({"status": "Task enqueued", "task_name": response.name})
+@app.route('/task-status/<task_id>', methods=['GET'])
+def task_status(task_id):
+    # task_id is the task_id /enqueue-cover-letter-task answered with
+    status = task_statuses.get(task_id)
+    if status is None:
+        return jsonify({"error": f"Unknown task {task_id}"}), 404
+    return jsonify(status)
+
+def rejected_response(rejection):
+    print(f"Rejected {request.path}: {rejection}")
+    return (jsonify({"error": str(rejection), "retry_after": rejection.retry_after}), rejection.status,
+            {"Retry-After": str(rejection.retry_after)})
+
+def admitted(view, slots=None):
+    # Run a view only once the admission controller gave it a slot, or slots() of them, and give them back when it
+    # returns
+    @wraps(view)
+    def admitted_view(*args, **kwargs):
+        try:
+            slot = admission.enter(slots() if slots else 1)
+        except AdmissionRejected as rejection:
+            return rejected_response(rejection)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            admission.leave(slot)
+    return admitted_view
 
 @app.route('/generate-cover-letter', methods=['POST'])
+@admitted
 def generate_cover_letter():
+    # Cloud Tasks deliveries also keep the task's status up to date
+    task = cloud_task_from_headers()
     try:
         print("Entering generate_cover_letter function...")
         data = get_data_from_request()
-        validate_input_data(data)
+        if task is not None:
+            task_attempt_started(task, CloudTasksQueue.backend)
+        result = generate_letter(data, get_idempotency_key(data))
+    except Exception as e:
+        print(f"Error while generating cover letter: {str(e)}")
+        if task is not None:
+            task_attempt_finished(task, None, error=e)
+        return jsonify({"error": str(e)}), 500
+    if task is not None:
+        task_attempt_finished(task, result)
+    return jsonify(result), 200
+
+def generate_letter(data, idempotency_key):
+    """
+    Generate a letter and email it. The work of /generate-cover-letter and of local task queue tasks.
+
+    Args:
+    - idempotency_key: Key of the letter's checkpoints, so a retry resumes where the previous attempt failed.
+
+    Returns:
+    - The result to answer with. Raises when the letter couldn't be generated or sent.
+    """
+    validate_input_data(data)
+
+    # A retried task resumes from the stages its previous attempts finished
+    checkpoint = Checkpoint(checkpoint_store, idempotency_key, data)
+    completed = completed_result(checkpoint)
+    if completed:
+        print("Task already completed, returning its result")
+        return completed
+
+    # Extract main user inputs
+    email = data.get("email")
+    name = data.get("name")
+    agree_promo = data.get("agreePromo", False)
+
+    # Hold a letter of the user's quota before anything is spent on it. A retried task reuses its reservation.
+    reservation = letter_quota.reserve(email, checkpoint.key or uuid.uuid4().hex, name=name,
+                                       agree_promo=agree_promo)
+
+    # Extract further user inputs for cover letter
+    role = data.get("role")
+    company = data.get("company")
+    intro_points = data.get("intro_points")
+    tailored_experience_points = data.get("tailored_experience_points")
+    company_alignment_url = data.get("company_alignment_points")
+    document_title = f"{role} at {company}"
+
+    try:
+        section_timings = {}
+        paragraphs = generate_paragraphs(name, role, company, intro_points, tailored_experience_points,
+                                         company_alignment_url, timings=section_timings, checkpoint=checkpoint)
+
+        docx_bytes = checkpoint.get("docx")
+        if docx_bytes is None:
+            docx_bytes = create_cover_letter(paragraphs, company, role, name=name,
+                                             style=data.get("letter_style", DEFAULT_LETTER_STYLE)).getvalue()
+            checkpoint.save("docx", docx_bytes)
+
+        # Use up the reserved letter only once the email was sent successfully
+        remaining_articles = deliver_letter(email, docx_bytes, document_title, reservation, agree_promo,
+                                            checkpoint)
+    except Exception:
+        letter_quota.release(reservation)
+        raise
+
+    result = {
+        "message": "Cover Letter successfully generated and sent!",
+        "remaining_articles": remaining_articles,
+        "section_timings": section_timings
+    }
+    checkpoint.save("completed", result)
+    return result
+
+def cloud_task_from_headers(headers=None):
+    # The Task a Cloud Tasks delivery is an attempt of, or None for a request that didn't come from a queue
+    if headers is None:
+        headers = request.headers
+    task_name = headers.get("X-AppEngine-TaskName") or headers.get("X-CloudTasks-TaskName")
+    if not task_name:
+        return None
+    attempt = headers.get("X-AppEngine-TaskRetryCount") or headers.get("X-CloudTasks-TaskRetryCount") or "0"
+    eta = headers.get("X-AppEngine-TaskETA") or headers.get("X-CloudTasks-TaskETA")
+    return Task(task_name, None, None, int(attempt), float(eta) if eta else None)
+
+def task_attempt_started(task, backend):
+    task_statuses.started(task.task_id, task.attempt)
+    # How long the attempt waited in the queue past the time it was due
+    if task.eta is not None:
+        task_queue_seconds.labels(backend=backend).observe(max(time.time() - task.eta, 0))
+
+def task_attempt_finished(task, result, error=None):
+    # For Cloud Tasks deliveries. Cloud Tasks decides on retries itself, the status only predicts them.
+    if error is None:
+        task_statuses.succeeded(task.task_id, result)
+    elif QUEUE_RETRY_POLICY.gives_up(task.attempt, 0):
+        task_statuses.failed(task.task_id, error)
+    else:
+        task_statuses.failed(task.task_id, error, retry_in=QUEUE_RETRY_POLICY.backoff(task.attempt))
 
-        # Extract main user inputs
+def run_letter_task(task):
+    # LocalTaskQueue handler. Like a Cloud Tasks delivery, it waits for an admission slot, and a rejection is
+    # retried after its Retry-After.
+    slot = admission.enter()
+    try:
+        task_attempt_started(task, LocalTaskQueue.backend)
+        return generate_letter(json.loads(task.body), f"task:{TASKS_QUEUE_NAME}:{task.task_id}")
+    finally:
+        admission.leave(slot)
+
+# Tasks go through Cloud Tasks, or offline through a queue of worker threads in this process
+task_statuses = TaskStatuses(checkpoint_store)
+TASK_QUEUE_BACKEND = os.environ.get("TASK_QUEUE_BACKEND",
+                                    "local" if OFFLINE and not CLOUD_TASKS_STUB_URL else "cloudtasks")
+if TASK_QUEUE_BACKEND == "local":
+    task_queue = LocalTaskQueue(run_letter_task, task_statuses,
+                                workers=int(os.environ.get("LOCAL_TASK_WORKERS", admission.limit)))
+    atexit.register(task_queue.close, float(os.environ.get("TASK_QUEUE_SHUTDOWN_TIMEOUT", 20)))
+else:
+    task_queue = CloudTasksQueue(get_tasks_client, TASKS_PROJECT_ID, TASKS_LOCATION, TASKS_QUEUE_NAME,
+                                 "/generate-cover-letter", task_statuses, stub_url=CLOUD_TASKS_STUB_URL)
+stats_collector("coverletter_task_queue", "Tasks of the local task queue",
+                lambda: {TASK_QUEUE_BACKEND: task_queue.stats()}, "backend", gauges=("ready", "scheduled", "running"))
+
+@app.route('/generate-cover-letter-stream', methods=['POST'])
+def generate_cover_letter_stream():
+    """
+    Same as /generate-cover-letter, but streams the sections to the client as Server-Sent Events while they are
+    generated.
+
+    Events:
+    - delta: {"section", "pass", "text"} with the next tokens of a section. "pass" is "draft" or "final".
+    - reset: {"section", "pass"} when a pass was retried and its streamed text should be discarded.
+    - section: {"section", "text"} with the cleaned paragraph once a section is finished.
+    - done: {"message", "remaining_articles", "section_timings"} once the letter has been emailed.
+    - error: {"error"} if generating or sending the letter failed.
+    """
+    # The letter is generated after this returns, so the slot is handed over to the generating thread
+    try:
+        slot = admission.enter()
+    except AdmissionRejected as rejection:
+        return rejected_response(rejection)
+
+    try:
+        print("Entering generate_cover_letter_stream function...")
+        data = get_data_from_request()
+        validate_input_data(data)
         email = data.get("email")
-        name = data.get("name")
         agree_promo = data.get("agreePromo", False)
+        checkpoint = Checkpoint(checkpoint_store, get_idempotency_key(data), data)
+        completed = completed_result(checkpoint)
+        if completed is None:
+            reservation = letter_quota.reserve(email, checkpoint.key or uuid.uuid4().hex, name=data.get("name"),
+                                               agree_promo=agree_promo)
+    except Exception as e:
+        admission.leave(slot)
+        print(f"Error while generating cover letter: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
-        user_doc_ref = db.collection('users').document(email)
-        user_doc = user_doc_ref.get()
-        num_letters = 0
-
-        # If user exists, get the current num_letters
-        if user_doc.exists:
-            num_letters = user_doc.to_dict().get('num_letters', 0)
+    events = queue.Queue()
+    if completed is not None:
+        # A replay of a finished letter only gets its result again
+        print("Task already completed, returning its result")
+        admission.leave(slot)
+        events.put(("done", completed))
+        events.put(None)
 
-            # Check the limit
-            if num_letters >= 5:
-                raise Exception("Your free cover letters have run out")
+    def on_event(event, payload):
+        events.put((event, payload))
 
-        # Extract further user inputs for cover letter
+    def generate():
+        name = data.get("name")
         role = data.get("role")
         company = data.get("company")
-        intro_points = data.get("intro_points")
-        tailored_experience_points = data.get("tailored_experience_points")
-        company_alignment_url = data.get("company_alignment_points")
-        document_title = f"{role} at {company}"
+        try:
+            section_timings = {}
+            paragraphs = generate_paragraphs(name, role, company, data.get("intro_points"),
+                                             data.get("tailored_experience_points"),
+                                             data.get("company_alignment_points"),
+                                             timings=section_timings, on_event=on_event, checkpoint=checkpoint)
+            output_stream = create_cover_letter(paragraphs, company, role, name=name,
+                                                style=data.get("letter_style", DEFAULT_LETTER_STYLE))
+            remaining_articles = deliver_letter(email, output_stream.getvalue(), f"{role} at {company}",
+                                                reservation, agree_promo, checkpoint)
+            result = {
+                "message": "Cover Letter successfully generated and sent!",
+                "remaining_articles": remaining_articles,
+                "section_timings": section_timings
+            }
+            checkpoint.save("completed", result)
+            on_event("done", result)
+        except Exception as e:
+            print(f"Error while generating cover letter: {str(e)}")
+            letter_quota.release(reservation)
+            on_event("error", {"error": str(e)})
+        finally:
+            admission.leave(slot)
+            events.put(None)
+
+    # The letter is finished and emailed even if the client disconnects half way
+    if completed is None:
+        threading.Thread(target=traced(generate), name="stream-generate", daemon=True).start()
+
+    def stream():
+        # Flush the headers right away so the client sees the connection open
+        yield ": connected\n\n"
+        while True:
+            try:
+                item = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if item is None:
+                return
+            event, payload = item
+            yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def batch_slots():
+    # One slot per letter the batch generates at once
+    data = request.get_json(silent=True)
+    targets = data.get("targets") if isinstance(data, dict) else None
+    return min(len(targets), BATCH_PARALLELISM) if isinstance(targets, list) and targets else 1
+
+@app.route('/generate-cover-letter-batch', methods=['POST'])
+@partial(admitted, slots=batch_slots)
+def generate_cover_letter_batch():
+    """
+    Generate letters for several roles at once and email them together as a zip.
 
-        paragraphs = generate_paragraphs(name, role, company, intro_points, tailored_experience_points,
-                                         company_alignment_url)
-        output_stream = create_cover_letter(paragraphs, company, role)
-        send_email_with_attachment(email, output_stream, document_title)
-
-        # Update Firestore AFTER email sent successfully
-        if user_doc.exists:
-            update_data = {"num_letters": firestore.Increment(1)}
-            current_agree_promo = user_doc.to_dict().get('agreePromo', False)
-            if current_agree_promo != agree_promo:
-                update_data['agreePromo'] = agree_promo
-            user_doc_ref.update(update_data)
-            remaining_articles = 5 - (num_letters + 1)
-        else:
-            user_doc_ref.set({
-                "num_letters": 1,
-                "agreePromo": agree_promo,
-                "name": name
-            })
-            remaining_articles = 4
-
-        return jsonify({
-            "message": "Cover Letter successfully generated and sent!",
-            "remaining_articles": remaining_articles
-        }), 200
+    The body has the user fields of /generate-cover-letter (name, email, intro_points, tailored_experience_points,
+    letter_style, agreePromo) and a "targets" list of {"role", "company", "company_alignment_points"}, where a
+    target can also set its own letter_style. The user's points are translated once, every distinct company page
+    is fetched once, and the whole batch has to fit in the user's quota. Letters that fail, or aren't done within
+    BATCH_DEADLINE_SECONDS, are left out of the email and aren't counted against the quota.
+    """
+    try:
+        print("Entering generate_cover_letter_batch function...")
+        data = get_data_from_request()
+        targets = validate_batch_data(data)
+
+        checkpoint = Checkpoint(checkpoint_store, get_idempotency_key(data), data)
+        completed = completed_result(checkpoint)
+        if completed:
+            print("Batch already completed, returning its result")
+            return jsonify(completed), 200
+
+        email = data.get("email")
+        agree_promo = data.get("agreePromo", False)
+        reservation = letter_quota.reserve(email, checkpoint.key or uuid.uuid4().hex, count=len(targets),
+                                           name=data.get("name"), agree_promo=agree_promo)
+        try:
+            letters, results = generate_batch_letters(data, targets, checkpoint)
+            if not letters:
+                raise RuntimeError("None of the cover letters could be generated")
+
+            # Only the letters in the email are used up, the rest of the reservation is given back on commit
+            delivered = reservation._replace(count=len(letters),
+                                             remaining=reservation.remaining + len(targets) - len(letters))
+            remaining_articles = deliver_email(build_batch_email(email, zip_letters(letters), len(letters)),
+                                               delivered, agree_promo, checkpoint)
+        except Exception:
+            letter_quota.release(reservation)
+            raise
+
+        result = {
+            "message": f"{len(letters)} of {len(targets)} cover letters successfully generated and sent!",
+            "remaining_articles": remaining_articles,
+            "letters": results
+        }
+        checkpoint.save("completed", result)
+        return jsonify(result), 200
 
     except Exception as e:
-        print(f"Error while generating cover letter: {str(e)}")
+        print(f"Error while generating cover letter batch: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def generate_batch_letters(data, targets, checkpoint):
+    """
+    Generate the letters of a batch, with the work they have in common done once.
+
+    Returns:
+    - The (document title, docx bytes) of every letter that was generated, in target order, and a result per
+      target with its status and section timings.
+    """
+    name = data.get("name")
+    started = time.monotonic()
+
+    def time_left():
+        return max(0.0, BATCH_DEADLINE_SECONDS - (time.monotonic() - started))
+
+    translated = checkpoint.get("translated")
+    if translated is None:
+        with span("translate"):
+            translated = translate_texts([data.get("intro_points"), data.get("tailored_experience_points")])
+        checkpoint.save("translated", translated)
+
+    # Fetch every distinct company page once, before the letters that use it start
+    urls = sorted({target.get("company_alignment_points") for target in targets} - {None, ""})
+    content_futures = {url: batch_executor.submit(traced(batch_company_content), url) for url in urls}
+    company_contents = {}
+    for url, future in content_futures.items():
+        try:
+            company_contents[url] = future.result(timeout=time_left())
+        except FutureTimeoutError:
+            print(f"Fetching {url} ran past the batch deadline, using the generic alignment paragraph")
+            company_contents[url] = "", ""
+
+    def generate_letter(index, target, timings):
+        role = target["role"]
+        company = target["company"]
+        url = target.get("company_alignment_points")
+        # Each letter resumes from its own checkpoint, tied to the batch's payload
+        letter_checkpoint = Checkpoint(checkpoint_store, checkpoint.key and f"{checkpoint.key}:{index}",
+                                       {"batch": checkpoint.payload_hash, "index": index})
+        docx_bytes = letter_checkpoint.get("docx")
+        if docx_bytes is None:
+            with span("batch_letter", index=index):
+                paragraphs = generate_paragraphs(name, role, company, data.get("intro_points"),
+                                                 data.get("tailored_experience_points"), url, concurrent=False,
+                                                 timings=timings, checkpoint=letter_checkpoint,
+                                                 translated=translated, company_content=company_contents.get(url))
+                style = target.get("letter_style", data.get("letter_style", DEFAULT_LETTER_STYLE))
+                docx_bytes = create_cover_letter(paragraphs, company, role, name=name, style=style).getvalue()
+            letter_checkpoint.save("docx", docx_bytes)
+        return docx_bytes
+
+    timings = [{} for _ in targets]
+    futures = [batch_executor.submit(traced(generate_letter), index, target, timings[index])
+               for index, target in enumerate(targets)]
+
+    letters, results = [], []
+    for target, future, section_timings in zip(targets, futures, timings):
+        result = {"role": target["role"], "company": target["company"], "section_timings": section_timings}
+        try:
+            letters.append((f"{target['role']} at {target['company']}", future.result(timeout=time_left())))
+            result["status"] = "ok"
+        except FutureTimeoutError:
+            # Letters that haven't started yet never will. Running ones finish in the background, unused.
+            future.cancel()
+            print(f"The {target['role']} at {target['company']} letter ran past the batch deadline")
+            result.update(status="timed_out", error=f"Not finished within {BATCH_DEADLINE_SECONDS:g} seconds")
+        except Exception as e:
+            print(f"Error while generating the {target['role']} at {target['company']} letter: {e}")
+            result.update(status="failed", error=str(e))
+        results.append(result)
+    return letters, results
+
+def batch_company_content(url):
+    # A page that can't be fetched gets the generic alignment paragraph, like a single letter would
+    try:
+        return get_company_content(url)
+    except Exception as e:
+        print(f"Failed to fetch content from URL due to: {e}")
+        return "", ""
+
+def zip_letters(letters):
+    # One .docx per letter. They are zip archives already, so they are stored without compressing them again.
+    output_stream = BytesIO()
+    filenames = set()
+    with zipfile.ZipFile(output_stream, "w", zipfile.ZIP_STORED) as archive:
+        for document_title, docx_bytes in letters:
+            base_name = re.sub(r'[\\/:*?"<>|]+', "-", document_title).strip() or "Cover letter"
+            filename, number = f"{base_name}.docx", 1
+            while filename in filenames:
+                number += 1
+                filename = f"{base_name} ({number}).docx"
+            filenames.add(filename)
+            archive.writestr(filename, docx_bytes)
+    return output_stream.getvalue()
+
+def get_idempotency_key(data, headers=None):
+    # Cloud Tasks names every task, and keeps the name across retries of the same task
+    if headers is None:
+        headers = request.headers
+    task_name = (headers.get("X-AppEngine-TaskName") or headers.get("X-CloudTasks-TaskName"))
+    if task_name:
+        return f"task:{headers.get('X-AppEngine-QueueName', '')}:{task_name}"
+    idempotency_key = headers.get("Idempotency-Key") or data.get("idempotency_key")
+    if idempotency_key:
+        return f"key:{idempotency_key}"
+    return None
+
 def get_data_from_request():
     data = request.get_json()
     if not data:
@@ -521,69 +1550,146 @@ def validate_input_data(data):
     missing_fields = check_missing_fields(data, required_fields)
     if missing_fields:
         raise ValueError(f"Missing required fields: {', '.join(missing_fields)}")
+    letter_style = data.get("letter_style", DEFAULT_LETTER_STYLE)
+    if letter_style not in letter_styles():
+        raise ValueError(f"Unknown letter style: {letter_style}. Choose one of: {', '.join(letter_styles())}")
+
+def validate_batch_data(data):
+    # Every target, together with the user fields, has to make a valid single letter request
+    targets = data.get("targets")
+    if not isinstance(targets, list) or not targets:
+        raise ValueError("Missing required fields: targets")
+    if len(targets) > BATCH_MAX_TARGETS:
+        raise ValueError(f"A batch can have at most {BATCH_MAX_TARGETS} targets, got {len(targets)}")
+    for target in targets:
+        if not isinstance(target, dict):
+            raise ValueError("Every target must be an object with a role, company and company_alignment_points")
+        validate_input_data(dict(data, **target))
+    return targets
+
+def generate_paragraphs(name, role, company, intro_points, tailored_experience_points, company_alignment_url,
+                        concurrent=None, timings=None, on_event=None, checkpoint=None, translated=None,
+                        company_content=None):
+    """
+    Generate the three cover letter sections.
 
-def generate_paragraphs(name, role, company, intro_points, tailored_experience_points, company_alignment_url):
-    intro_paragraph = rewrite_intro(name, role, company, intro_points)
-    tailored_experience_paragraph = rewrite_tailored_experience(role, company, tailored_experience_points)
-    company_alignment_paragraph = rewrite_company_alignment(company_alignment_url, name, company)
-    return {
-       "intro": intro_paragraph,
-       "tailored_experience": tailored_experience_paragraph,
-        "company_alignment": company_alignment_paragraph
+    Args:
+    - concurrent: Fan the sections out on the section executor. Defaults to GENERATE_SECTIONS_CONCURRENTLY.
+    - timings: Optional dict that is filled with the duration and status of each section.
+    - on_event: Optional callback(event, payload) that receives "delta" and "reset" events while the sections
+      stream in and a "section" event with each finished paragraph.
+    - checkpoint: Optional Checkpoint. The translation and every finished section are saved to it, and the ones
+      it already holds are not generated again.
+    - translated: The intro and tailored experience points already translated, e.g. once for a whole batch.
+    - company_content: The (text_content, relevant_content) of company_alignment_url when it was already fetched.
+
+    Returns:
+    - A dict with the "intro", "tailored_experience" and "company_alignment" paragraphs.
+    """
+    if concurrent is None:
+        concurrent = GENERATE_SECTIONS_CONCURRENTLY
+    if timings is None:
+        timings = {}
+
+    if checkpoint is None:
+        checkpoint = Checkpoint(None, None, None)
+
+    # Translate all user inputs in one DeepL call before the sections fan out
+    if translated is None:
+        translated = checkpoint.get("translated")
+    if translated is None:
+        translated = timed_section(
+            "translate", lambda: translate_texts([intro_points, tailored_experience_points]), timings)()
+        checkpoint.save("translated", translated)
+    translated_intro_points, translated_tailored_experience_points = translated
+
+    def section_delta(section_name):
+        if on_event is None:
+            return None
+
+        def on_delta(pass_name, text):
+            if text is None:
+                on_event("reset", {"section": section_name, "pass": pass_name})
+            else:
+                on_event("delta", {"section": section_name, "pass": pass_name, "text": text})
+        return on_delta
+
+    def finished(section_name, paragraph):
+        checkpoint.save(section_name, paragraph)
+        if on_event is not None:
+            on_event("section", {"section": section_name, "text": paragraph})
+        return paragraph
+
+    sections = {
+        "intro": lambda: finished("intro", rewrite_intro(
+            name, role, company, translated_intro_points, on_delta=section_delta("intro"))),
+        "tailored_experience": lambda: finished("tailored_experience", rewrite_tailored_experience(
+            role, company, translated_tailored_experience_points, on_delta=section_delta("tailored_experience"))),
+        "company_alignment": lambda: finished("company_alignment", rewrite_company_alignment(
+            company_alignment_url, name, company, on_delta=section_delta("company_alignment"),
+            company_content=company_content)),
     }
 
-def create_cover_letter(paragraphs, company, role):
-    intro_paragraph = paragraphs["intro"]
-    tailored_experience_paragraph = paragraphs["tailored_experience"]
-    company_alignment_paragraph = paragraphs["company_alignment"]
-
-    document_title = f"Cover Letter for {role} at {company}"
-    doc = Document()
-
-    print("Initiated new Document")
-
-    # Colored horizontal rule at the top
-    section = doc.sections[0]
-    section.top_margin = Pt(0.5)
-    section.start_type
-    paragraph = doc.add_paragraph()
-    run = paragraph.add_run()
-
-    # Add FULL NAME in 36pt font
-    full_name_paragraph = doc.add_paragraph("[FULL NAME]")
-    full_name_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    run = full_name_paragraph.runs[0]
-    run.font.size = Pt(36)
-
-    # Add CITY, STATE, ZIP in normal font
-    city_paragraph = doc.add_paragraph("[CITY STATE ZIP]")
-    city_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-
-    # Add PHONE | EMAIL in normal font
-    contact_paragraph = doc.add_paragraph("[PHONE] | [EMAIL]")
-    contact_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-
-    # One newline
-    # doc.add_paragraph("\n")
-
-    # Add the paragraphs to the .docx document
-    doc.add_paragraph(f"Dear Hiring Manager at {company},")
-    # doc.add_paragraph("\n")
-    doc.add_paragraph(intro_paragraph)
-    # doc.add_paragraph("\n")
-    doc.add_paragraph(tailored_experience_paragraph)
-    # doc.add_paragraph("\n")
-    doc.add_paragraph(company_alignment_paragraph)
-    doc.add_paragraph(f"Sincerely,\n[FULL NAME]")
-
-    # Save the .docx document
-    file_name = f"{document_title}.docx"
-
-    # Create the .docx document in memory using io.BytesIO
-    output_stream = BytesIO()
-    doc.save(output_stream)
-    output_stream.seek(0)  # Reset the stream's position to the start
+    # Sections finished by an earlier attempt come from the checkpoint
+    resumed = {section_name: checkpoint.get(section_name) for section_name in sections
+               if checkpoint.get(section_name) is not None}
+    for section_name in resumed:
+        del sections[section_name]
+        timings[section_name] = {"status": "checkpointed"}
+        if on_event is not None:
+            on_event("section", {"section": section_name, "text": resumed[section_name]})
+
+    if concurrent:
+        paragraphs = run_sections_concurrently(sections, timings)
+    else:
+        paragraphs = {}
+        for section_name, section_function in sections.items():
+            paragraphs[section_name] = timed_section(section_name, section_function, timings)()
+    paragraphs.update(resumed)
+
+    print("Section timings:", timings)
+    return paragraphs
+
+def timed_section(section_name, section_function, timings):
+    # Wrap a section so its duration and outcome end up in the timings report
+    def run():
+        start = time.perf_counter()
+        timings[section_name] = {"status": "running"}
+        try:
+            with span(section_name):
+                result = section_function()
+        except Exception:
+            timings[section_name] = {"status": "failed", "seconds": round(time.perf_counter() - start, 3)}
+            raise
+        timings[section_name] = {"status": "ok", "seconds": round(time.perf_counter() - start, 3)}
+        return result
+    return run
+
+def run_sections_concurrently(sections, timings):
+    started = time.monotonic()
+    futures = {
+        section_name: section_executor.submit(traced(timed_section(section_name, section_function, timings)))
+        for section_name, section_function in sections.items()
+    }
 
+    paragraphs = {}
+    for section_name, future in futures.items():
+        deadline = SECTION_DEADLINES.get(section_name, 60)
+        remaining = max(0.0, deadline - (time.monotonic() - started))
+        try:
+            paragraphs[section_name] = future.result(timeout=remaining)
+        except FutureTimeoutError:
+            timings[section_name] = {"status": "timed_out", "seconds": round(time.monotonic() - started, 3)}
+            for pending in futures.values():
+                pending.cancel()
+            raise TimeoutError(f"Generating the {section_name} section took longer than {deadline:g} seconds")
+    return paragraphs
+
+def create_cover_letter(paragraphs, company, role, name=None, style=DEFAULT_LETTER_STYLE):
+    # Fill the cached template for the chosen letter style and return the .docx document as a BytesIO
+    with span("render", style=style):
+        output_stream = render_cover_letter(paragraphs, company, role, name=name, style=style)
+    print(f"Rendered {style} cover letter")
     return output_stream
 
 # def store_user_data_in_firestore(name, email, agree_promo):
@@ -602,44 +1708,81 @@ def create_cover_letter(paragraphs, company, role):
 #         print(f"Stored user data in Firestore with document ID: {doc_ref.id}. User did not agree to promotional emails.")
 
 
-def send_email_with_attachment(email, output_stream, document_title):
+def build_letter_email(email, file_data, document_title):
     # Construct the message
     subject = "Your Generated Cover Letter"
     from_email = "noreply@mg.myaiguy.net"
 
-    print(f"Preparing to send email to {email}")
+    # You can enhance the text with more meaningful content or even use HTML.
+    return EmailMessage(email, subject, "Please find your generated cover letter attached.",
+                        [(f"{document_title}.docx", file_data, DOCX_MIME_TYPE)], from_email)
 
-    # Convert the BytesIO stream to bytes
-    file_data = output_stream.getvalue()
+def build_batch_email(email, zip_data, letter_count):
+    return EmailMessage(email, "Your Generated Cover Letters",
+                        f"Please find your {letter_count} generated cover letters attached.",
+                        [("Cover letters.zip", zip_data, ZIP_MIME_TYPE)], "noreply@mg.myaiguy.net")
 
-    # Prepare the email data
-    email_data = {
-        "from": from_email,
-        "to": email,
-        "subject": subject,
-        "text": "Please find your generated cover letter attached.",
-        # You can enhance this with more meaningful text or even use HTML.
-    }
+def send_email(message):
+    print(f"Preparing to send email to {message.to}")
 
-    # Send the email using Mailgun's API
-    response = requests.post(
-        MAILGUN_API_ENDPOINT,
-        auth=("api", MAILGUN_API_KEY),
-        files=[("attachment", (f"{document_title}.docx", file_data,
-                               'application/vnd.openxmlformats-officedocument.wordprocessingml.document'))],
-        data=email_data
-    )
+    # Send the email right away, raises a DeliveryError if Mailgun doesn't accept it
+    with span("email"):
+        response = mail_transport.send(message)
+    print("Email sent successfully!")
+    return response
 
-    # Check for successful response
-    if response.status_code == 200:
-        print("Email sent successfully!")
-    else:
-        error_message = f"Error occurred while sending the email: {response.text}"
-        print(error_message)
-        raise Exception(error_message)
+def send_email_with_attachment(email, output_stream, document_title):
+    return send_email(build_letter_email(email, output_stream.getvalue(), document_title))
+
+def deliver_letter(email, docx_bytes, document_title, reservation, agree_promo, checkpoint):
+    """
+    Email the letter and use up its reserved letter.
 
-    # Error handling can be enhanced depending on requirements
-    return response.json()
+    Returns:
+    - The number of letters the user has left.
+    """
+    return deliver_email(build_letter_email(email, docx_bytes, document_title), reservation, agree_promo,
+                         checkpoint)
+
+def completed_result(checkpoint):
+    # The result of a finished task, unless the outbox gave up on its email after the result was saved
+    if checkpoint.get("delivery_failed"):
+        return None
+    return checkpoint.get("completed")
+
+def deliver_email(message, reservation, agree_promo, checkpoint):
+    """
+    Email letters and use up their reservation.
+
+    With the outbox, the email is queued and the letters are only used up once Mailgun accepted it, or released if
+    it never does. Otherwise the email is sent before returning.
+
+    Returns:
+    - The number of letters the user has left.
+    """
+    if checkpoint.get("email_sent"):
+        return letter_quota.commit(reservation, agree_promo=agree_promo)
+
+    if not USE_EMAIL_OUTBOX:
+        send_email(message)
+        checkpoint.save("email_sent", True)
+        return letter_quota.commit(reservation, agree_promo=agree_promo)
+
+    def on_delivered(response):
+        checkpoint.save("email_sent", True)
+        letter_quota.commit(reservation, agree_promo=agree_promo)
+
+    def on_failed(error):
+        letter_quota.release(reservation)
+        # Let a resubmission with the same idempotency key send the letter again. This can run before the request
+        # saved its completed result, so it is a stage of its own that the result never overwrites.
+        checkpoint.save("delivery_failed", str(error))
+
+    if checkpoint.get("delivery_failed"):
+        checkpoint.save("delivery_failed", None)
+    print(f"Queueing email to {message.to}")
+    email_outbox.submit(message, on_delivered=on_delivered, on_failed=on_failed)
+    return reservation.remaining
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,402 @@
+"""
+Async serving mode.
+
+POST /generate-cover-letter runs on the event loop with non-blocking clients for OpenAI, DeepL and the company
+pages, so one worker process multiplexes many letters that are waiting on upstream I/O. spaCy scoring goes to a
+small executor, and the calls that only have blocking clients (Firestore for the quota and checkpoints, disk
+caches, Selenium, Mailgun without the outbox) go to a thread pool. Every other route is served by the Flask app
+on threads of its own.
+
+Run with:
+
+    gunicorn -k uvicorn.workers.UvicornWorker -b :$PORT --timeout 150 asgi_app:application
+"""
+import asyncio
+import functools
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import openai
+from a2wsgi import WSGIMiddleware
+from werkzeug.datastructures import Headers
+
+import app
+from admission import AdmissionRejected
+from caching import AsyncSingleFlight
+from checkpoints import Checkpoint
+from html_extract import ParagraphExtractor
+from http_client import AsyncHttpClient
+from metrics import http_requests, http_request_seconds
+from openai_scheduler import PRIORITY_DRAFT, estimate_tokens
+from tracing import span, traced, trace_id_from_header
+
+# Threads for the work that only has blocking clients
+blocking_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("ASYNC_BLOCKING_THREADS", 32)),
+                                       thread_name_prefix="async-blocking")
+# spaCy scoring is CPU bound, more threads than cores only add contention
+nlp_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("ASYNC_NLP_THREADS", 2)),
+                                  thread_name_prefix="async-nlp")
+# Same upstream settings as the blocking client, counted in the same /http-stats
+async_http_client = AsyncHttpClient(app.http_client.upstreams, app.http_client.stats_by_upstream)
+inflight_completions = AsyncSingleFlight()
+# The Flask routes, run on a pool of threads
+wsgi_application = WSGIMiddleware(app.app, workers=int(os.environ.get("ASYNC_WSGI_THREADS", 10)))
+
+
+async def run_blocking(function, *args, executor=None, **kwargs):
+    # Run a blocking call on a thread, keeping the caller's trace
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor or blocking_executor,
+                                      functools.partial(traced(function), *args, **kwargs))
+
+
+async def chat_completion_async(model, messages, on_delta=None, priority=PRIORITY_DRAFT):
+    # Same as app.chat_completion, with the completion cache and scheduler shared with the blocking path
+    streamed_attempts = []
+
+    async def request_function():
+        app.http_client.stats_by_upstream["openai"].request_sent()
+        with span("openai", model=model, stream=on_delta is not None):
+            if on_delta is None:
+                response = await openai.ChatCompletion.acreate(model=model, messages=messages,
+                                                               request_timeout=app.http_client.timeout("openai"))
+            else:
+                if streamed_attempts:
+                    on_delta(None)
+                streamed_attempts.append(True)
+                response = await stream_chat_completion_async(model, messages, on_delta)
+        app.record_token_usage(model, messages, response)
+        return response
+
+    async def fetch():
+        response = await app.openai_scheduler.run_async(request_function, estimated_tokens=estimate_tokens(messages),
+                                                        priority=priority, max_attempts=3, base_delay=1)
+        app.completion_cache.set(cache_key, response)
+        return response
+
+    cache_key = app.completion_cache_key(model, messages)
+    response = app.completion_cache.get(cache_key)
+    if response is not None:
+        print("Completion cache hit")
+    else:
+        response = await inflight_completions.do(cache_key, fetch)
+    if on_delta is not None and not streamed_attempts:
+        on_delta(response['choices'][0]['message']['content'])
+    return response
+
+
+async def stream_chat_completion_async(model, messages, on_delta):
+    chunks = []
+    async for chunk in await openai.ChatCompletion.acreate(model=model, messages=messages, stream=True,
+                                                           request_timeout=app.http_client.timeout("openai")):
+        delta = chunk['choices'][0]['delta'].get('content')
+        if delta:
+            chunks.append(delta)
+            on_delta(delta)
+    return {"choices": [{"message": {"role": "assistant", "content": "".join(chunks)}}]}
+
+
+async def translate_texts_async(texts, target_language="EN"):
+    # Same as app.translate_texts, sharing its translation cache
+    translated, pending = await run_blocking(app.cached_translations, texts, target_language)
+    if not pending:
+        return translated
+
+    pending_texts = list(pending)
+    try:
+        with span("deepl", texts=len(pending_texts)):
+            response = await async_http_client.post("deepl", app.DEEPL_API_ENDPOINT, headers=app.deepl_headers(),
+                                                    json=app.deepl_payload(pending_texts, target_language))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"DeepL request failed, keeping the untranslated texts: {e}")
+        return translated
+    print("DeepL API Status Code:", response.status, "Texts:", len(pending_texts))
+
+    try:
+        translations = (await response.json(content_type=None))['translations']
+    except Exception as e:
+        print(f"Failed to parse JSON: {e}")
+        return translated
+    return app.apply_translations(translated, pending, translations, target_language)
+
+
+async def fetch_web_page_async(url, etag=None, last_modified=None):
+    # Same as app.fetch_web_page. Chunks are parsed on the loop as they arrive, the Selenium fallback runs on a thread.
+    try:
+        with span("scrape_requests") as scrape:
+            response = await async_http_client.get("scrape", url, headers=app.scrape_headers(etag, last_modified),
+                                                   stream=True)
+            async with response:
+                print("Response code for website URL:", response.status)
+                if response.status == 304:
+                    return {"content": None, "paragraphs": None, "etag": etag, "last_modified": last_modified,
+                            "not_modified": True}
+                response.raise_for_status()
+                extractor = ParagraphExtractor(response.get_encoding() if response.charset else None)
+                async for chunk in response.content.iter_chunked(app.PAGE_CHUNK_BYTES):
+                    extractor.feed(chunk)
+                    if extractor.done or extractor.bytes_read >= app.PAGE_MAX_BYTES:
+                        break
+            scrape.set(bytes_read=extractor.bytes_read)
+            paragraphs = extractor.result()
+            if paragraphs is not None:
+                return {"content": " ".join(paragraphs), "paragraphs": paragraphs,
+                        "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified"),
+                        "not_modified": False}
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error fetching the page with aiohttp: {e}")
+
+    return await run_blocking(app.fetch_with_browser, url)
+
+
+async def get_company_content_async(url):
+    entry, fresh = await run_blocking(app.page_cache.lookup, url)
+    if entry is not None and fresh:
+        print("Company page cache hit:", url)
+        return " ".join(entry["paragraphs"]), entry["relevant_content"]
+
+    page = await fetch_web_page_async(url,
+                                      etag=entry.get("etag") if entry else None,
+                                      last_modified=entry.get("last_modified") if entry else None)
+    return await run_blocking(app.company_content_from_page, url, entry, page, executor=nlp_executor)
+
+
+async def perform_step_async(step, on_delta=None):
+    if isinstance(step, app.CompanyContentStep):
+        return await get_company_content_async(step.url)
+    return await chat_completion_async(step.model, step.messages, on_delta=app.pass_callback(on_delta, step.pass_name),
+                                       priority=step.priority)
+
+
+async def run_section_async(steps, on_delta=None):
+    # Drives the same section writers as app.run_section
+    result, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result, error = None, None
+        try:
+            result = await perform_step_async(step, on_delta)
+        except Exception as e:
+            error = e
+
+
+async def timed_section_async(section_name, coroutine, timings):
+    start = time.perf_counter()
+    timings[section_name] = {"status": "running"}
+    try:
+        with span(section_name):
+            result = await coroutine
+    except Exception:
+        timings[section_name] = {"status": "failed", "seconds": round(time.perf_counter() - start, 3)}
+        raise
+    timings[section_name] = {"status": "ok", "seconds": round(time.perf_counter() - start, 3)}
+    return result
+
+
+async def run_sections_async(sections, timings):
+    # Same deadlines as app.run_sections_concurrently, counted from the fan-out
+    started = time.monotonic()
+    tasks = {section_name: asyncio.ensure_future(timed_section_async(section_name, section_function(), timings))
+             for section_name, section_function in sections.items()}
+    try:
+        paragraphs = {}
+        for section_name, task in tasks.items():
+            deadline = app.SECTION_DEADLINES.get(section_name, 60)
+            remaining = max(0.0, deadline - (time.monotonic() - started))
+            try:
+                paragraphs[section_name] = await asyncio.wait_for(asyncio.shield(task), remaining)
+            except asyncio.TimeoutError:
+                timings[section_name] = {"status": "timed_out", "seconds": round(time.monotonic() - started, 3)}
+                raise TimeoutError(f"Generating the {section_name} section took longer than {deadline:g} seconds")
+        return paragraphs
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+
+async def generate_paragraphs_async(name, role, company, intro_points, tailored_experience_points,
+                                    company_alignment_url, timings, checkpoint):
+    # Same as app.generate_paragraphs, with the sections always generated concurrently
+    translated = checkpoint.get("translated")
+    if translated is None:
+        translated = await timed_section_async(
+            "translate", translate_texts_async([intro_points, tailored_experience_points]), timings)
+        await run_blocking(checkpoint.save, "translated", translated)
+    translated_intro_points, translated_tailored_experience_points = translated
+
+    async def finished(section_name, steps):
+        paragraph = await run_section_async(steps)
+        await run_blocking(checkpoint.save, section_name, paragraph)
+        return paragraph
+
+    sections = {
+        "intro": lambda: finished("intro", app.intro_steps(name, role, company, translated_intro_points)),
+        "tailored_experience": lambda: finished("tailored_experience", app.tailored_experience_steps(
+            role, company, translated_tailored_experience_points)),
+        "company_alignment": lambda: finished("company_alignment", app.company_alignment_steps(
+            company_alignment_url, name, company)),
+    }
+
+    resumed = {section_name: checkpoint.get(section_name) for section_name in sections
+               if checkpoint.get(section_name) is not None}
+    for section_name in resumed:
+        del sections[section_name]
+        timings[section_name] = {"status": "checkpointed"}
+
+    paragraphs = await run_sections_async(sections, timings)
+    paragraphs.update(resumed)
+    print("Section timings:", timings)
+    return paragraphs
+
+
+async def generate_cover_letter(data, headers):
+    """
+    The async counterpart of app.generate_cover_letter.
+
+    Returns:
+    - The status code and the JSON response body.
+    """
+    try:
+        print("Entering generate_cover_letter function...")
+        if not data:
+            raise ValueError("No data received")
+        app.validate_input_data(data)
+
+        checkpoint = await run_blocking(Checkpoint, app.checkpoint_store, app.get_idempotency_key(data, headers), data)
+        completed = app.completed_result(checkpoint)
+        if completed:
+            print("Task already completed, returning its result")
+            return 200, completed
+
+        email = data.get("email")
+        name = data.get("name")
+        agree_promo = data.get("agreePromo", False)
+        reservation = await run_blocking(app.letter_quota.reserve, email, checkpoint.key or uuid.uuid4().hex,
+                                         name=name, agree_promo=agree_promo)
+
+        role = data.get("role")
+        company = data.get("company")
+        document_title = f"{role} at {company}"
+
+        try:
+            section_timings = {}
+            paragraphs = await generate_paragraphs_async(
+                name, role, company, data.get("intro_points"), data.get("tailored_experience_points"),
+                data.get("company_alignment_points"), section_timings, checkpoint)
+
+            docx_bytes = checkpoint.get("docx")
+            if docx_bytes is None:
+                style = data.get("letter_style", app.DEFAULT_LETTER_STYLE)
+                output_stream = await run_blocking(app.create_cover_letter, paragraphs, company, role, name=name,
+                                                   style=style)
+                docx_bytes = output_stream.getvalue()
+                await run_blocking(checkpoint.save, "docx", docx_bytes)
+
+            remaining_articles = await run_blocking(app.deliver_letter, email, docx_bytes, document_title,
+                                                    reservation, agree_promo, checkpoint)
+        except BaseException:
+            await run_blocking(app.letter_quota.release, reservation)
+            raise
+
+        result = {
+            "message": "Cover Letter successfully generated and sent!",
+            "remaining_articles": remaining_articles,
+            "section_timings": section_timings
+        }
+        await run_blocking(checkpoint.save, "completed", result)
+        return 200, result
+
+    except Exception as e:
+        print(f"Error while generating cover letter: {str(e)}")
+        return 500, {"error": str(e)}
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+def response_headers(request_headers):
+    headers = [(b"content-type", b"application/json")]
+    origin = request_headers.get("Origin")
+    if origin in app.CORS_ORIGINS:
+        headers += [(b"access-control-allow-origin", origin.encode("latin-1")), (b"vary", b"Origin")]
+    if app.OFFLINE:
+        headers.append((b"x-worker-id", str(os.getpid()).encode("ascii")))
+    return headers
+
+
+async def generate_cover_letter_endpoint(scope, receive, send):
+    started = time.perf_counter()
+    headers = Headers([(key.decode("latin-1"), value.decode("latin-1")) for key, value in scope["headers"]])
+    openai.aiosession.set(async_http_client.session("openai"))
+    extra_headers = []
+    with span("request", trace_id=trace_id_from_header(headers.get("X-Cloud-Trace-Context")), record=False,
+              endpoint="generate_cover_letter", method="POST", serving="async"):
+        try:
+            slot = await app.admission.enter_async()
+        except AdmissionRejected as rejection:
+            print(f"Rejected /generate-cover-letter: {rejection}")
+            status, result = rejection.status, {"error": str(rejection), "retry_after": rejection.retry_after}
+            extra_headers.append((b"retry-after", str(rejection.retry_after).encode("ascii")))
+        else:
+            try:
+                try:
+                    data = json.loads(await read_body(receive) or b"null")
+                except ValueError:
+                    data = None
+                # Cloud Tasks deliveries keep the task's status up to date, like in app.generate_cover_letter
+                task = app.cloud_task_from_headers(headers)
+                if task is not None:
+                    await run_blocking(app.task_attempt_started, task, app.CloudTasksQueue.backend)
+                status, result = await generate_cover_letter(data, headers)
+                if task is not None:
+                    await run_blocking(app.task_attempt_finished, task, result,
+                                       error=result["error"] if status != 200 else None)
+            finally:
+                app.admission.leave(slot)
+
+    body = json.dumps(result).encode("utf-8")
+    extra_headers.append((b"content-length", str(len(body)).encode("ascii")))
+    await send({"type": "http.response.start", "status": status,
+                "headers": response_headers(headers) + extra_headers})
+    await send({"type": "http.response.body", "body": body})
+    http_requests.labels(endpoint="generate_cover_letter", method="POST", status=status).inc()
+    http_request_seconds.labels(endpoint="generate_cover_letter").observe(time.perf_counter() - started)
+
+
+ASYNC_ROUTES = {
+    ("POST", "/generate-cover-letter"): generate_cover_letter_endpoint,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_http_client.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] == "http":
+        route = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+        if route is not None:
+            return await route(scope, receive, send)
+    return await wsgi_application(scope, receive, send)
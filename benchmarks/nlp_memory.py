@@ -0,0 +1,176 @@
+"""
+Memory of loading spaCy in every gunicorn worker, compared with the workers sharing the NLP pool.
+
+For each layout, starts --workers worker processes that score the sentences of the saved pages once, then adds up
+the memory of every process involved. PSS counts a page shared by several processes in fractions, so the pool
+processes forked from the server aren't charged twice for the model they share. The workers only import what
+differs between the layouts; the rest of the app costs the same in both.
+
+Run from the repository root, on Linux:
+
+    python -m benchmarks.nlp_memory --workers 4 --pool-processes 1
+    python -m benchmarks.nlp_memory --model path/to/model --python path/to/python
+"""
+import argparse
+import json
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from html_extract import extract_paragraphs  # noqa: E402
+from nlp_pool import NLPClient, score_texts  # noqa: E402
+
+
+def fixture_sentences():
+    pages_dir = os.path.join(BENCHMARK_DIR, "fixtures", "pages")
+    sentences = []
+    for filename in sorted(os.listdir(pages_dir)):
+        with open(os.path.join(pages_dir, filename), "r", encoding="utf-8") as page_file:
+            paragraphs = extract_paragraphs(page_file.read()) or []
+        sentences.extend(sentence.strip() for sentence in " ".join(paragraphs).split(".") if sentence.strip())
+    return sentences
+
+
+def memory_kib(pid):
+    # (PSS, RSS) of a process. Kernels without smaps_rollup only report RSS, which counts shared pages in full.
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as smaps:
+            fields = dict(line.split(":", 1) for line in smaps if line.startswith(("Pss:", "Rss:")))
+        return int(fields["Pss"].split()[0]), int(fields["Rss"].split()[0])
+    except (OSError, KeyError):
+        with open(f"/proc/{pid}/status", "r") as status:
+            rss = next(int(line.split()[1]) for line in status if line.startswith("VmRSS:"))
+        return rss, rss
+
+
+def children(pid):
+    found = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as stat:
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if parent == pid:
+            found.append(int(entry))
+    return found
+
+
+def start_worker(python, mode, model, texts, env):
+    worker = subprocess.Popen([python, "-m", "benchmarks.nlp_memory", "--child", mode, "--model", model],
+                              cwd=REPO_DIR, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    worker.stdin.write(json.dumps(texts) + "\n")
+    worker.stdin.flush()
+    if worker.stdout.readline().strip() != "ready":
+        worker.kill()
+        raise RuntimeError(f"A {mode} worker failed to score the sample, see its output above")
+    return worker
+
+
+def stop(processes):
+    for process in processes:
+        if process.stdin:
+            process.stdin.close()
+        else:
+            process.terminate()
+    for process in processes:
+        process.wait(timeout=30)
+
+
+def layout_report(name, roles):
+    # roles maps a role name to its pids
+    report = {"layout": name, "processes": {}, "pss_mib": 0.0, "rss_mib": 0.0}
+    for role, pids in roles.items():
+        pss, rss = (sum(values) / 1024 for values in zip(*(memory_kib(pid) for pid in pids)))
+        report["processes"][role] = {"count": len(pids), "pss_mib": round(pss, 1), "rss_mib": round(rss, 1)}
+        report["pss_mib"] += pss
+        report["rss_mib"] += rss
+    report["pss_mib"] = round(report["pss_mib"], 1)
+    report["rss_mib"] = round(report["rss_mib"], 1)
+    return report
+
+
+def measure_per_worker(args, texts):
+    workers = [start_worker(args.python, "local", args.model, texts, dict(os.environ)) for _ in range(args.workers)]
+    try:
+        return layout_report(f"model in each of {args.workers} workers",
+                             {"worker": [worker.pid for worker in workers]})
+    finally:
+        stop(workers)
+
+
+def measure_pooled(args, texts):
+    address = os.path.join(tempfile.gettempdir(), f"nlp-memory-{os.getpid()}.sock")
+    env = dict(os.environ, NLP_POOL_ADDRESS=address, NLP_POOL_AUTHKEY=secrets.token_hex(16))
+    server = subprocess.Popen([args.python, "-m", "nlp_pool", "--model", args.model,
+                               "--processes", str(args.pool_processes)], cwd=REPO_DIR, env=env)
+    workers = []
+    try:
+        NLPClient(address, bytes.fromhex(env["NLP_POOL_AUTHKEY"])).wait_ready(120)
+        workers = [start_worker(args.python, "client", args.model, texts, env) for _ in range(args.workers)]
+        return layout_report(f"{args.workers} workers sharing a pool of {args.pool_processes}", {
+            "pool server": [server.pid],
+            "pool process": children(server.pid),
+            "worker": [worker.pid for worker in workers],
+        })
+    finally:
+        stop(workers)
+        stop([server])
+
+
+def run_child(mode, model):
+    # A stand-in web worker: score the sample once, then stay alive until the parent closes stdin
+    texts = json.loads(sys.stdin.readline())
+    if mode == "local":
+        import spacy
+
+        score_texts(spacy.load(model), texts)
+    else:
+        NLPClient(os.environ["NLP_POOL_ADDRESS"], bytes.fromhex(os.environ["NLP_POOL_AUTHKEY"])).score(texts)
+    print("ready", flush=True)
+    sys.stdin.read()
+
+
+def print_report(reports):
+    print(f"{'layout':<40} {'role':<14} {'procs':>5} {'PSS MiB':>9} {'RSS MiB':>9}")
+    for report in reports:
+        for role, usage in report["processes"].items():
+            print(f"{report['layout']:<40} {role:<14} {usage['count']:>5} {usage['pss_mib']:>9.1f} "
+                  f"{usage['rss_mib']:>9.1f}")
+        print(f"{report['layout']:<40} {'total':<14} {'':>5} {report['pss_mib']:>9.1f} {report['rss_mib']:>9.1f}")
+    saved = reports[0]["pss_mib"] - reports[1]["pss_mib"]
+    print(f"The pool saves {saved:.1f} MiB PSS ({saved / reports[0]['pss_mib']:.0%})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4, help="Web workers per instance")
+    parser.add_argument("--pool-processes", type=int, default=1, help="Scoring processes in the pool")
+    parser.add_argument("--model", default=os.environ.get(
+        "NLP_MODEL_PATH", "spacy_models/en_core_web_sm/en_core_web_sm-3.6.0"))
+    parser.add_argument("--python", default=sys.executable, help="Interpreter with spaCy to run the processes with")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--child", choices=["local", "client"], help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        return run_child(args.child, args.model)
+
+    texts = fixture_sentences()
+    reports = [measure_per_worker(args, texts), measure_pooled(args, texts)]
+    print_report(reports)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(reports, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
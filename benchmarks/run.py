@@ -0,0 +1,261 @@
+"""
+Microbenchmarks for the CPU-bound helpers in app.py.
+
+Run from the repository root:
+
+    python -m benchmarks.run                   # compare against benchmarks/baseline.json
+    python -m benchmarks.run --save-baseline   # record a new baseline on this machine
+    python -m benchmarks.run -k score          # only benchmarks whose name contains "score"
+    python -m benchmarks.run --check           # as a CI gate: also fail when there is no baseline to compare to
+
+app.py is imported with COVERLETTER_OFFLINE=true, so no Secret Manager, Firebase or network access is needed.
+Benchmarks that need the spaCy model are skipped when it can't be loaded (set NLP_MODEL_PATH to point at it).
+The run exits with status 1 when a benchmark got slower or uses more memory than the baseline allows.
+"""
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("COVERLETTER_OFFLINE", "true")
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BENCHMARK_DIR, "fixtures")
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, "baseline.json")
+# A benchmark regresses when its p50 latency or peak memory exceeds the baseline by more than this fraction
+DEFAULT_THRESHOLD = 0.25
+
+benchmarks = []
+
+
+def benchmark(name, needs_nlp=False):
+    # Register a setup function. It receives the app module and the fixtures and returns the callable to time.
+    def register(setup):
+        benchmarks.append({"name": name, "setup": setup, "needs_nlp": needs_nlp})
+        return setup
+    return register
+
+
+def load_fixtures():
+    pages = {}
+    pages_dir = os.path.join(FIXTURE_DIR, "pages")
+    for filename in sorted(os.listdir(pages_dir)):
+        if filename.endswith(".html"):
+            with open(os.path.join(pages_dir, filename), "r", encoding="utf-8") as page_file:
+                pages[filename[:-len(".html")]] = page_file.read()
+    with open(os.path.join(FIXTURE_DIR, "responses.json"), "r", encoding="utf-8") as responses_file:
+        fixtures = json.load(responses_file)
+    fixtures["pages"] = pages
+    return fixtures
+
+
+def page_texts(app, fixtures):
+    # The text get_web_content would return for each saved page that has enough of it
+    texts = [app.parse_page(html) for html in fixtures["pages"].values()]
+    return [" ".join(paragraphs) for paragraphs in texts if paragraphs is not None]
+
+
+@benchmark("parse_page")
+def bench_parse_page(app, fixtures):
+    pages = list(fixtures["pages"].values())
+    return lambda: [app.parse_page(html) for html in pages]
+
+
+@benchmark("parse_page_large")
+def bench_parse_page_large(app, fixtures):
+    # A marketing page with a big menu and inline bundle before the content, and a long tail after it
+    menu = "".join(f'<li><a href="/products/{i}">Product {i}</a></li>' for i in range(3000))
+    bundle = "window.__STATE__ = " + json.dumps([{"id": i, "name": f"Product {i}"} for i in range(5000)])
+    tail = "".join(f"<section><h2>Feature {i}</h2><p>Feature {i} in detail.</p></section>" for i in range(10000))
+    html = fixtures["pages"]["northwind-logistics"].replace(
+        "<body>", f"<body><nav><ul>{menu}</ul></nav><script>{bundle}</script>", 1).replace("</body>", tail + "</body>")
+    return lambda: app.parse_page(html)
+
+
+@benchmark("clean_response_text")
+def bench_clean_response_text(app, fixtures):
+    responses = fixtures["responses"]
+    return lambda: [app.clean_response_text(response) for response in responses]
+
+
+@benchmark("score_content", needs_nlp=True)
+def bench_score_content(app, fixtures):
+    sentences = [sentence.strip() for text in page_texts(app, fixtures) for sentence in text.split(".") if sentence]
+    return lambda: [app.score_content(sentence) for sentence in sentences]
+
+
+@benchmark("extract_relevant_content", needs_nlp=True)
+def bench_extract_relevant_content(app, fixtures):
+    texts = page_texts(app, fixtures)
+    return lambda: [app.extract_relevant_content(text) for text in texts]
+
+
+@benchmark("create_cover_letter")
+def bench_create_cover_letter(app, fixtures):
+    letters = fixtures["paragraphs"]
+    # Build the templates before timing, like a warmed up instance would have
+    for style in app.letter_styles():
+        app.create_cover_letter(letters[0], letters[0]["company"], letters[0]["role"], style=style)
+    return lambda: [app.create_cover_letter(letter, letter["company"], letter["role"], name=letter["name"])
+                    for letter in letters]
+
+
+def percentile(sorted_samples, fraction):
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def measure(function, warmup, min_rounds, min_time):
+    """
+    Time a callable.
+
+    Args:
+    - warmup: Untimed calls before measuring, to fill caches and let lazy initialization happen.
+    - min_rounds, min_time: The callable runs at least min_rounds times and for at least min_time seconds.
+
+    Returns:
+    - A dict with the number of rounds, ops/sec, p50 and p99 latency in milliseconds and peak memory in KiB.
+    """
+    for _ in range(warmup):
+        function()
+
+    samples = []
+    gc.collect()
+    started = time.perf_counter()
+    while len(samples) < min_rounds or time.perf_counter() - started < min_time:
+        call_started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - call_started)
+    samples.sort()
+
+    # Memory is measured in separate calls, since tracemalloc slows down every allocation
+    gc.collect()
+    tracemalloc.start()
+    try:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for _ in range(3):
+            function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "rounds": len(samples),
+        "ops_per_sec": len(samples) / sum(samples),
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "peak_kib": max(0, peak - current) / 1024,
+    }
+
+
+def compare(name, result, baseline, threshold):
+    # Returns the list of regressions of one benchmark against its baseline entry
+    if baseline is None:
+        return []
+    regressions = []
+    for metric in ("p50_ms", "peak_kib"):
+        allowed = baseline[metric] * (1 + threshold)
+        if result[metric] > allowed and result[metric] - baseline[metric] > 0.001:
+            regressions.append(f"{name}: {metric} {result[metric]:.3f} exceeds baseline {baseline[metric]:.3f} "
+                               f"by more than {threshold:.0%}")
+    return regressions
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(path, results):
+    baseline = {
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "processor": platform.processor()},
+        "benchmarks": results,
+    }
+    with open(path, "w", encoding="utf-8") as baseline_file:
+        json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write("\n")
+
+
+def import_app():
+    # app.py prints while it starts up and while it renders letters, which would drown the report
+    sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        import app
+    return app
+
+
+def nlp_available(app):
+    try:
+        app.wait_for_nlp()
+        return True, None
+    except RuntimeError as e:
+        return False, str(e)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", "--filter", default="", help="Only run benchmarks whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline file to compare against or save to")
+    parser.add_argument("--save-baseline", action="store_true", help="Record the results as the new baseline")
+    parser.add_argument("--check", action="store_true",
+                        help="Fail when there is no baseline, or no baseline entry for a benchmark that ran")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Allowed slowdown or memory growth as a fraction of the baseline")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--min-rounds", type=int, default=20)
+    parser.add_argument("--min-time", type=float, default=1.0, help="Minimum seconds spent timing each benchmark")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args(argv)
+
+    app = import_app()
+    fixtures = load_fixtures()
+    has_nlp, nlp_error = nlp_available(app)
+    baseline = None if args.save_baseline else load_baseline(args.baseline)
+    if baseline is None and not args.save_baseline:
+        print(f"No baseline at {args.baseline}, run with --save-baseline to record one")
+        if args.check:
+            return 1
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<28}{'ops/sec':>12}{'p50 ms':>11}{'p99 ms':>11}{'peak KiB':>11}")
+    for entry in benchmarks:
+        name = entry["name"]
+        if args.filter not in name:
+            continue
+        if entry["needs_nlp"] and not has_nlp:
+            print(f"{name:<28}skipped: {nlp_error}")
+            continue
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = measure(entry["setup"](app, fixtures), args.warmup, args.min_rounds, args.min_time)
+        results[name] = result
+        print(f"{name:<28}{result['ops_per_sec']:>12.1f}{result['p50_ms']:>11.3f}{result['p99_ms']:>11.3f}"
+              f"{result['peak_kib']:>11.1f}")
+        if baseline is not None:
+            if args.check and name not in baseline["benchmarks"]:
+                regressions.append(f"{name}: no baseline entry, run with --save-baseline to record one")
+            regressions.extend(compare(name, result, baseline["benchmarks"].get(name), args.threshold))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import queue
+import threading
+from contextlib import contextmanager
+
+
+class BrowserPoolExhausted(RuntimeError):
+    pass
+
+
+class BrowserPool:
+    """
+    Bounded pool of warm headless browsers that are reused across requests.
+
+    Args:
+    - factory: A function that starts a new browser.
+    - size: Maximum number of pooled browsers, which is also how many pages are fetched concurrently.
+    - max_pages: Number of pages a browser serves before it is replaced by a fresh one.
+    - acquire_timeout: How many seconds to wait for a pooled browser before falling back to a fresh one.
+    - max_overflow: How many fresh, single use browsers may run next to the pool when it is busy.
+    - healthy_exceptions: Exceptions raised while using a browser that don't mean it crashed, like a page
+      load timeout. Any other exception retires the browser.
+    """
+
+    def __init__(self, factory, size=1, max_pages=50, acquire_timeout=5, max_overflow=1, healthy_exceptions=()):
+        self.factory = factory
+        self.max_pages = max_pages
+        self.acquire_timeout = acquire_timeout
+        self.healthy_exceptions = healthy_exceptions
+        self.slots = threading.BoundedSemaphore(size)
+        self.overflow_slots = threading.BoundedSemaphore(max_overflow) if max_overflow else None
+        # Most recently used browsers first, so rarely used ones age out through max_pages less often
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.counters = {"started": 0, "reused": 0, "recycled": 0, "crashed": 0, "fallbacks": 0}
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def start_browser(self):
+        browser = self.factory()
+        self.count("started")
+        return browser
+
+    @contextmanager
+    def browser(self):
+        if self.slots.acquire(timeout=self.acquire_timeout):
+            try:
+                with self.pooled_browser() as browser:
+                    yield browser
+            finally:
+                self.slots.release()
+        else:
+            with self.fresh_browser() as browser:
+                yield browser
+
+    @contextmanager
+    def pooled_browser(self):
+        try:
+            browser, pages = self.idle.get_nowait()
+            self.count("reused")
+        except queue.Empty:
+            browser, pages = self.start_browser(), 0
+
+        try:
+            yield browser
+        except self.healthy_exceptions:
+            self.check_in(browser, pages + 1)
+            raise
+        except BaseException:
+            self.count("crashed")
+            quit_browser(browser)
+            raise
+        else:
+            self.check_in(browser, pages + 1)
+
+    @contextmanager
+    def fresh_browser(self):
+        # The pool is busy: use a single use browser, as long as the overflow cap allows another one
+        if self.overflow_slots is None or not self.overflow_slots.acquire(timeout=self.acquire_timeout):
+            raise BrowserPoolExhausted("No browser became available in time")
+        self.count("fallbacks")
+        try:
+            browser = self.start_browser()
+            try:
+                yield browser
+            finally:
+                quit_browser(browser)
+        finally:
+            self.overflow_slots.release()
+
+    def check_in(self, browser, pages):
+        if pages >= self.max_pages:
+            self.count("recycled")
+            quit_browser(browser)
+            return
+        try:
+            # Don't leak cookies or a heavy page into the next request
+            browser.delete_all_cookies()
+            browser.get("about:blank")
+        except Exception as e:
+            print(f"Retiring browser that failed to reset: {e}")
+            self.count("crashed")
+            quit_browser(browser)
+            return
+        self.idle.put((browser, pages))
+
+    def warm(self, count=1):
+        # Start browsers ahead of the first request that needs one
+        for _ in range(count):
+            self.idle.put((self.start_browser(), 0))
+
+    def close(self):
+        while True:
+            try:
+                browser, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            quit_browser(browser)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["idle"] = self.idle.qsize()
+        return stats
+
+
+def quit_browser(browser):
+    try:
+        browser.quit()
+    except Exception as e:
+        print(f"Failed to quit browser: {e}")
@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def content_hash(*parts):
+    # Stable key for any JSON serializable values
+    serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """
+    Thread safe in-memory cache with a per-entry time to live and least recently used eviction.
+
+    Args:
+    - max_entries: Number of entries kept before the least recently used one is evicted.
+    - ttl: Seconds an entry stays valid. None keeps entries until they are evicted.
+    """
+
+    def __init__(self, max_entries=1000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at is None or expires_at > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key, so only the first one does the work and the others wait
+    for its result (or its exception).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = function()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines running on one event loop.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, function):
+        call = self.calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            return await asyncio.shield(call)
+
+        call = self.calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await function()
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except BaseException as e:
+            call.set_exception(e)
+            # Nobody may be waiting for it, which is fine
+            call.exception()
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            del self.calls[key]
@@ -0,0 +1,164 @@
+import base64
+import datetime
+import json
+import os
+import threading
+import time
+from caching import content_hash
+
+
+class LocalCheckpointStore:
+    """
+    Checkpoints kept as one JSON file per key, for tests and local runs. Bytes values are stored base64 encoded.
+    """
+
+    def __init__(self, directory, retention_seconds=24 * 3600):
+        self.directory = directory
+        self.retention_seconds = retention_seconds
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self, key):
+        try:
+            with open(self.path(key), "r", encoding="utf-8") as checkpoint_file:
+                stages = json.load(checkpoint_file, object_hook=decode_bytes)
+        except (OSError, ValueError):
+            return {}
+        if stages.get("updated_at", 0) < time.time() - self.retention_seconds:
+            return {}
+        return stages
+
+    def save(self, key, stage, value):
+        self.update(key, stage, lambda current: value)
+
+    def update(self, key, stage, change):
+        # Replace a stage's value (None when missing) with change(value), atomically for the threads of this process
+        with self.lock:
+            stages = self.load(key)
+            value = stages[stage] = change(stages.get(stage))
+            stages["updated_at"] = time.time()
+            temp_path = f"{self.path(key)}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as checkpoint_file:
+                json.dump(stages, checkpoint_file, default=encode_bytes)
+            os.replace(temp_path, self.path(key))
+        return value
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+
+def encode_bytes(value):
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    raise TypeError(f"Can't store {type(value).__name__} in a checkpoint")
+
+
+def decode_bytes(value):
+    if set(value) == {"__bytes__"}:
+        return base64.b64decode(value["__bytes__"])
+    return value
+
+
+class FirestoreCheckpointStore:
+    """
+    Checkpoints kept as one Firestore document per key. A Firestore TTL policy on expires_at cleans them up.
+    """
+
+    def __init__(self, db, firestore, collection="checkpoints", retention_seconds=24 * 3600):
+        self.db = db
+        self.firestore = firestore
+        self.collection = db.collection(collection)
+        self.retention_seconds = retention_seconds
+
+    def load(self, key):
+        return self.stages(self.collection.document(key).get())
+
+    def stages(self, snapshot):
+        if not snapshot.exists:
+            return {}
+        stages = snapshot.to_dict()
+        expires_at = stages.pop("expires_at", None)
+        if expires_at is not None and expires_at.timestamp() < time.time():
+            return {}
+        return stages
+
+    def fields(self, stage, value):
+        now = time.time()
+        return {
+            stage: value,
+            "updated_at": now,
+            "expires_at": datetime.datetime.fromtimestamp(now + self.retention_seconds, tz=datetime.timezone.utc),
+        }
+
+    def save(self, key, stage, value):
+        self.collection.document(key).set(self.fields(stage, value), merge=True)
+
+    def update(self, key, stage, change):
+        # Same as LocalCheckpointStore.update, in a transaction that is retried on contention
+        doc_ref = self.collection.document(key)
+
+        @self.firestore.transactional
+        def run(transaction):
+            value = change(self.stages(doc_ref.get(transaction=transaction)).get(stage))
+            transaction.set(doc_ref, self.fields(stage, value), merge=True)
+            return value
+
+        return run(self.db.transaction())
+
+    def delete(self, key):
+        self.collection.document(key).delete()
+
+
+class Checkpoint:
+    """
+    The finished stages of one task, so a retried task resumes where the previous attempt failed.
+
+    Args:
+    - store: The checkpoint store, or None to disable checkpointing.
+    - key: The task name or idempotency key. Without one nothing is persisted.
+    - payload: The task payload. A checkpoint saved for a different payload under the same key is ignored.
+    """
+
+    def __init__(self, store, key, payload):
+        self.store = store if key else None
+        self.key = content_hash(key) if key else None
+        self.payload_hash = content_hash(payload)
+        self.stages = {}
+        self.started = False
+        if self.store is not None:
+            try:
+                stages = self.store.load(self.key)
+            except Exception as e:
+                print(f"Failed to load checkpoint: {e}")
+                stages = {}
+            if stages.get("payload_hash") == self.payload_hash:
+                self.stages = stages
+                self.started = True
+                print(f"Resuming from checkpoint with stages: {sorted(self.completed_stages())}")
+
+    def completed_stages(self):
+        return set(self.stages) - {"payload_hash", "updated_at"}
+
+    def get(self, stage, default=None):
+        return self.stages.get(stage, default)
+
+    def save(self, stage, value):
+        self.stages[stage] = value
+        if self.store is None:
+            return
+        try:
+            if not self.started:
+                # Drop whatever an earlier payload left under the same key before the first stage is saved
+                self.store.delete(self.key)
+                self.store.save(self.key, "payload_hash", self.payload_hash)
+                self.started = True
+            self.store.save(self.key, stage, value)
+        except Exception as e:
+            # A missing checkpoint only costs work on a retry, so it never fails the task
+            print(f"Failed to save checkpoint stage {stage}: {e}")
@@ -0,0 +1,205 @@
+import os
+import re
+import threading
+import zipfile
+from datetime import datetime, timezone
+from io import BytesIO
+from xml.sax.saxutils import escape
+from docx import Document
+from docx.shared import Pt
+from docx.enum.text import WD_PARAGRAPH_ALIGNMENT as WD_ALIGN_PARAGRAPH
+
+# Designers can drop a styled <style>.docx with the same placeholders here to replace a built-in layout
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+PLACEHOLDER_PATTERN = re.compile(rb"\{\{([A-Z_]+)\}\}")
+# Parts of the package that get placeholders substituted. Everything else is copied as it is.
+TEMPLATED_PARTS = ("word/document.xml", "docProps/core.xml")
+# Fixed timestamps keep the output byte-stable for the same input
+FIXED_DATE = datetime(2023, 1, 1, tzinfo=timezone.utc)
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# Characters XML 1.0 doesn't allow, which would make Word refuse the document
+INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+
+def add_centered_header(doc, name_size):
+    full_name_paragraph = doc.add_paragraph("{{FULL_NAME}}")
+    full_name_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    full_name_paragraph.runs[0].font.size = Pt(name_size)
+    doc.add_paragraph("[CITY STATE ZIP]").alignment = WD_ALIGN_PARAGRAPH.CENTER
+    doc.add_paragraph("[PHONE] | [EMAIL]").alignment = WD_ALIGN_PARAGRAPH.CENTER
+
+
+def add_letter_body(doc):
+    doc.add_paragraph("Dear Hiring Manager at {{COMPANY}},")
+    doc.add_paragraph("{{INTRO}}")
+    doc.add_paragraph("{{TAILORED_EXPERIENCE}}")
+    doc.add_paragraph("{{COMPANY_ALIGNMENT}}")
+    doc.add_paragraph("Sincerely,\n{{FULL_NAME}}")
+
+
+def build_classic(doc):
+    # The original layout: large centered name over the contact details
+    doc.sections[0].top_margin = Pt(0.5)
+    doc.add_paragraph()
+    add_centered_header(doc, 36)
+    add_letter_body(doc)
+
+
+def build_modern(doc):
+    # Left aligned header in a sans serif font with the role as a subject line
+    doc.styles["Normal"].font.name = "Calibri"
+    doc.styles["Normal"].font.size = Pt(11)
+    name_paragraph = doc.add_paragraph("{{FULL_NAME}}")
+    name_paragraph.runs[0].font.size = Pt(28)
+    name_paragraph.runs[0].font.bold = True
+    doc.add_paragraph("[CITY STATE ZIP] | [PHONE] | [EMAIL]")
+    subject_paragraph = doc.add_paragraph("Application for {{ROLE}}")
+    subject_paragraph.runs[0].font.bold = True
+    add_letter_body(doc)
+
+
+def build_compact(doc):
+    # Everything on one page: narrow margins, smaller type
+    section = doc.sections[0]
+    section.top_margin = section.bottom_margin = Pt(36)
+    section.left_margin = section.right_margin = Pt(54)
+    doc.styles["Normal"].font.size = Pt(10)
+    add_centered_header(doc, 20)
+    add_letter_body(doc)
+
+
+LETTER_STYLES = {
+    "classic": build_classic,
+    "modern": build_modern,
+    "compact": build_compact,
+}
+
+
+class Template:
+    """
+    A parsed DOCX package, ready to render.
+
+    The parts without placeholders (styles, theme, fonts) are compressed once into a partial package, and
+    rendering only appends the compressed, substituted templated parts to a copy of it.
+    """
+
+    def __init__(self, package_bytes):
+        self.templated_parts = []
+        static_stream = BytesIO()
+        with zipfile.ZipFile(BytesIO(package_bytes)) as package, \
+                zipfile.ZipFile(static_stream, "w", zipfile.ZIP_DEFLATED) as static_package:
+            for info in package.infolist():
+                content = package.read(info)
+                if info.filename in TEMPLATED_PARTS:
+                    self.templated_parts.append(
+                        (info.filename, split_placeholders(preserve_placeholder_whitespace(content))))
+                else:
+                    write_part(static_package, info.filename, content)
+        self.static_package = static_stream.getvalue()
+
+    def render(self, values):
+        # values maps placeholder names to (document xml, plain xml) byte strings
+        output_stream = BytesIO(self.static_package)
+        with zipfile.ZipFile(output_stream, "a", zipfile.ZIP_DEFLATED) as package:
+            for filename, segments in self.templated_parts:
+                plain = filename != "word/document.xml"
+                write_part(package, filename, b"".join(
+                    segment if isinstance(segment, bytes) else values[segment][1 if plain else 0]
+                    for segment in segments
+                ))
+        output_stream.seek(0)
+        return output_stream
+
+
+def write_part(package, filename, content):
+    package.writestr(zipfile.ZipInfo(filename, date_time=ZIP_DATE_TIME), content, compress_type=zipfile.ZIP_DEFLATED)
+
+
+def preserve_placeholder_whitespace(xml):
+    # Substituted text may start or end with spaces, which Word drops unless the run preserves them
+    return re.sub(rb"<w:t>([^<]*\{\{)", rb'<w:t xml:space="preserve">\1', xml)
+
+
+def split_placeholders(xml):
+    segments = []
+    position = 0
+    for match in PLACEHOLDER_PATTERN.finditer(xml):
+        segments.append(xml[position:match.start()])
+        segments.append(match.group(1).decode("ascii"))
+        position = match.end()
+    segments.append(xml[position:])
+    return segments
+
+
+def run_xml(text):
+    # Same mapping python-docx uses for run text: newlines become breaks and tabs become tab elements
+    text = escape(INVALID_XML_CHARS.sub("", text))
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = text.replace("\n", '</w:t><w:br/><w:t xml:space="preserve">')
+    text = text.replace("\t", '</w:t><w:tab/><w:t xml:space="preserve">')
+    return text.encode("utf-8")
+
+
+def plain_xml(text):
+    return escape(" ".join(INVALID_XML_CHARS.sub("", text).split())).encode("utf-8")
+
+
+def build_template(style):
+    path = os.path.join(TEMPLATE_DIR, f"{style}.docx")
+    if os.path.exists(path):
+        with open(path, "rb") as template_file:
+            return Template(template_file.read())
+
+    doc = Document()
+    LETTER_STYLES[style](doc)
+    doc.core_properties.title = "{{DOCUMENT_TITLE}}"
+    doc.core_properties.created = FIXED_DATE
+    doc.core_properties.modified = FIXED_DATE
+    package_stream = BytesIO()
+    doc.save(package_stream)
+    return Template(package_stream.getvalue())
+
+
+def letter_styles():
+    # The built-in layouts plus any template dropped in TEMPLATE_DIR
+    styles = set(LETTER_STYLES)
+    if os.path.isdir(TEMPLATE_DIR):
+        styles.update(name[:-len(".docx")] for name in os.listdir(TEMPLATE_DIR) if name.endswith(".docx"))
+    return sorted(styles)
+
+
+templates = {}
+templates_lock = threading.Lock()
+
+
+def get_template(style):
+    # Templates are built and parsed once per process
+    template = templates.get(style)
+    if template is None:
+        with templates_lock:
+            template = templates.get(style)
+            if template is None:
+                template = templates[style] = build_template(style)
+    return template
+
+
+def render_cover_letter(paragraphs, company, role, name=None, style="classic"):
+    """
+    Render a cover letter by substituting the values straight into the cached template XML.
+
+    Returns:
+    - A BytesIO with the .docx document, identical for identical input.
+    """
+    if style not in letter_styles():
+        raise ValueError(f"Unknown letter style: {style}")
+
+    values = {
+        "FULL_NAME": name or "[FULL NAME]",
+        "COMPANY": company,
+        "ROLE": role,
+        "DOCUMENT_TITLE": f"Cover Letter for {role} at {company}",
+        "INTRO": paragraphs["intro"],
+        "TAILORED_EXPERIENCE": paragraphs["tailored_experience"],
+        "COMPANY_ALIGNMENT": paragraphs["company_alignment"],
+    }
+    return get_template(style).render({key: (run_xml(value), plain_xml(value)) for key, value in values.items()})
@@ -0,0 +1,82 @@
+# gunicorn reads this file from the working directory on top of the command line in app.yaml.
+#
+# When gunicorn starts, it starts the shared NLP pool (nlp_pool.py) and points the workers at it through
+# NLP_POOL_ADDRESS and NLP_POOL_AUTHKEY, so the spaCy model is loaded once per instance instead of once per
+# worker. Set NLP_POOL=false to have every worker load its own copy again.
+#
+# It also gives the workers a fresh PROMETHEUS_MULTIPROC_DIR, where each one writes its metrics, so that /metrics
+# reports the whole instance whichever worker serves the scrape.
+import os
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def on_starting(server):
+    prepare_metrics_dir(server)
+    if os.environ.get("NLP_POOL", "true").lower() != "true" or os.environ.get("NLP_POOL_ADDRESS"):
+        return
+    address = os.path.join(tempfile.gettempdir(), f"coverletter-nlp-{os.getpid()}.sock")
+    # Workers are forked from this process, so they inherit both
+    os.environ["NLP_POOL_ADDRESS"] = address
+    os.environ["NLP_POOL_AUTHKEY"] = secrets.token_hex(16)
+    server.nlp_pool_stopping = threading.Event()
+    server.nlp_pool_process = start_nlp_pool(server)
+    threading.Thread(target=supervise_nlp_pool, args=(server,), name="nlp-pool-supervisor", daemon=True).start()
+
+
+def prepare_metrics_dir(server):
+    # Files left by an earlier run would be added to this one's counts
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.path.join(
+        tempfile.gettempdir(), f"coverletter-metrics-{os.getpid()}")
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = directory
+    server.log.info("Workers write their metrics to %s", directory)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def start_nlp_pool(server):
+    process = subprocess.Popen([sys.executable, "-m", "nlp_pool"], cwd=APP_DIR)
+    server.log.info("Started the NLP pool on %s (pid %s)", os.environ["NLP_POOL_ADDRESS"], process.pid)
+    return process
+
+
+def supervise_nlp_pool(server):
+    # Restart the pool when it dies, e.g. killed for using too much memory, backing off while it keeps failing
+    delay = 1
+    while True:
+        started = time.monotonic()
+        returncode = server.nlp_pool_process.wait()
+        if server.nlp_pool_stopping.is_set():
+            return
+        if time.monotonic() - started > 60:
+            delay = 1
+        server.log.warning("The NLP pool exited with status %s, restarting it in %ss", returncode, delay)
+        if server.nlp_pool_stopping.wait(delay):
+            return
+        delay = min(delay * 2, 60)
+        server.nlp_pool_process = start_nlp_pool(server)
+
+
+def on_exit(server):
+    process = getattr(server, "nlp_pool_process", None)
+    if process is None:
+        return
+    server.nlp_pool_stopping.set()
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
@@ -0,0 +1,152 @@
+import codecs
+from html.parser import HTMLParser
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# What closing the parser raises for a page without any element, which just has no paragraphs
+CLOSE_ERRORS = (etree.XMLSyntaxError,) if etree is not None else ()
+
+# Text in these elements is never part of the page's content
+SKIPPED_TAGS = {"script", "style", "template", "nav"}
+
+
+class ParagraphExtractor:
+    """
+    Collect the text of a page's first paragraphs from chunks of HTML as they are read, without building a tree.
+
+    Feeding can stop as soon as done is set: the first max_paragraphs <p> elements are complete and the page
+    has more than min_text_length characters of text. Text inside script, style, template and nav elements is
+    ignored. Parsing uses lxml when it is installed and the standard library's html.parser otherwise.
+
+    Args:
+    - encoding: Encoding of the byte chunks given to feed().
+    """
+
+    def __init__(self, encoding="utf-8", max_paragraphs=10, min_text_length=50):
+        self.max_paragraphs = max_paragraphs
+        self.min_text_length = min_text_length
+        self.decoder = codecs.getincrementaldecoder(codecs.lookup(encoding or "utf-8").name)(errors="replace")
+        self.paragraphs = []
+        self.open_paragraphs = []
+        self.skip_depth = 0
+        self.text_length = 0
+        self.bytes_read = 0
+        self.done = False
+        self.closed = False
+        self.parser = etree.HTMLParser(target=self) if etree is not None else FallbackParser(self)
+
+    def feed(self, chunk):
+        if self.done:
+            return
+        if isinstance(chunk, bytes):
+            self.bytes_read += len(chunk)
+            chunk = self.decoder.decode(chunk)
+        else:
+            self.bytes_read += len(chunk)
+        if chunk:
+            self.parser.feed(chunk)
+
+    def result(self):
+        """
+        Returns:
+        - The paragraph texts, or None when the page has too little text to be worth using.
+        """
+        if not self.done and not self.closed:
+            # Text the parser still holds, like that of an unclosed last <p>, only comes out once it is closed
+            tail = self.decoder.decode(b"", final=True)
+            if tail:
+                self.parser.feed(tail)
+            self.closed = True
+            try:
+                self.parser.close()
+            except CLOSE_ERRORS:
+                pass
+        if self.text_length > self.min_text_length:
+            return ["".join(parts) for parts in self.paragraphs]
+        return None
+
+    def check_done(self):
+        self.done = (len(self.paragraphs) >= self.max_paragraphs and not self.open_paragraphs
+                     and self.text_length > self.min_text_length)
+
+    # Parser target interface, shared by lxml and FallbackParser
+
+    def start(self, tag, attrib=None):
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag == "p" and not self.skip_depth and len(self.paragraphs) < self.max_paragraphs:
+            parts = []
+            self.paragraphs.append(parts)
+            self.open_paragraphs.append(parts)
+
+    def end(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+        elif tag == "p" and not self.skip_depth and self.open_paragraphs:
+            self.open_paragraphs.pop()
+            self.check_done()
+
+    def data(self, data):
+        if self.skip_depth or self.done:
+            return
+        self.text_length += len(data)
+        for parts in self.open_paragraphs:
+            parts.append(data)
+        if self.text_length > self.min_text_length and not self.open_paragraphs:
+            self.check_done()
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        pass
+
+
+class FallbackParser(HTMLParser):
+    # Feeds a ParagraphExtractor from html.parser. A new <p> closes an open one, as it does for lxml and browsers.
+
+    def __init__(self, target):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "p" and self.target.open_paragraphs and not self.target.skip_depth:
+            self.target.end("p")
+        self.target.start(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.target.start(tag)
+        self.target.end(tag)
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+
+def extract_paragraphs(html_content, max_paragraphs=10, min_text_length=50, chunk_size=16 * 1024):
+    # ParagraphExtractor for a page that has already been read. It is fed in slices so parsing stops early too.
+    chunks = (html_content[start:start + chunk_size] for start in range(0, len(html_content), chunk_size))
+    return read_paragraphs(chunks, max_paragraphs=max_paragraphs, min_text_length=min_text_length).result()
+
+
+def read_paragraphs(chunks, encoding=None, max_bytes=None, max_paragraphs=10, min_text_length=50):
+    """
+    Extract paragraphs from an iterable of byte chunks, e.g. requests' iter_content(), reading no more than needed.
+
+    Args:
+    - max_bytes: Stop reading after this many bytes, and use what was parsed so far.
+
+    Returns:
+    - The extractor, whose result() has the paragraphs and bytes_read how much of the page was read.
+    """
+    extractor = ParagraphExtractor(encoding, max_paragraphs, min_text_length)
+    for chunk in chunks:
+        extractor.feed(chunk)
+        if extractor.done or (max_bytes and extractor.bytes_read >= max_bytes):
+            break
+    return extractor
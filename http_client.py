@@ -0,0 +1,233 @@
+import asyncio
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+class Upstream:
+    """
+    Connection settings for one upstream service.
+
+    Args:
+    - connect_timeout, read_timeout: Seconds before giving up on connecting and on waiting for the response.
+    - retry: urllib3 Retry policy mounted on the session. Only idempotent failures should be retried here.
+    - pool_maxsize: Number of keep-alive connections kept per host.
+    """
+
+    def __init__(self, connect_timeout, read_timeout, retry, pool_maxsize=10):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retry = retry
+        self.pool_maxsize = pool_maxsize
+
+
+class UpstreamStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+
+    def request_sent(self):
+        with self.lock:
+            self.requests += 1
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections_opened += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "connections_opened": self.connections_opened,
+                "connections_reused": max(0, self.requests - self.connections_opened),
+            }
+
+
+def counting_pool_class(base, stats):
+    class CountingConnectionPool(base):
+        def _new_conn(self):
+            stats.connection_opened()
+            return super()._new_conn()
+    return CountingConnectionPool
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    # Counts requests and newly opened connections, the difference being the requests served on a kept-alive one
+
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": counting_pool_class(HTTPConnectionPool, self.stats),
+            "https": counting_pool_class(HTTPSConnectionPool, self.stats),
+        }
+
+    def send(self, request, **kwargs):
+        self.stats.request_sent()
+        return super().send(request, **kwargs)
+
+
+class HttpClient:
+    """
+    Shared keep-alive sessions for the upstream services, one per upstream, with their own timeouts and retries.
+    """
+
+    def __init__(self, upstreams):
+        self.upstreams = upstreams
+        self.stats_by_upstream = {name: UpstreamStats() for name in upstreams}
+        self.sessions = {name: self.build_session(name) for name in upstreams}
+        self.local = threading.local()
+
+    def build_session(self, name):
+        upstream = self.upstreams[name]
+        adapter = CountingHTTPAdapter(self.stats_by_upstream[name], max_retries=upstream.retry,
+                                      pool_connections=4, pool_maxsize=upstream.pool_maxsize)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def session(self, upstream):
+        return self.sessions[upstream]
+
+    def thread_session(self, upstream):
+        # A session of the calling thread only, for clients that close their session on their own schedule
+        sessions = self.local.__dict__.setdefault("sessions", {})
+        if upstream not in sessions:
+            sessions[upstream] = self.build_session(upstream)
+        return sessions[upstream]
+
+    def timeout(self, upstream):
+        return self.upstreams[upstream].timeout
+
+    def request(self, upstream, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout(upstream))
+        return self.sessions[upstream].request(method, url, **kwargs)
+
+    def get(self, upstream, url, **kwargs):
+        return self.request(upstream, "GET", url, **kwargs)
+
+    def post(self, upstream, url, **kwargs):
+        return self.request(upstream, "POST", url, **kwargs)
+
+    def stats(self):
+        return {name: stats.snapshot() for name, stats in self.stats_by_upstream.items()}
+
+
+class AsyncHttpClient:
+    """
+    aiohttp counterpart of HttpClient for the async serving mode, with the same per-upstream timeouts and retry
+    policies. Requests are counted in the given stats, so both serving modes report through HttpClient.stats().
+
+    Sessions belong to the event loop they were created in, so they are created on first use and closed with close().
+    """
+
+    def __init__(self, upstreams, stats_by_upstream=None):
+        self.upstreams = upstreams
+        self.stats_by_upstream = stats_by_upstream or {name: UpstreamStats() for name in upstreams}
+        self.sessions = {}
+
+    def session(self, upstream):
+        import aiohttp
+
+        session = self.sessions.get(upstream)
+        if session is None or session.closed:
+            stats = self.stats_by_upstream[upstream]
+            trace_config = aiohttp.TraceConfig()
+
+            async def on_connection_create_end(session, context, params):
+                stats.connection_opened()
+
+            trace_config.on_connection_create_end.append(on_connection_create_end)
+            session = self.sessions[upstream] = aiohttp.ClientSession(trace_configs=[trace_config])
+        return session
+
+    def timeout(self, upstream):
+        import aiohttp
+
+        connect_timeout, read_timeout = self.upstreams[upstream].timeout
+        return aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+    async def request(self, upstream, method, url, stream=False, **kwargs):
+        """
+        Send a request, retrying like the upstream's urllib3 Retry policy would.
+
+        Args:
+        - stream: Like requests' stream=True, return before reading the body. The caller reads it from
+          response.content and releases the response.
+
+        Returns:
+        - The aiohttp response, with its body already read unless streaming.
+        """
+        import aiohttp
+
+        retry = self.upstreams[upstream].retry
+        allowed_methods = retry.allowed_methods or Retry.DEFAULT_ALLOWED_METHODS
+        budgets = {"total": retry.total or 0, "connect": retry.connect or 0, "read": retry.read or 0,
+                   "status": retry.status or 0}
+        kwargs.setdefault("timeout", self.timeout(upstream))
+        attempt = 0
+        while True:
+            self.stats_by_upstream[upstream].request_sent()
+            retry_after = None
+            try:
+                response = await self.session(upstream).request(method, url, **kwargs)
+                if not stream:
+                    await response.read()
+            except aiohttp.ClientConnectorError:
+                kind = "connect"
+                if not budgets["connect"] or not budgets["total"]:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                kind = "read"
+                if not budgets["read"] or not budgets["total"] or method.upper() not in allowed_methods:
+                    raise
+            else:
+                kind = "status"
+                if (response.status not in (retry.status_forcelist or ()) or not budgets["status"]
+                        or not budgets["total"] or method.upper() not in allowed_methods):
+                    return response
+                if retry.respect_retry_after_header:
+                    retry_after = response.headers.get("Retry-After")
+                response.release()
+            budgets[kind] -= 1
+            budgets["total"] -= 1
+            delay = retry.backoff_factor * 2 ** attempt if attempt else 0
+            if retry_after is not None and retry_after.isdigit():
+                delay = float(retry_after)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def get(self, upstream, url, **kwargs):
+        return await self.request(upstream, "GET", url, **kwargs)
+
+    async def post(self, upstream, url, **kwargs):
+        return await self.request(upstream, "POST", url, **kwargs)
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions = {}
+
+
+def default_upstreams():
+    # Retries never repeat a request the upstream may already have acted on, except for DeepL where a repeated
+    # translation is harmless. Mailgun only retries failed connects and explicit "try again later" answers.
+    return {
+        "scrape": Upstream(5, 10, Retry(total=2, connect=2, read=0, status=1, backoff_factor=0.5,
+                                        status_forcelist=(502, 503, 504), raise_on_status=False)),
+        "deepl": Upstream(3.05, 15, Retry(total=3, connect=3, read=1, status=3, backoff_factor=0.5,
+                                          status_forcelist=(429, 500, 502, 503, 504),
+                                          allowed_methods=frozenset({"GET", "POST"}), raise_on_status=False,
+                                          respect_retry_after_header=True)),
+        "mailgun": Upstream(3.05, 30, Retry(total=3, connect=3, read=0, status=2, backoff_factor=1,
+                                            status_forcelist=(429, 503), allowed_methods=frozenset({"POST"}),
+                                            raise_on_status=False, respect_retry_after_header=True)),
+        # OpenAI failures are retried by safe_openai_request, so the session only retries failed connects
+        "openai": Upstream(5, 60, Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.5)),
+    }
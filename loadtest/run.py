@@ -0,0 +1,340 @@
+"""
+Load test the app under gunicorn against local stand-ins for every upstream.
+
+Starts the stubs from loadtest/stubs.py, then for every gunicorn worker count in --workers starts --instances
+gunicorn servers and replays loadtest/payloads.json against them at every concurrency in --concurrency.
+Throughput and latency percentiles are reported per run, per instance and per worker process, which is the data
+to size max_instances and the gunicorn worker count in app.yaml with. Run from the repository root:
+
+    python -m loadtest.run --workers 1,2,4 --concurrency 1,4,8,16 --requests 64 --latency openai=2 --jitter openai=1
+    python -m loadtest.run --endpoint enqueue --workers 2 --concurrency 8 --error-rate openai=0.05
+    python -m loadtest.run --endpoint enqueue --task-backend local --workers 1 --threads 8 --concurrency 8
+"""
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from loadtest.stubs import StubServer, add_stub_arguments, behaviours_from_arguments
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAYLOADS_PATH = os.path.join(REPO_DIR, "loadtest", "payloads.json")
+ENDPOINTS = {"generate": "/generate-cover-letter", "enqueue": "/enqueue-cover-letter-task"}
+
+
+def comma_separated_ints(value):
+    return [int(part) for part in value.split(",") if part]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, duration):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / duration if duration > 0 else None,
+        "p50": percentile(latencies, 0.5),
+        "p90": percentile(latencies, 0.9),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else None,
+    }
+
+
+class Instance:
+    """
+    One gunicorn server running app:app, standing in for one App Engine instance.
+    """
+
+    def __init__(self, port, workers, environment, log_dir, threads=1, serving="sync"):
+        self.port = port
+        self.workers = workers
+        self.url = f"http://127.0.0.1:{port}"
+        self.log_path = os.path.join(log_dir, f"gunicorn-{port}-w{workers}.log")
+        command = [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{port}", "-w", str(workers),
+                   "--timeout", "150"]
+        if serving == "async":
+            command += ["-k", "uvicorn.workers.UvicornWorker", "asgi_app:application"]
+        else:
+            command += ["--threads", str(threads), "app:app"]
+        env = dict(os.environ, **environment)
+        # Each worker schedules OpenAI calls against its share of the account limits, like in production
+        env["WEB_CONCURRENCY"] = str(workers)
+        # Instances on one machine must not share admission slots
+        env["ADMISSION_LOCK_DIR"] = os.path.join(log_dir, f"admission-{port}")
+        self.log_file = open(self.log_path, "w")
+        self.process = subprocess.Popen(command, cwd=REPO_DIR, env=env, stdout=self.log_file,
+                                        stderr=subprocess.STDOUT)
+
+    def wait_until_ready(self, timeout):
+        # Ready once every worker answered, since each one imports the app on its own
+        deadline = time.monotonic() + timeout
+        seen_workers = set()
+        with requests.Session() as session:
+            while time.monotonic() < deadline:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"gunicorn on port {self.port} exited, see {self.log_path}")
+                try:
+                    response = session.get(f"{self.url}/test", timeout=5, headers={"Connection": "close"})
+                    if response.status_code == 200:
+                        seen_workers.add(response.headers.get("X-Worker-Id"))
+                        if len(seen_workers) >= self.workers:
+                            return
+                except requests.RequestException:
+                    pass
+                time.sleep(0.2)
+        raise RuntimeError(f"gunicorn on port {self.port} wasn't ready after {timeout}s, see {self.log_path}")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log_file.close()
+
+
+def build_payload(template, stub_url, run_id, sequence, unique_pages):
+    # Every request is for a different user, and its points differ so the completion cache doesn't answer it
+    payload = {key: value.replace("{stub}", stub_url) for key, value in template.items()}
+    payload["email"] = f"loadtest+{run_id}-{sequence}@example.com"
+    payload["intro_points"] += f" (request {run_id}-{sequence})"
+    payload["tailored_experience_points"] += f" (request {run_id}-{sequence})"
+    if unique_pages and payload["company_alignment_points"]:
+        payload["company_alignment_points"] += f"?request={run_id}-{sequence}"
+    return payload
+
+
+def run_level(instances, endpoint, concurrency, total_requests, payloads, stub_url, unique_pages):
+    """
+    Send total_requests requests from concurrency clients, spreading them over the instances round-robin.
+
+    Returns:
+    - A list of (instance url, worker id, status code, latency in seconds, task id) tuples and the wall clock
+      duration. The task id is None except for enqueued tasks.
+    """
+    run_id = uuid.uuid4().hex[:8]
+    sequence = itertools.count()
+    targets = itertools.cycle(instances)
+    lock = threading.Lock()
+    results = []
+
+    def client():
+        with requests.Session() as session:
+            while True:
+                with lock:
+                    number = next(sequence)
+                    instance = next(targets)
+                if number >= total_requests:
+                    return
+                payload = build_payload(payloads[number % len(payloads)], stub_url, run_id, number, unique_pages)
+                started = time.perf_counter()
+                try:
+                    response = session.post(instance.url + ENDPOINTS[endpoint], json=payload, timeout=300)
+                    status, worker = response.status_code, response.headers.get("X-Worker-Id")
+                    task_id = response.json().get("task_id") if endpoint == "enqueue" and status == 200 else None
+                except (requests.RequestException, ValueError):
+                    status, worker, task_id = None, None, None
+                with lock:
+                    results.append((instance.url, worker, status, time.perf_counter() - started, task_id))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(concurrency)]:
+            future.result()
+    return results, time.perf_counter() - started
+
+
+def wait_for_tasks(stub_url, timeout):
+    # Enqueued tasks run after the request returned, so wait until the Cloud Tasks stub delivered all of them
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = requests.get(f"{stub_url}/stats", timeout=5).json()
+        if stats["tasks"]["pending"] == 0:
+            return stats
+        time.sleep(0.5)
+    return requests.get(f"{stub_url}/stats", timeout=5).json()
+
+
+def fetch_task_statuses(url, task_ids):
+    with requests.Session() as session:
+        return [session.get(f"{url}/task-status/{task_id}", timeout=10).json() for task_id in task_ids]
+
+
+def wait_for_local_tasks(url, task_ids, timeout):
+    # The local task queue runs the tasks inside the app, so wait until the status of every task is final
+    deadline = time.monotonic() + timeout
+    while True:
+        statuses = fetch_task_statuses(url, task_ids)
+        if all(status.get("state") in ("succeeded", "failed") for status in statuses) or time.monotonic() > deadline:
+            return statuses
+        time.sleep(0.5)
+
+
+def local_task_stats(statuses):
+    # The task counts the Cloud Tasks stub would report, from the statuses of the local task queue
+    tasks = {"created": len(statuses), "succeeded": 0, "failed": 0, "attempts": 0, "pending": 0, "duplicates": 0,
+             "latencies": []}
+    for status in statuses:
+        state = status.get("state")
+        tasks[state if state in ("succeeded", "failed") else "pending"] += 1
+        tasks["attempts"] += status.get("attempts", 0)
+        if status.get("finished_at") is not None:
+            tasks["latencies"].append(status["finished_at"] - status["enqueued_at"])
+    return tasks
+
+
+def summarize_level(results, duration, stub_stats, tasks_duration=None, task_statuses=()):
+    successful = [result for result in results if result[2] is not None and 200 <= result[2] < 300]
+    level_report = summarize([result[3] for result in successful], duration)
+    level_report["errors"] = len(results) - len(successful)
+    level_report["statuses"] = {}
+    for result in results:
+        level_report["statuses"][str(result[2])] = level_report["statuses"].get(str(result[2]), 0) + 1
+
+    level_report["per_instance"] = {}
+    level_report["per_worker"] = {}
+    for key_function, breakdown in (((lambda result: result[0]), level_report["per_instance"]),
+                                    ((lambda result: f"{result[0]} pid {result[1]}"), level_report["per_worker"])):
+        groups = {}
+        for result in successful:
+            groups.setdefault(key_function(result), []).append(result[3])
+        for key, latencies in sorted(groups.items()):
+            breakdown[key] = summarize(latencies, duration)
+
+    level_report["upstreams"] = stub_stats["upstreams"]
+    tasks = stub_stats["tasks"]
+    if tasks["created"]:
+        latencies = tasks.pop("latencies")
+        task_latencies = summarize(latencies, tasks_duration)
+        task_latencies.pop("requests")
+        level_report["tasks"] = dict(tasks, **task_latencies)
+        # Time from when a task was due to when its attempt started, for the tasks that succeeded at once
+        queued = summarize([status["started_at"] - status["eta"] for status in task_statuses
+                            if status.get("attempts") == 1 and status.get("state") == "succeeded"], tasks_duration)
+        level_report["tasks"].update({"queue_p50": queued["p50"], "queue_p99": queued["p99"]})
+    return level_report
+
+
+def print_report(level):
+    def seconds(value):
+        return "-" if value is None else f"{value:.2f}"
+
+    print(f"{level['endpoint']:<9}{level['instances']:>5}{level['workers']:>8}{level['concurrency']:>6}"
+          f"{level['requests']:>7}{level['errors']:>7}{level['throughput'] or 0:>9.2f}"
+          f"{seconds(level['p50']):>8}{seconds(level['p90']):>8}{seconds(level['p99']):>8}")
+    for worker, stats in level["per_worker"].items():
+        print(f"    {worker:<40}{stats['requests']:>6} req {stats['throughput']:>7.2f}/s "
+              f"p50 {seconds(stats['p50'])} p99 {seconds(stats['p99'])}")
+    if "tasks" in level:
+        tasks = level["tasks"]
+        print(f"    tasks: {tasks['succeeded']} succeeded, {tasks['failed']} failed, {tasks['attempts']} attempts, "
+              f"{tasks['throughput'] or 0:.2f}/s end to end, p50 {seconds(tasks['p50'])} p99 {seconds(tasks['p99'])}, "
+              f"queued p50 {seconds(tasks['queue_p50'])} p99 {seconds(tasks['queue_p99'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoint", choices=sorted(ENDPOINTS) + ["both"], default="generate")
+    parser.add_argument("--workers", type=comma_separated_ints, default=[1, 2, 4],
+                        help="Comma separated gunicorn worker counts to sweep")
+    parser.add_argument("--threads", type=int, default=1, help="gunicorn threads per worker")
+    parser.add_argument("--serving", choices=["sync", "async"], default="sync",
+                        help="Serve app:app with sync workers or asgi_app:application with uvicorn workers")
+    parser.add_argument("--task-backend", choices=["stub", "local"], default="stub",
+                        help="Send enqueued tasks through the Cloud Tasks stub or the app's local task queue")
+    parser.add_argument("--instances", type=int, default=1, help="Number of gunicorn servers to spread load over")
+    parser.add_argument("--concurrency", type=comma_separated_ints, default=[1, 4, 8, 16],
+                        help="Comma separated numbers of concurrent clients to sweep")
+    parser.add_argument("--requests", type=int, default=32, help="Requests per concurrency level")
+    parser.add_argument("--unique-pages", action="store_true",
+                        help="Give every request its own company page URL, so the page cache never hits")
+    parser.add_argument("--base-port", type=int, default=8100)
+    parser.add_argument("--stub-port", type=int, default=8900)
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    parser.add_argument("--output", help="Write the full results to this JSON file")
+    add_stub_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.task_delay is None:
+        args.task_delay = 0.0
+
+    with open(PAYLOADS_PATH, "r", encoding="utf-8") as payloads_file:
+        payloads = json.load(payloads_file)
+    endpoints = sorted(ENDPOINTS) if args.endpoint == "both" else [args.endpoint]
+    ports = [args.base_port + index for index in range(args.instances)]
+
+    stubs = StubServer(args.stub_port, behaviours_from_arguments(args),
+                       targets=[f"http://127.0.0.1:{port}" for port in ports], task_delay=args.task_delay)
+    stubs.start()
+    environment = dict(stubs.app_environment(), FREE_LETTER_LIMIT="1000000")
+    # Every worker gets its own local page cache and checkpoint directories for the run
+    log_dir = tempfile.mkdtemp(prefix="loadtest-")
+    environment["PAGE_CACHE_DIR"] = os.path.join(log_dir, "page_cache")
+    environment["CHECKPOINT_DIR"] = os.path.join(log_dir, "checkpoints")
+    if args.task_backend == "local":
+        del environment["CLOUD_TASKS_STUB_URL"]
+        environment["TASK_QUEUE_BACKEND"] = "local"
+    print(f"Stubs on {stubs.url}, gunicorn logs in {log_dir}")
+
+    levels = []
+    print(f"{'endpoint':<9}{'inst':>5}{'workers':>8}{'conc':>6}{'reqs':>7}{'errs':>7}{'req/s':>9}"
+          f"{'p50':>8}{'p90':>8}{'p99':>8}")
+    try:
+        for workers in args.workers:
+            instances = [Instance(port, workers, environment, log_dir, args.threads, args.serving) for port in ports]
+            try:
+                for instance in instances:
+                    instance.wait_until_ready(args.startup_timeout)
+                for endpoint, concurrency in itertools.product(endpoints, args.concurrency):
+                    stubs.state.reset()
+                    started = time.perf_counter()
+                    results, duration = run_level(instances, endpoint, concurrency, args.requests, payloads,
+                                                  stubs.url, args.unique_pages)
+                    tasks_duration = None
+                    statuses = []
+                    stub_stats = stubs.state.stats()
+                    if endpoint == "enqueue":
+                        task_ids = [result[4] for result in results if result[4]]
+                        # The checkpoint directory, and so the task statuses, is shared by all instances
+                        if args.task_backend == "local":
+                            statuses = wait_for_local_tasks(instances[0].url, task_ids, args.requests * 150)
+                            stub_stats = dict(stubs.state.stats(), tasks=local_task_stats(statuses))
+                        else:
+                            wait_for_tasks(stubs.url, args.requests * 150)
+                            statuses = fetch_task_statuses(instances[0].url, task_ids)
+                            stub_stats = stubs.state.stats()
+                        tasks_duration = time.perf_counter() - started
+                    level = {"endpoint": endpoint, "serving": args.serving, "task_backend": args.task_backend,
+                             "instances": args.instances, "workers": workers, "threads": args.threads,
+                             "concurrency": concurrency}
+                    level.update(summarize_level(results, duration, stub_stats, tasks_duration, statuses))
+                    levels.append(level)
+                    print_report(level)
+            finally:
+                for instance in instances:
+                    instance.stop()
+    finally:
+        stubs.shutdown()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump({"arguments": vars(args), "levels": levels}, output_file, indent=2)
+        print(f"Wrote results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
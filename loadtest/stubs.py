@@ -0,0 +1,346 @@
+"""
+Local stand-ins for the upstream services, with configurable latency and error rates.
+
+One HTTP server plays OpenAI (/v1/chat/completions, streaming included), DeepL (/v2/translate), Mailgun
+(/v3/<domain>/messages), Cloud Tasks (/tasks, dispatching each task to the app after its delay and retrying
+failures like queue.yaml does) and the company websites (/pages/<name>, serving benchmarks/fixtures/pages).
+Secret Manager and Firestore need no server: app.py reads secrets from the environment and uses its local quota,
+checkpoint and page cache backends when COVERLETTER_OFFLINE=true.
+
+Run on its own with:
+
+    python -m loadtest.stubs --port 8900 --latency openai=1.5 --error-rate openai=0.02 --target http://127.0.0.1:8000
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+
+from task_queue import QUEUE_RETRY_POLICY
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fixtures", "pages")
+UPSTREAMS = ("openai", "deepl", "mailgun", "tasks", "pages")
+# Status codes returned by failing requests, chosen to exercise each client's retry path
+ERROR_STATUSES = {"openai": 429, "deepl": 503, "mailgun": 503, "tasks": 503, "pages": 503}
+# The retry policy of cover-letter-queue has its backoff scaled by this for local runs
+TASK_TIME_SCALE = 0.01
+
+COMPLETION_TEXT = (
+    "With six years of experience building reliable data platforms, I have learned how much good tooling matters "
+    "to the people who depend on it. At my last company I led the migration of our tracking pipeline to a "
+    "streaming architecture, which cut the delay on delivery estimates from hours to seconds. I would love to "
+    "bring that experience to your team."
+)
+
+
+class UpstreamBehaviour:
+    """
+    Latency and failures of one stubbed upstream.
+
+    Args:
+    - latency: Seconds every request takes.
+    - jitter: Up to this many extra seconds, drawn uniformly per request.
+    - error_rate: Probability that a request fails with the upstream's error status.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def wait(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def fails(self):
+        return random.random() < self.error_rate
+
+
+class StubState:
+    def __init__(self, behaviours, targets=(), task_delay=None):
+        self.behaviours = behaviours
+        self.targets = itertools.cycle(list(targets)) if targets else None
+        self.task_delay = task_delay
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {upstream: {"requests": 0, "errors": 0} for upstream in UPSTREAMS}
+            self.tasks = {"created": 0, "succeeded": 0, "failed": 0, "attempts": 0, "pending": 0, "duplicates": 0,
+                          "latencies": []}
+            self.task_names = set()
+
+    def count(self, upstream, failed):
+        with self.lock:
+            self.counters[upstream]["requests"] += 1
+            if failed:
+                self.counters[upstream]["errors"] += 1
+
+    def next_target(self):
+        with self.lock:
+            return next(self.targets)
+
+    def stats(self):
+        with self.lock:
+            return {"upstreams": json.loads(json.dumps(self.counters)), "tasks": dict(self.tasks)}
+
+    def create_task(self, task):
+        # Returns the task's name and whether it was created. Like Cloud Tasks, a task name can only be used once.
+        task_id = task.get("name") or uuid.uuid4().hex
+        name = f"projects/loadtest/locations/local/queues/cover-letter-queue/tasks/{task_id}"
+        delay = task.get("delay_seconds", 0) if self.task_delay is None else self.task_delay
+        with self.lock:
+            if name in self.task_names:
+                self.tasks["duplicates"] += 1
+                return name, False
+            self.task_names.add(name)
+            self.tasks["created"] += 1
+            self.tasks["pending"] += 1
+        timer = threading.Timer(delay, self.dispatch_task,
+                                args=(name, task, time.monotonic(), 0, time.time() + delay))
+        timer.daemon = True
+        timer.start()
+        return name, True
+
+    def dispatch_task(self, name, task, created, attempt, eta):
+        # Deliver a task like App Engine routing would, retrying non-2xx answers with doubling backoff. A 429 or
+        # 503 with Retry-After waits at least that long.
+        headers = dict(task.get("headers", {}))
+        headers.update({"X-CloudTasks-TaskName": name.rsplit("/", 1)[-1],
+                        "X-CloudTasks-TaskRetryCount": str(attempt),
+                        "X-CloudTasks-TaskETA": f"{eta:.6f}"})
+        backoff = QUEUE_RETRY_POLICY.backoff(attempt)
+        try:
+            response = requests.post(self.next_target() + task["relative_uri"], data=task["body"].encode("utf-8"),
+                                     headers=headers, timeout=600)
+            succeeded = 200 <= response.status_code < 300
+            if response.status_code in (429, 503) and response.headers.get("Retry-After", "").isdigit():
+                backoff = max(backoff, int(response.headers["Retry-After"]))
+        except requests.RequestException:
+            succeeded = False
+        with self.lock:
+            self.tasks["attempts"] += 1
+            if succeeded or QUEUE_RETRY_POLICY.gives_up(attempt, time.monotonic() - created):
+                self.tasks["pending"] -= 1
+                self.tasks["succeeded" if succeeded else "failed"] += 1
+                self.tasks["latencies"].append(time.monotonic() - created)
+                return
+        timer = threading.Timer(backoff * TASK_TIME_SCALE, self.dispatch_task,
+                                args=(name, task, created, attempt + 1, time.time() + backoff * TASK_TIME_SCALE))
+        timer.daemon = True
+        timer.start()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "LoadtestStub/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def upstream(self, path):
+        if path.startswith("/v1/"):
+            return "openai"
+        if path.startswith("/v2/translate"):
+            return "deepl"
+        if path.startswith("/v3/"):
+            return "mailgun"
+        if path.startswith("/tasks"):
+            return "tasks"
+        if path.startswith("/pages/"):
+            return "pages"
+        return None
+
+    def handle_stub(self, method):
+        state = self.server.state
+        path = urlsplit(self.path).path
+        if path == "/stats" and method == "GET":
+            return self.send_json(200, state.stats())
+        if path == "/reset" and method == "POST":
+            state.reset()
+            return self.send_json(200, {"reset": True})
+
+        upstream = self.upstream(path)
+        if upstream is None:
+            return self.send_json(404, {"error": f"No stub for {path}"})
+        body = self.read_body()
+        behaviour = state.behaviours[upstream]
+        behaviour.wait()
+        failed = behaviour.fails()
+        state.count(upstream, failed)
+        if failed:
+            return self.send_json(ERROR_STATUSES[upstream], {"error": {"message": "Stubbed failure"}},
+                                  headers={"Retry-After": "1"})
+        getattr(self, f"handle_{upstream}")(path, body)
+
+    def do_GET(self):
+        self.handle_stub("GET")
+
+    def do_POST(self):
+        self.handle_stub("POST")
+
+    def handle_openai(self, path, body):
+        request_data = json.loads(body or b"{}")
+        prompt_tokens = sum(len(message.get("content", "")) for message in request_data.get("messages", [])) // 4
+        completion_tokens = len(COMPLETION_TEXT) // 4
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = request_data.get("model", "gpt-3.5-turbo")
+        if not request_data.get("stream"):
+            return self.send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": COMPLETION_TEXT},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+
+        # Streamed completions go out word by word and close the connection at the end
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        words = COMPLETION_TEXT.split(" ")
+        for index, word in enumerate(words):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [{"index": 0, "delta": {"content": word if index == 0 else " " + word},
+                                                  "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        final = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+
+    def handle_deepl(self, path, body):
+        request_data = json.loads(body or b"{}")
+        self.send_json(200, {"translations": [{"detected_source_language": "DE", "text": f"[EN] {text}"}
+                                              for text in request_data.get("text", [])]})
+
+    def handle_mailgun(self, path, body):
+        self.send_json(200, {"id": f"<{uuid.uuid4().hex}@stub.mailgun>", "message": "Queued. Thank you."})
+
+    def handle_tasks(self, path, body):
+        if self.server.state.targets is None:
+            return self.send_json(400, {"error": "The tasks stub has no --target to dispatch to"})
+        name, created = self.server.state.create_task(json.loads(body))
+        if not created:
+            return self.send_json(409, {"error": "Requested entity already exists", "name": name})
+        self.send_json(200, {"name": name})
+
+    def handle_pages(self, path, body):
+        page_path = os.path.join(PAGES_DIR, os.path.basename(path) + ".html")
+        if not os.path.exists(page_path):
+            return self.send_json(404, {"error": "No such page"})
+        with open(page_path, "rb") as page_file:
+            page = page_file.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, port, behaviours, targets=(), task_delay=None, host="127.0.0.1"):
+        super().__init__((host, port), StubHandler)
+        self.state = StubState(behaviours, targets, task_delay)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="loadtest-stubs", daemon=True)
+        thread.start()
+        return thread
+
+    def app_environment(self):
+        # Environment that points app.py at these stubs instead of the real services
+        return {
+            "COVERLETTER_OFFLINE": "true",
+            "OPENAI_API_BASE": f"{self.url}/v1",
+            "DEEPL_API_ENDPOINT": f"{self.url}/v2/translate",
+            "MAILGUN_BACKEND": "mailgun",
+            "MAILGUN_API_ENDPOINT": f"{self.url}/v3/mg.myaiguy.net/messages",
+            "CLOUD_TASKS_STUB_URL": f"{self.url}/tasks",
+        }
+
+
+def parse_settings(values, option):
+    # "openai=1.5" pairs into {"openai": 1.5}
+    settings = {}
+    for value in values or []:
+        upstream, _, number = value.partition("=")
+        if upstream not in UPSTREAMS:
+            raise argparse.ArgumentTypeError(f"{option}: unknown upstream {upstream}, choose from {UPSTREAMS}")
+        settings[upstream] = float(number)
+    return settings
+
+
+def add_stub_arguments(parser):
+    parser.add_argument("--latency", action="append", metavar="UPSTREAM=SECONDS",
+                        help="Latency of an upstream, e.g. openai=1.5. Can be repeated.")
+    parser.add_argument("--jitter", action="append", metavar="UPSTREAM=SECONDS",
+                        help="Extra random latency of up to this many seconds")
+    parser.add_argument("--error-rate", action="append", metavar="UPSTREAM=FRACTION",
+                        help="Fraction of requests that fail, e.g. openai=0.05")
+    parser.add_argument("--task-delay", type=float,
+                        help="Dispatch tasks after this many seconds instead of the delay they were created with")
+
+
+def behaviours_from_arguments(args):
+    latency = parse_settings(args.latency, "--latency")
+    jitter = parse_settings(args.jitter, "--jitter")
+    error_rate = parse_settings(args.error_rate, "--error-rate")
+    return {upstream: UpstreamBehaviour(latency.get(upstream, 0.0), jitter.get(upstream, 0.0),
+                                        error_rate.get(upstream, 0.0))
+            for upstream in UPSTREAMS}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--target", action="append", default=[],
+                        help="Base URL of an app instance that tasks are dispatched to. Can be repeated.")
+    add_stub_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server = StubServer(args.port, behaviours_from_arguments(args), args.target, args.task_delay)
+    print(f"Stubs listening on {server.url}. Point the app at them with:")
+    for key, value in server.app_environment().items():
+        print(f"  export {key}={value}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
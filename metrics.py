@@ -0,0 +1,91 @@
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Upper bounds in seconds. The top ones matter because a whole letter has to finish within gunicorn's 150s.
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 150)
+
+# Under gunicorn, PROMETHEUS_MULTIPROC_DIR is set before the workers start (gunicorn.conf.py). Every worker then
+# writes its counters and histograms to files there, and a scrape adds up all of them, whichever worker serves it.
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+# Counters and histograms updated as things happen
+registry = CollectorRegistry()
+# Statistics the components of this process already keep (caches, pools), collected on every scrape
+component_stats = CollectorRegistry()
+
+stage_seconds = Histogram(
+    "coverletter_stage_seconds", "Duration of each generation stage", ["stage"], buckets=DEFAULT_BUCKETS,
+    registry=registry)
+stage_errors = Counter(
+    "coverletter_stage_errors_total", "Stages that ended with an exception", ["stage", "error"], registry=registry)
+openai_tokens = Counter(
+    "coverletter_openai_tokens_total",
+    "OpenAI tokens used. Streamed completions report no usage, so theirs are estimated (source=estimate).",
+    ["model", "kind", "source"], registry=registry)
+http_requests = Counter(
+    "coverletter_http_requests_total", "Requests served", ["endpoint", "method", "status"], registry=registry)
+http_request_seconds = Histogram(
+    "coverletter_http_request_seconds", "Time to serve a request", ["endpoint"], buckets=DEFAULT_BUCKETS,
+    registry=registry)
+task_queue_seconds = Histogram(
+    "coverletter_task_queue_seconds", "Time task attempts waited in the queue past the time they were due",
+    ["backend"], buckets=DEFAULT_BUCKETS, registry=registry)
+
+
+def render_metrics():
+    # The Prometheus text format of every metric
+    if MULTIPROCESS:
+        scraped = CollectorRegistry()
+        multiprocess.MultiProcessCollector(scraped)
+    else:
+        scraped = registry
+    return generate_latest(scraped) + generate_latest(component_stats)
+
+
+class StatsCollector:
+    """
+    Collector for statistics kept by other components. get_stats returns {component name: {field: number}}.
+
+    Every numeric field becomes a <prefix>_<field>_total counter labelled with the component name, except the
+    fields in gauges, which become <prefix>_<field> gauges. The components keep their statistics in memory, so
+    with several worker processes each sample is also labelled with the pid of the worker that served the scrape.
+    """
+
+    def __init__(self, prefix, documentation, get_stats, labelname, gauges=()):
+        self.prefix = prefix
+        self.documentation = documentation
+        self.get_stats = get_stats
+        self.labelname = labelname
+        self.gauges = gauges
+
+    def collect(self):
+        try:
+            stats_by_component = self.get_stats()
+        except Exception as e:
+            print(f"Metrics collector {self.prefix} failed: {e}")
+            return []
+        labelnames = [self.labelname] + (["pid"] if MULTIPROCESS else [])
+        extra = [str(os.getpid())] if MULTIPROCESS else []
+        families = {}
+        for component, stats in stats_by_component.items():
+            for field, value in sorted(stats.items()):
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                family = families.get(field)
+                if family is None:
+                    name = f"{self.prefix}_{field}"
+                    documentation = f"{self.documentation}: {field.replace('_', ' ')}"
+                    if field in self.gauges:
+                        family = GaugeMetricFamily(name, documentation, labels=labelnames)
+                    else:
+                        family = CounterMetricFamily(name, documentation, labels=labelnames)
+                    families[field] = family
+                family.add_metric([str(component)] + extra, value)
+        return [families[field] for field in sorted(families)]
+
+
+def stats_collector(prefix, documentation, get_stats, labelname, gauges=()):
+    # Report the statistics of a component on /metrics
+    component_stats.register(StatsCollector(prefix, documentation, get_stats, labelname, gauges))
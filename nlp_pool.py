@@ -0,0 +1,279 @@
+"""
+Scoring of company page sentences, and a small pool of NLP processes that the web workers of an instance share.
+
+Loading the spaCy model in every gunicorn worker costs a copy of it per worker. With the pool, one server process
+loads the model and forks its worker processes from there, and the web workers send their sentence batches to it
+over a Unix socket. gunicorn.conf.py starts the server when gunicorn starts. It can also be run on its own:
+
+    NLP_POOL_AUTHKEY=<hex> python -m nlp_pool --address /tmp/coverletter-nlp.sock
+"""
+import argparse
+import multiprocessing
+import os
+import re
+import signal
+import socket
+import stat
+import sys
+import threading
+import time
+from multiprocessing import connection
+
+# Keywords that hint a sentence talks about the company itself
+CONTENT_KEYWORDS = ["about", "mission", "vision", "history", "company", "founded", "established", "believe", "our goal",
+                    "we aim", "we strive"]
+# Entity labels that count towards a sentence's score
+CONTENT_ENTITY_LABELS = {"ORG", "DATE"}
+# One pass matcher for all keywords. The lookahead lets matches of different keywords overlap, and since no keyword
+# is a prefix of another or overlaps itself, the number of matches equals the sum of the per-keyword str.count calls.
+CONTENT_KEYWORD_PATTERN = re.compile("(?=(" + "|".join(re.escape(keyword) for keyword in CONTENT_KEYWORDS) + "))")
+SCORING_BATCH_SIZE = 256
+
+
+def score_texts(nlp, texts):
+    # Only NER contributes to the score. In en_core_web_sm the NER component has its own tok2vec layer,
+    # so disabling the rest of the pipeline leaves the entities unchanged.
+    disabled = [pipe_name for pipe_name in nlp.pipe_names if pipe_name != "ner"]
+    scores = []
+    for text, doc in zip(texts, nlp.pipe(texts, disable=disabled, batch_size=SCORING_BATCH_SIZE)):
+        # Score based on keywords and named entities
+        keyword_score = len(CONTENT_KEYWORD_PATTERN.findall(text.lower()))
+        named_entity_score = sum(1 for ent in doc.ents if ent.label_ in CONTENT_ENTITY_LABELS)
+        scores.append(keyword_score + named_entity_score)
+    return scores
+
+
+class NLPPoolError(RuntimeError):
+    pass
+
+
+class NLPPoolBusy(NLPPoolError):
+    pass
+
+
+class NLPClient:
+    """
+    Sends sentence batches to an NLPServer. Every thread keeps a connection of its own.
+
+    Args:
+    - timeout: Seconds to wait for the scores of a batch. The connection is dropped after a timeout, so a late
+      answer can't be taken for the answer to the next batch.
+    """
+
+    def __init__(self, address, authkey, timeout=10.0):
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.counters = {"batches": 0, "busy": 0, "timeouts": 0, "errors": 0}
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def connection(self):
+        conn = getattr(self.local, "connection", None)
+        if conn is None:
+            try:
+                conn = connection.Client(self.address, family="AF_UNIX", authkey=self.authkey)
+            except (OSError, EOFError, connection.AuthenticationError) as e:
+                raise NLPPoolError(f"The NLP pool at {self.address} isn't reachable: {e}")
+            self.local.connection = conn
+        return conn
+
+    def drop_connection(self):
+        conn = getattr(self.local, "connection", None)
+        self.local.connection = None
+        if conn is not None:
+            conn.close()
+
+    def request(self, message, timeout):
+        conn = self.connection()
+        try:
+            conn.send(message)
+            if not conn.poll(timeout):
+                self.drop_connection()
+                self.count("timeouts")
+                raise NLPPoolError(f"The NLP pool didn't answer within {timeout:g}s")
+            status, value = conn.recv()
+        except (OSError, EOFError) as e:
+            self.drop_connection()
+            self.count("errors")
+            raise NLPPoolError(f"Lost the connection to the NLP pool: {e}")
+        if status == "busy":
+            self.count("busy")
+            raise NLPPoolBusy(value)
+        if status != "ok":
+            self.count("errors")
+            raise NLPPoolError(value)
+        return value
+
+    def score(self, texts):
+        self.count("batches")
+        return self.request(("score", list(texts)), self.timeout)
+
+    def wait_ready(self, timeout):
+        # The server only accepts connections once its model is loaded, so the first answered ping means it is ready
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.request(("ping", None), max(deadline - time.monotonic(), 0.1))
+            except NLPPoolError:
+                self.drop_connection()
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.25)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+# The server's model, inherited by the pool processes it forks
+worker_nlp = None
+
+
+def score_in_worker(texts):
+    return score_texts(worker_nlp, texts)
+
+
+class NLPServer:
+    """
+    Scores sentence batches for the web workers of an instance.
+
+    Args:
+    - processes: Number of scoring processes. They are forked after the model is loaded, so they start out sharing
+      its memory.
+    - max_pending: Batches queued or being scored at once. Further batches are turned away as busy right away
+      rather than queueing behind work that may outlast the caller's timeout.
+    - job_timeout: Seconds after which the server gives up on a batch, e.g. when a scoring process died.
+    - parent_pid: Exit once this process is gone, so the server doesn't outlive a gunicorn master that was killed
+      without running its exit hook.
+    """
+
+    def __init__(self, address, authkey, model_path, processes=1, max_pending=16, job_timeout=30.0,
+                 parent_pid=None):
+        self.address = address
+        self.authkey = authkey
+        self.model_path = model_path
+        self.processes = processes
+        self.max_pending = max_pending
+        self.job_timeout = job_timeout
+        self.parent_pid = parent_pid
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.pool = None
+        self.listener = None
+
+    def serve(self):
+        global worker_nlp
+        import spacy
+
+        # Bind first, so a bad address fails before the model is loaded. Connections made meanwhile wait for the
+        # model, since they are only accepted once it is loaded.
+        remove_stale_socket(self.address)
+        self.listener = connection.Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        started = time.perf_counter()
+        worker_nlp = spacy.load(self.model_path)
+        # Fork the pool before any other thread exists
+        self.pool = multiprocessing.get_context("fork").Pool(self.processes)
+        print(f"NLP pool loaded {self.model_path} in {time.perf_counter() - started:.2f}s, "
+              f"{self.processes} processes, listening on {self.address}", flush=True)
+
+        if self.parent_pid is not None:
+            threading.Thread(target=exit_with_parent, args=(self.parent_pid,), name="nlp-pool-parent",
+                             daemon=True).start()
+        try:
+            while True:
+                try:
+                    conn = self.listener.accept()
+                except connection.AuthenticationError as e:
+                    print(f"NLP pool rejected a connection: {e}", flush=True)
+                    continue
+                except (OSError, EOFError) as e:
+                    # The client went away during the handshake, e.g. it gave up while the model was loading
+                    print(f"NLP pool lost a connection before it was set up: {e}", flush=True)
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), name="nlp-pool-connection", daemon=True).start()
+        finally:
+            self.close()
+
+    def handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    kind, payload = conn.recv()
+                    conn.send(self.respond(kind, payload))
+                except (OSError, EOFError):
+                    return
+
+    def respond(self, kind, payload):
+        if kind == "ping":
+            return "ok", None
+        if kind != "score":
+            return "error", f"Unknown request {kind}"
+        if not self.pending.acquire(blocking=False):
+            return "busy", f"The NLP pool already has {self.max_pending} batches pending"
+        try:
+            return "ok", self.pool.apply_async(score_in_worker, (payload,)).get(self.job_timeout)
+        except multiprocessing.TimeoutError:
+            return "error", f"Scoring took longer than {self.job_timeout:g}s"
+        except Exception as e:
+            return "error", f"Scoring failed: {type(e).__name__}: {e}"
+        finally:
+            self.pending.release()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+        if self.pool is not None:
+            self.pool.terminate()
+
+
+def remove_stale_socket(address):
+    # A server that was killed, e.g. for running out of memory, leaves its socket file behind, and binding the
+    # address again would fail with EADDRINUSE. A socket nobody listens on any more refuses connections.
+    if not os.path.exists(address) or not stat.S_ISSOCK(os.stat(address).st_mode):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(address)
+    except ConnectionRefusedError:
+        print(f"Removing the stale NLP pool socket {address}", flush=True)
+        os.unlink(address)
+        return
+    finally:
+        probe.close()
+    raise RuntimeError(f"Another NLP pool is already listening on {address}")
+
+
+def exit_with_parent(parent_pid, interval=5.0):
+    while os.getppid() == parent_pid:
+        time.sleep(interval)
+    # Shut down the same way as on SIGTERM, which also stops the pool processes
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--address", default=os.environ.get("NLP_POOL_ADDRESS"),
+                        help="Unix socket to listen on. Defaults to NLP_POOL_ADDRESS.")
+    parser.add_argument("--model", default=os.environ.get(
+        "NLP_MODEL_PATH", "spacy_models/en_core_web_sm/en_core_web_sm-3.6.0"))
+    parser.add_argument("--processes", type=int, default=int(os.environ.get("NLP_POOL_PROCESSES", 1)))
+    parser.add_argument("--max-pending", type=int, default=int(os.environ.get("NLP_POOL_MAX_PENDING", 16)))
+    parser.add_argument("--job-timeout", type=float, default=float(os.environ.get("NLP_POOL_JOB_TIMEOUT", 30)))
+    args = parser.parse_args(argv)
+    if not args.address or not os.environ.get("NLP_POOL_AUTHKEY"):
+        parser.error("Set --address (or NLP_POOL_ADDRESS) and NLP_POOL_AUTHKEY")
+
+    # SIGTERM from the gunicorn exit hook unwinds serve(), which removes the socket and stops the pool
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = NLPServer(args.address, bytes.fromhex(os.environ["NLP_POOL_AUTHKEY"]), args.model,
+                       processes=args.processes, max_pending=args.max_pending, job_timeout=args.job_timeout,
+                       parent_pid=os.getppid())
+    server.serve()
+
+
+if __name__ == "__main__":
+    main()
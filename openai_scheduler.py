@@ -0,0 +1,260 @@
+import asyncio
+import email.utils
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+# Lower numbers go first. Revision passes finish letters that already paid for their draft.
+PRIORITY_REVISION = 0
+PRIORITY_DRAFT = 1
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.TryAgain,
+)
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        # Seconds until amount tokens are available. Requests larger than the bucket only wait for a full one.
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        # Negative amounts charge requests that used more than estimated
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def retry_after_seconds(error):
+    # Retry-After is either a number of seconds or an HTTP date
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value)
+        return max(0.0, parsed.timestamp() - time.time()) if parsed else None
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    # 5xx API errors are transient, 4xx ones (bad request, auth) are not
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+
+class OpenAIScheduler:
+    """
+    Client side scheduler for OpenAI requests.
+
+    Requests wait for both a requests-per-minute and a tokens-per-minute bucket, and are admitted in priority
+    order. Failed requests are retried with exponential backoff and jitter, honouring Retry-After. A rate limit
+    error pauses every request of the process, since they all share the same account limits.
+
+    Args:
+    - requests_per_minute, tokens_per_minute: This process's share of the account limits.
+    - max_attempts: Default number of attempts per request, the first one included.
+    - base_delay, max_delay: Default bounds in seconds for the backoff between retries.
+    - async_waiters: Threads that wait for admission on behalf of run_async. They are the scheduler's own, so
+      coroutines held back by the rate limits don't take up the event loop's default executor.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, max_attempts=5, base_delay=1.0, max_delay=30.0,
+                 async_waiters=32):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.counters = {"requests": 0, "retries": 0, "rate_limited": 0, "failed": 0}
+        self.async_waiters = ThreadPoolExecutor(max_workers=async_waiters, thread_name_prefix="openai-admission")
+
+    def acquire(self, estimated_tokens, priority, cancelled=None):
+        # cancelled is an Event that gives up the wait once set (see acquire_async)
+        with self.condition:
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    if cancelled is not None and cancelled.is_set():
+                        raise asyncio.CancelledError()
+                    wait = None
+                    if self.waiting[0] == ticket:
+                        now = time.monotonic()
+                        wait = max(self.paused_until - now,
+                                   self.request_bucket.wait_time(1, now),
+                                   self.token_bucket.wait_time(estimated_tokens, now))
+                        if wait <= 0:
+                            heapq.heappop(self.waiting)
+                            self.request_bucket.take(1)
+                            self.token_bucket.take(estimated_tokens)
+                            self.in_flight += 1
+                            self.counters["requests"] += 1
+                            self.condition.notify_all()
+                            return
+                    self.condition.wait(wait)
+            except BaseException:
+                if ticket in self.waiting:
+                    self.waiting.remove(ticket)
+                    heapq.heapify(self.waiting)
+                    self.condition.notify_all()
+                raise
+
+    async def acquire_async(self, estimated_tokens, priority):
+        # acquire on one of the scheduler's threads, so the event loop keeps running while the request waits
+        cancelled = threading.Event()
+        future = self.async_waiters.submit(self.acquire, estimated_tokens, priority, cancelled)
+        try:
+            await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The waiting thread carries on after the coroutine is cancelled. Stop its wait, and give the slot back
+            # if it was granted all the same.
+            with self.condition:
+                cancelled.set()
+                self.condition.notify_all()
+            future.add_done_callback(lambda done: self.release_unclaimed(done, estimated_tokens))
+            raise
+
+    def release_unclaimed(self, future, estimated_tokens):
+        if not future.cancelled() and future.exception() is None:
+            self.release(estimated_tokens)
+
+    def release(self, estimated_tokens, used_tokens=None):
+        with self.condition:
+            self.in_flight -= 1
+            if used_tokens is not None:
+                self.token_bucket.refund(estimated_tokens - used_tokens)
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.condition.notify_all()
+
+    def backoff(self, attempt, base_delay):
+        ceiling = min(self.max_delay, base_delay * 2 ** attempt)
+        return random.uniform(ceiling / 2, ceiling)
+
+    def run(self, request_function, estimated_tokens=1000, priority=PRIORITY_DRAFT, max_attempts=None,
+            base_delay=None):
+        max_attempts = max_attempts or self.max_attempts
+        base_delay = self.base_delay if base_delay is None else base_delay
+        for attempt in range(max_attempts):
+            self.acquire(estimated_tokens, priority)
+            used_tokens = None
+            try:
+                response = request_function()
+                usage = response.get("usage") if hasattr(response, "get") else None
+                if usage:
+                    used_tokens = usage.get("total_tokens")
+                return response
+            except Exception as e:
+                if not is_retryable(e) or attempt == max_attempts - 1:
+                    self.count("failed")
+                    raise
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = self.backoff(attempt, base_delay)
+                if isinstance(e, openai.error.RateLimitError):
+                    self.count("rate_limited")
+                    self.pause(delay)
+                self.count("retries")
+                print(f"OpenAI request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            finally:
+                self.release(estimated_tokens, used_tokens)
+            time.sleep(delay)
+
+    async def run_async(self, request_function, estimated_tokens=1000, priority=PRIORITY_DRAFT, max_attempts=None,
+                        base_delay=None):
+        # Same as run for a coroutine function. Both serving modes share the same buckets and queue.
+        max_attempts = max_attempts or self.max_attempts
+        base_delay = self.base_delay if base_delay is None else base_delay
+        for attempt in range(max_attempts):
+            await self.acquire_async(estimated_tokens, priority)
+            used_tokens = None
+            try:
+                response = await request_function()
+                usage = response.get("usage") if hasattr(response, "get") else None
+                if usage:
+                    used_tokens = usage.get("total_tokens")
+                return response
+            except Exception as e:
+                if not is_retryable(e) or attempt == max_attempts - 1:
+                    self.count("failed")
+                    raise
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = self.backoff(attempt, base_delay)
+                if isinstance(e, openai.error.RateLimitError):
+                    self.count("rate_limited")
+                    self.pause(delay)
+                self.count("retries")
+                print(f"OpenAI request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            finally:
+                self.release(estimated_tokens, used_tokens)
+            await asyncio.sleep(delay)
+
+    def count(self, counter):
+        with self.condition:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats["in_flight"] = self.in_flight
+            stats["waiting"] = len(self.waiting)
+        return stats
+
+
+def estimate_tokens(messages, completion_tokens=600):
+    # Roughly four characters per token for English text, plus room for the completion
+    return sum(len(message["content"]) for message in messages) // 4 + completion_tokens
+
+
+def truncate_to_tokens(text, max_tokens):
+    # Cut text down to about max_tokens by the same estimate, at a word boundary when there is one nearby
+    max_chars = max_tokens * 4
+    if not text or len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    boundary = cut.rfind(" ")
+    return (cut[:boundary] if boundary > max_chars // 2 else cut).rstrip()
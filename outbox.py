@@ -0,0 +1,212 @@
+import contextvars
+import heapq
+import itertools
+import random
+import threading
+import time
+import uuid
+from tracing import span
+
+DOCX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+ZIP_MIME_TYPE = "application/zip"
+
+
+class DeliveryError(Exception):
+    """
+    A message that wasn't accepted. Permanent errors (bad address, rejected payload) are not retried.
+    """
+
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+class EmailMessage:
+    def __init__(self, to, subject, text, attachments, sender):
+        # attachments is a list of (filename, bytes, mime type) tuples
+        self.id = uuid.uuid4().hex
+        self.to = to
+        self.subject = subject
+        self.text = text
+        self.attachments = attachments
+        self.sender = sender
+
+
+class MailgunTransport:
+    def __init__(self, http_client, endpoint, api_key):
+        self.http_client = http_client
+        self.endpoint = endpoint
+        self.api_key = api_key
+
+    def send(self, message):
+        response = self.http_client.post(
+            "mailgun",
+            self.endpoint,
+            auth=("api", self.api_key),
+            files=[("attachment", attachment) for attachment in message.attachments],
+            data={"from": message.sender, "to": message.to, "subject": message.subject, "text": message.text}
+        )
+        if response.status_code == 200:
+            return response.json()
+        # Mailgun rejects bad requests with 4xx for good, except for rate limiting
+        permanent = 400 <= response.status_code < 500 and response.status_code != 429
+        raise DeliveryError(f"Error occurred while sending the email: {response.text}", permanent=permanent)
+
+
+class FakeMailgun:
+    """
+    Local stand-in for Mailgun that keeps the messages it accepts.
+
+    Args:
+    - failures: Number of sends that fail before the first one succeeds.
+    - failure_rate: Probability that any later send fails.
+    - latency: Seconds each send takes.
+    """
+
+    def __init__(self, failures=0, failure_rate=0.0, latency=0.0):
+        self.failures = failures
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        time.sleep(self.latency)
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise DeliveryError("Fake Mailgun failure")
+            if random.random() < self.failure_rate:
+                raise DeliveryError("Fake Mailgun failure")
+            self.sent.append(message)
+        return {"id": f"<{message.id}@fake.mailgun>", "message": "Queued. Thank you."}
+
+
+class Outbox:
+    """
+    Delivers emails from background workers, so a request can return as soon as its message is queued.
+
+    Failed deliveries are retried with exponential backoff and jitter. on_delivered(response) runs once the
+    transport accepted a message, on_failed(error) once it is given up on.
+
+    Args:
+    - transport: Object with a send(message) method that raises DeliveryError on failure.
+    - workers: Number of delivery threads.
+    - max_attempts: Attempts per message before it is given up on.
+    - base_delay, max_delay: Bounds in seconds for the backoff between attempts.
+    """
+
+    def __init__(self, transport, workers=2, max_attempts=5, base_delay=2.0, max_delay=60.0):
+        self.transport = transport
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        # Heap of (ready at, sequence, message, callbacks, attempt, context)
+        self.scheduled = []
+        self.sequence = itertools.count()
+        self.in_progress = 0
+        self.closed = False
+        self.counters = {"queued": 0, "delivered": 0, "retried": 0, "failed": 0}
+        self.workers = [threading.Thread(target=self.work, name=f"outbox-{index}", daemon=True)
+                        for index in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, message, on_delivered=None, on_failed=None):
+        # Deliveries run in the submitter's context, so their spans belong to the request that sent the email
+        self.schedule(message, (on_delivered, on_failed), attempt=0, delay=0, context=contextvars.copy_context())
+        self.count("queued")
+        return message.id
+
+    def schedule(self, message, callbacks, attempt, delay, context):
+        with self.condition:
+            heapq.heappush(self.scheduled, (time.monotonic() + delay, next(self.sequence), message, callbacks,
+                                            attempt, context))
+            self.condition.notify_all()
+
+    def next_message(self):
+        with self.condition:
+            while True:
+                if self.closed and not self.scheduled:
+                    return None
+                if self.scheduled:
+                    wait = self.scheduled[0][0] - time.monotonic()
+                    if wait <= 0:
+                        self.in_progress += 1
+                        return heapq.heappop(self.scheduled)[2:]
+                else:
+                    wait = None
+                self.condition.wait(wait)
+
+    def work(self):
+        while True:
+            item = self.next_message()
+            if item is None:
+                return
+            message, callbacks, attempt, context = item
+            try:
+                context.run(self.deliver, message, callbacks, attempt, context)
+            finally:
+                with self.condition:
+                    self.in_progress -= 1
+                    self.condition.notify_all()
+
+    def deliver(self, message, callbacks, attempt, context):
+        on_delivered, on_failed = callbacks
+        try:
+            with span("email", attempt=attempt + 1):
+                response = self.transport.send(message)
+        except Exception as e:
+            permanent = getattr(e, "permanent", False)
+            if permanent or attempt + 1 >= self.max_attempts:
+                print(f"Giving up on email {message.id} to {message.to} after {attempt + 1} attempts: {e}")
+                self.count("failed")
+                run_callback(on_failed, e)
+                return
+            delay = random.uniform(0.5, 1) * min(self.max_delay, self.base_delay * 2 ** attempt)
+            print(f"Email {message.id} failed ({e}), retrying in {delay:.1f}s")
+            self.count("retried")
+            self.schedule(message, callbacks, attempt + 1, delay, context)
+            return
+
+        print(f"Email {message.id} sent successfully!")
+        self.count("delivered")
+        run_callback(on_delivered, response)
+
+    def count(self, counter):
+        with self.condition:
+            self.counters[counter] += 1
+
+    def flush(self, timeout=None):
+        # Wait until every queued message was delivered or given up on
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.scheduled or self.in_progress:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join(timeout)
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats["pending"] = len(self.scheduled) + self.in_progress
+        return stats
+
+
+def run_callback(callback, argument):
+    if callback is None:
+        return
+    try:
+        callback(argument)
+    except Exception as e:
+        print(f"Outbox callback failed: {e}")
@@ -0,0 +1,187 @@
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Query parameters that only track where a visitor came from and never change the page content
+TRACKING_PARAMETERS = {"gclid", "fbclid", "mc_cid", "mc_eid", "ref", "igshid"}
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    # Lower-case scheme and host, drop default ports, fragments and tracking parameters, sort the query
+    url = url.strip()
+    if "://" not in url:
+        url = "https://" + url
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    path = parts.path or "/"
+    if len(path) > 1:
+        path = path.rstrip("/")
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith("utm_") and key.lower() not in TRACKING_PARAMETERS
+    )
+    return urlunsplit((scheme, host, path, urlencode(query), ""))
+
+
+def cache_key(url):
+    return hashlib.sha256(normalize_url(url).encode("utf-8")).hexdigest()
+
+
+class DiskPageCache:
+    """
+    Page cache entries stored as one JSON file per URL.
+
+    The file modification time doubles as the last access time, so the least recently used entries are the ones
+    removed once there are more than max_entries files.
+    """
+
+    def __init__(self, directory, max_entries=500):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as cache_file:
+                entry = json.load(cache_file)
+            os.utime(path, None)
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, entry):
+        path = self.path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as cache_file:
+            json.dump(entry, cache_file)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            try:
+                entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                           if name.endswith(".json")]
+            except OSError:
+                return
+            if len(entries) <= self.max_entries:
+                return
+            entries.sort(key=lambda path: os.stat(path).st_mtime if os.path.exists(path) else 0)
+            for path in entries[:len(entries) - self.max_entries]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+class FirestorePageCache:
+    """
+    Shared page cache tier so every instance benefits from a page fetched by any of them.
+
+    Each entry carries an expires_at timestamp that a Firestore TTL policy on the collection can use to
+    delete old pages.
+    """
+
+    def __init__(self, db, collection="page_cache", retention_seconds=7 * 24 * 3600):
+        self.collection = db.collection(collection)
+        self.retention_seconds = retention_seconds
+
+    def get(self, key):
+        try:
+            snapshot = self.collection.document(key).get()
+        except Exception as e:
+            print(f"Failed to read the shared page cache: {e}")
+            return None
+        if not snapshot.exists:
+            return None
+        entry = snapshot.to_dict()
+        entry.pop("expires_at", None)
+        return entry
+
+    def set(self, key, entry):
+        document = dict(entry)
+        document["expires_at"] = datetime.datetime.fromtimestamp(time.time() + self.retention_seconds,
+                                                                 tz=datetime.timezone.utc)
+        try:
+            self.collection.document(key).set(document)
+        except Exception as e:
+            print(f"Failed to write the shared page cache: {e}")
+
+
+class PageCache:
+    """
+    Two tier cache of fetched company pages.
+
+    Args:
+    - local: The per-instance backend, checked first.
+    - shared: Optional backend shared by all instances. Hits are copied into the local tier.
+    - ttl: Seconds an entry is served without asking the origin again. Older entries are revalidated with their
+      ETag/Last-Modified validators when they have them.
+    """
+
+    def __init__(self, local, shared=None, ttl=24 * 3600):
+        self.local = local
+        self.shared = shared
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def lookup(self, url):
+        # Returns (entry, fresh). entry is None on a miss, fresh is False once the TTL has passed.
+        key = cache_key(url)
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None, False
+        fresh = time.time() - entry.get("validated_at", 0) < self.ttl
+        if fresh:
+            self.hits += 1
+        return entry, fresh
+
+    def store(self, url, paragraphs, relevant_content, etag=None, last_modified=None):
+        now = time.time()
+        entry = {
+            "url": normalize_url(url),
+            "paragraphs": paragraphs,
+            "relevant_content": relevant_content,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": now,
+            "validated_at": now,
+        }
+        self.write(url, entry)
+        return entry
+
+    def revalidated(self, url, entry):
+        # The origin answered 304 Not Modified, so the entry is good for another TTL
+        self.revalidations += 1
+        entry = dict(entry, validated_at=time.time())
+        self.write(url, entry)
+        return entry
+
+    def write(self, url, entry):
+        key = cache_key(url)
+        self.local.set(key, entry)
+        if self.shared is not None:
+            self.shared.set(key, entry)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "revalidations": self.revalidations}
@@ -0,0 +1,159 @@
+import threading
+import time
+from collections import namedtuple
+
+# How many committed reservation ids a user document remembers, so committing one twice counts it once
+COMMITTED_HISTORY = 20
+
+Reservation = namedtuple("Reservation", ["email", "reservation_id", "count", "remaining"])
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def active_reservations(data, now):
+    return {reservation_id: reservation for reservation_id, reservation in data.get("reservations", {}).items()
+            if reservation["expires_at"] > now}
+
+
+def reserved_count(reservations):
+    return sum(reservation["count"] for reservation in reservations.values())
+
+
+def apply_reserve(data, reservation_id, count, limit, ttl, now):
+    """
+    Reserve count letters on a user document.
+
+    Reserving an id that is already reserved (a retried task) only extends it, and an id that was already
+    committed (a replayed request) holds nothing. Expired reservations, left behind by requests that died half
+    way, are dropped and no longer hold letters.
+
+    Returns:
+    - The updated document fields and the number of letters left once the reservation is committed.
+    """
+    reservations = active_reservations(data, now)
+    num_letters = data.get("num_letters", 0)
+    if reservation_id in data.get("committed_reservations", []):
+        return {"reservations": reservations}, limit - num_letters - reserved_count(reservations)
+    if reservation_id not in reservations:
+        if num_letters + reserved_count(reservations) + count > limit:
+            raise QuotaExceeded("Your free cover letters have run out")
+    reservations[reservation_id] = {"count": count, "expires_at": now + ttl}
+    remaining = limit - num_letters - reserved_count(reservations)
+    return {"reservations": reservations}, remaining
+
+
+def apply_commit(data, reservation, limit, now, agree_promo=None):
+    # Turn a reservation into used letters. Returns the updated fields and the number of letters left.
+    reservations = active_reservations(data, now)
+    committed = data.get("committed_reservations", [])
+    num_letters = data.get("num_letters", 0)
+    reservations.pop(reservation.reservation_id, None)
+    if reservation.reservation_id not in committed:
+        num_letters += reservation.count
+        committed = (committed + [reservation.reservation_id])[-COMMITTED_HISTORY:]
+    update = {"reservations": reservations, "num_letters": num_letters, "committed_reservations": committed}
+    if agree_promo is not None and data.get("agreePromo", False) != agree_promo:
+        update["agreePromo"] = agree_promo
+    return update, limit - num_letters - reserved_count(reservations)
+
+
+def apply_release(data, reservation, now):
+    reservations = active_reservations(data, now)
+    reservations.pop(reservation.reservation_id, None)
+    return {"reservations": reservations}
+
+
+class FirestoreQuota:
+    """
+    Letter quota kept on the users/{email} documents, reserved up front and committed once a letter was delivered.
+
+    Every change runs in a Firestore transaction, so concurrent or duplicate submissions can't reserve more
+    letters than the user has left. Works the same against the Firestore emulator (FIRESTORE_EMULATOR_HOST).
+
+    Args:
+    - limit: Number of free letters per user.
+    - reservation_ttl: Seconds after which an uncommitted reservation stops holding letters.
+    """
+
+    def __init__(self, db, firestore, limit=5, reservation_ttl=900, collection="users"):
+        self.db = db
+        self.firestore = firestore
+        self.limit = limit
+        self.reservation_ttl = reservation_ttl
+        self.collection = db.collection(collection)
+
+    def run_transaction(self, email, change):
+        # change(data, exists) returns (fields to write, result). The transaction is retried on contention.
+        user_doc_ref = self.collection.document(email)
+
+        @self.firestore.transactional
+        def run(transaction):
+            snapshot = user_doc_ref.get(transaction=transaction)
+            data = snapshot.to_dict() if snapshot.exists else {}
+            update, result = change(data, snapshot.exists)
+            if snapshot.exists:
+                transaction.update(user_doc_ref, update)
+            else:
+                transaction.set(user_doc_ref, update)
+            return result
+
+        return run(self.db.transaction())
+
+    def reserve(self, email, reservation_id, count=1, name=None, agree_promo=False):
+        def change(data, exists):
+            update, remaining = apply_reserve(data, reservation_id, count, self.limit, self.reservation_ttl,
+                                              time.time())
+            if not exists:
+                update.update({"num_letters": 0, "agreePromo": agree_promo, "name": name})
+            return update, remaining
+
+        remaining = self.run_transaction(email, change)
+        return Reservation(email, reservation_id, count, remaining)
+
+    def commit(self, reservation, agree_promo=None):
+        return self.run_transaction(reservation.email, lambda data, exists: apply_commit(
+            data, reservation, self.limit, time.time(), agree_promo))
+
+    def release(self, reservation):
+        try:
+            self.run_transaction(reservation.email,
+                                 lambda data, exists: (apply_release(data, reservation, time.time()), None))
+        except Exception as e:
+            # The reservation expires on its own, so a failed release only holds the letter for a while
+            print(f"Failed to release quota reservation {reservation.reservation_id}: {e}")
+
+
+class LocalQuota:
+    """
+    In-memory letter quota with the same behaviour as FirestoreQuota, for tests and local runs.
+    """
+
+    def __init__(self, limit=5, reservation_ttl=900):
+        self.limit = limit
+        self.reservation_ttl = reservation_ttl
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, email, reservation_id, count=1, name=None, agree_promo=False):
+        with self.lock:
+            data = self.users.get(email)
+            if data is None:
+                data = {"num_letters": 0, "agreePromo": agree_promo, "name": name}
+            update, remaining = apply_reserve(data, reservation_id, count, self.limit, self.reservation_ttl,
+                                              time.time())
+            self.users[email] = dict(data, **update)
+        return Reservation(email, reservation_id, count, remaining)
+
+    def commit(self, reservation, agree_promo=None):
+        with self.lock:
+            data = self.users.get(reservation.email, {})
+            update, remaining = apply_commit(data, reservation, self.limit, time.time(), agree_promo)
+            self.users[reservation.email] = dict(data, **update)
+        return remaining
+
+    def release(self, reservation):
+        with self.lock:
+            data = self.users.get(reservation.email, {})
+            self.users[reservation.email] = dict(data, **apply_release(data, reservation, time.time()))
@@ -0,0 +1,307 @@
+import datetime
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import requests
+from google.api_core.exceptions import AlreadyExists
+from google.protobuf import timestamp_pb2
+from caching import content_hash
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITIES = {"high": PRIORITY_HIGH, "normal": PRIORITY_NORMAL, "low": PRIORITY_LOW}
+
+
+class RetryPolicy(namedtuple("RetryPolicy", ["retry_limit", "min_backoff", "max_backoff", "age_limit"])):
+    # Retry parameters of a Cloud Tasks queue, in seconds
+
+    def backoff(self, attempt):
+        # Delay after the given (zero based) attempt failed
+        return min(self.min_backoff * 2 ** attempt, self.max_backoff)
+
+    def gives_up(self, attempt, age):
+        return attempt >= self.retry_limit or age >= self.age_limit
+
+
+# cover-letter-queue in queue.yaml
+QUEUE_RETRY_POLICY = RetryPolicy(retry_limit=10, min_backoff=10, max_backoff=300, age_limit=3600)
+
+# Seconds Cloud Tasks keeps the name of a task that ran or was deleted, turning away new tasks with that name
+TASK_NAME_RETENTION = 3600
+
+# One attempt of a task, as its handler sees it. eta is the wall clock time the attempt was due to start.
+Task = namedtuple("Task", ["task_id", "body", "priority", "attempt", "eta"])
+
+
+class TaskStatuses:
+    """
+    The state of every task by id, so any process or instance can answer a status lookup.
+
+    A status is a dict with the task's state (queued, running, retrying, succeeded or failed), the backend, the
+    number of attempts, and the wall clock times it was enqueued, last started and finished. It is kept as one
+    stage of a checkpoint store entry, and expires with the store's retention. Every update is a transaction of
+    the store, since the enqueueing request and the task's own attempts can update a status at the same time.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def key(self, task_id):
+        return content_hash("task-status", task_id)
+
+    def get(self, task_id):
+        if self.store is None:
+            return None
+        try:
+            return self.store.load(self.key(task_id)).get("status")
+        except Exception as e:
+            print(f"Failed to load the status of task {task_id}: {e}")
+            return None
+
+    def update(self, task_id, defaults=None, **fields):
+        # defaults only fill in fields the status doesn't have yet
+        if self.store is None:
+            return
+
+        def change(status):
+            status = dict(status or {"task_id": task_id})
+            for field, value in (defaults or {}).items():
+                status.setdefault(field, value)
+            status.update(fields)
+            return status
+
+        try:
+            self.store.update(self.key(task_id), "status", change)
+        except Exception as e:
+            # Losing a status update only makes the lookup stale, the task itself carries on
+            print(f"Failed to save the status of task {task_id}: {e}")
+
+    def queued(self, task_id, backend, priority, eta):
+        # A task can start before its enqueuer records it, so this never moves a status back to queued
+        self.update(task_id, defaults={"state": "queued", "attempts": 0, "eta": eta}, backend=backend,
+                    priority=priority, enqueued_at=time.time())
+
+    def started(self, task_id, attempt):
+        self.update(task_id, state="running", attempts=attempt + 1, started_at=time.time())
+
+    def succeeded(self, task_id, result):
+        self.update(task_id, state="succeeded", finished_at=time.time(), result=result, error=None)
+
+    def failed(self, task_id, error, retry_in=None):
+        # retry_in is None once the task is given up on
+        if retry_in is None:
+            self.update(task_id, state="failed", finished_at=time.time(), error=str(error))
+        else:
+            self.update(task_id, state="retrying", error=str(error), eta=time.time() + retry_in)
+
+
+class CloudTasksQueue:
+    """
+    Tasks on a Cloud Tasks queue, delivered to the app as POST requests to relative_uri.
+
+    Cloud Tasks has no priorities, so the priority of a task is only recorded in its status. Its handler updates
+    the status from the X-CloudTasks-* headers of each delivery.
+
+    Args:
+    - get_client: Returns the CloudTasksClient, so it is only built once the first task is enqueued.
+    - stub_url: Post tasks to this local stand-in (loadtest/stubs.py) instead of Cloud Tasks.
+    """
+
+    backend = "cloudtasks"
+
+    def __init__(self, get_client, project, location, queue_name, relative_uri, statuses, stub_url=None):
+        self.get_client = get_client
+        self.project = project
+        self.location = location
+        self.queue_name = queue_name
+        self.relative_uri = relative_uri
+        self.statuses = statuses
+        self.stub_url = stub_url
+
+    def enqueue(self, task_id, body, delay=0, priority=PRIORITY_NORMAL):
+        """
+        Returns:
+        - The full task name, and False when a task with the same id already existed, in which case nothing was
+          enqueued.
+        """
+        if self.stub_url:
+            name, created = self.enqueue_stub(task_id, body, delay)
+        else:
+            name, created = self.enqueue_cloud_tasks(task_id, body, delay)
+        if created:
+            self.statuses.queued(task_id, self.backend, priority, time.time() + delay)
+        return name, created
+
+    def enqueue_stub(self, task_id, body, delay):
+        response = requests.post(self.stub_url, timeout=10, json={
+            "name": task_id,
+            "relative_uri": self.relative_uri,
+            "body": body.decode("utf-8"),
+            "headers": {"Content-Type": "application/json"},
+            "delay_seconds": delay,
+        })
+        if response.status_code == 409:
+            return response.json()["name"], False
+        response.raise_for_status()
+        return response.json()["name"], True
+
+    def enqueue_cloud_tasks(self, task_id, body, delay):
+        client = self.get_client()
+        name = client.task_path(self.project, self.location, self.queue_name, task_id)
+        task = {
+            "name": name,
+            "app_engine_http_request": {
+                "http_method": "POST",
+                "relative_uri": self.relative_uri,
+                "body": body,
+                "headers": {"Content-Type": "application/json"},
+            },
+        }
+        if delay:
+            timestamp = timestamp_pb2.Timestamp()
+            timestamp.FromDatetime(datetime.datetime.utcnow() + datetime.timedelta(seconds=delay))
+            task["schedule_time"] = timestamp
+        try:
+            return client.create_task(parent=client.queue_path(self.project, self.location, self.queue_name),
+                                      task=task).name, True
+        except AlreadyExists:
+            return name, False
+
+    def stats(self):
+        return {}
+
+
+class LocalTaskQueue:
+    """
+    Runs tasks on worker threads of this process instead of sending them through Cloud Tasks, for offline runs
+    and load tests of the whole pipeline without the round trip over HTTP.
+
+    Ready tasks run in priority order, then in the order they became ready. A failed attempt is retried with the
+    backoff of the retry policy, or after the exception's retry_after when that is longer (an AdmissionRejected).
+    Tasks live in memory only: whatever is still queued when the process exits is lost, which is why production
+    uses Cloud Tasks.
+
+    Args:
+    - handler: Function that runs a Task and returns its result, a JSON serializable value. An exception fails
+      the attempt.
+    - workers: Number of tasks run at once.
+    - name_retention: Seconds a task id is turned away after it was enqueued, like Cloud Tasks does with names.
+    """
+
+    backend = "local"
+
+    def __init__(self, handler, statuses, workers=4, retry_policy=QUEUE_RETRY_POLICY,
+                 name_retention=TASK_NAME_RETENTION):
+        self.handler = handler
+        self.statuses = statuses
+        self.retry_policy = retry_policy
+        self.name_retention = name_retention
+        self.condition = threading.Condition()
+        # Heap of (ready at, sequence, task, enqueued at) for tasks that wait for a delay or backoff, and heap of
+        # (priority, sequence, task, enqueued at) for the ones that can run
+        self.scheduled = []
+        self.ready = []
+        self.sequence = itertools.count()
+        # Task id to the time it was enqueued, oldest first
+        self.task_ids = OrderedDict()
+        self.in_progress = 0
+        self.closed = False
+        self.counters = {"enqueued": 0, "duplicates": 0, "succeeded": 0, "retried": 0, "failed": 0}
+        self.workers = [threading.Thread(target=self.work, name=f"task-queue-{index}", daemon=True)
+                        for index in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def enqueue(self, task_id, body, delay=0, priority=PRIORITY_NORMAL):
+        # Same as CloudTasksQueue.enqueue. The id is also checked against the statuses other processes recorded.
+        with self.condition:
+            now = time.monotonic()
+            while self.task_ids and next(iter(self.task_ids.values())) < now - self.name_retention:
+                self.task_ids.popitem(last=False)
+            duplicate = task_id in self.task_ids
+            self.task_ids.setdefault(task_id, now)
+        if duplicate or self.statuses.get(task_id) is not None:
+            self.count("duplicates")
+            return task_id, False
+        self.statuses.queued(task_id, self.backend, priority, time.time() + delay)
+        self.schedule(Task(task_id, body, priority, 0, time.time() + delay), delay, time.monotonic())
+        self.count("enqueued")
+        return task_id, True
+
+    def schedule(self, task, delay, enqueued):
+        with self.condition:
+            heapq.heappush(self.scheduled, (time.monotonic() + delay, next(self.sequence), task, enqueued))
+            self.condition.notify_all()
+
+    def next_task(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while self.scheduled and self.scheduled[0][0] <= now:
+                    _, sequence, task, enqueued = heapq.heappop(self.scheduled)
+                    heapq.heappush(self.ready, (task.priority, sequence, task, enqueued))
+                if self.ready:
+                    self.in_progress += 1
+                    return heapq.heappop(self.ready)[2:]
+                if self.closed:
+                    return None
+                self.condition.wait(self.scheduled[0][0] - now if self.scheduled else None)
+
+    def work(self):
+        while True:
+            item = self.next_task()
+            if item is None:
+                return
+            try:
+                self.run(*item)
+            finally:
+                with self.condition:
+                    self.in_progress -= 1
+                    self.condition.notify_all()
+
+    def run(self, task, enqueued):
+        self.statuses.started(task.task_id, task.attempt)
+        try:
+            result = self.handler(task)
+        except Exception as e:
+            age = time.monotonic() - enqueued
+            if self.retry_policy.gives_up(task.attempt, age):
+                print(f"Giving up on task {task.task_id} after {task.attempt + 1} attempts: {e}")
+                self.count("failed")
+                self.statuses.failed(task.task_id, e)
+                return
+            delay = max(self.retry_policy.backoff(task.attempt), getattr(e, "retry_after", 0))
+            print(f"Task {task.task_id} failed ({e}), retrying in {delay:g}s")
+            self.count("retried")
+            self.statuses.failed(task.task_id, e, retry_in=delay)
+            self.schedule(task._replace(attempt=task.attempt + 1, eta=time.time() + delay), delay, enqueued)
+            return
+        self.count("succeeded")
+        self.statuses.succeeded(task.task_id, result)
+
+    def count(self, counter):
+        with self.condition:
+            self.counters[counter] += 1
+
+    def close(self, timeout=None):
+        # Stop taking tasks and wait for the running ones. Tasks that are still queued are dropped.
+        with self.condition:
+            self.closed = True
+            self.scheduled.clear()
+            self.ready.clear()
+            self.condition.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats["ready"] = len(self.ready)
+            stats["scheduled"] = len(self.scheduled)
+            stats["running"] = self.in_progress
+        return stats
@@ -0,0 +1,87 @@
+import contextvars
+import json
+import os
+import random
+import time
+import uuid
+from contextlib import contextmanager
+
+from metrics import stage_errors, stage_seconds
+
+# Finished spans are printed as one JSON line each. Cloud Logging groups lines that carry the request's trace.
+# Only TRACE_SAMPLE_RATE of the traces are logged, whole, plus every span that failed. The stage metrics count
+# every span either way.
+LOG_SPANS = os.environ.get("TRACE_SPANS", "true").lower() == "true"
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1.0))
+PROJECT_ID = os.environ.get("PROJECT_ID", "coverlettergenerator-396114")
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, parent=None, trace_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id or (parent.trace_id if parent else uuid.uuid4().hex)
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.sampled = parent.sampled if parent else random.random() < TRACE_SAMPLE_RATE
+        self.attributes = dict(attributes or {})
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def log(self):
+        print(json.dumps({
+            "message": f"span {self.name} {self.seconds:.3f}s" + (f" failed: {self.error}" if self.error else ""),
+            "span": self.name,
+            "seconds": round(self.seconds, 4),
+            "error": self.error,
+            "attributes": self.attributes,
+            "logging.googleapis.com/trace": f"projects/{PROJECT_ID}/traces/{self.trace_id}",
+            "logging.googleapis.com/spanId": self.span_id,
+            "parent_span_id": self.parent_id,
+        }, default=str))
+
+
+@contextmanager
+def span(name, trace_id=None, record=True, **attributes):
+    """
+    Trace a stage of the work, as a child of the span it runs in.
+
+    Args:
+    - trace_id: Trace to join when there is no enclosing span, e.g. from the X-Cloud-Trace-Context header.
+    - record: Whether to record the duration and errors in the stage metrics.
+    - attributes: Extra fields logged with the span. More can be added through the yielded Span's set().
+    """
+    current = Span(name, parent=current_span.get(), trace_id=trace_id, attributes=attributes)
+    token = current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current_span.reset(token)
+        current.seconds = time.perf_counter() - current.started
+        if record:
+            stage_seconds.labels(stage=name).observe(current.seconds)
+            if current.error:
+                stage_errors.labels(stage=name, error=current.error).inc()
+        if LOG_SPANS and (current.sampled or current.error):
+            current.log()
+
+
+def traced(function):
+    # Run function in a copy of the caller's context, so spans it starts in another thread keep their parent
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+
+def trace_id_from_header(header):
+    # X-Cloud-Trace-Context is "TRACE_ID/SPAN_ID;o=OPTIONS"
+    if not header:
+        return None
+    return header.split("/", 1)[0] or None